@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Local Stub of the Yuque CDN for Benchmarks
+#
+# Serves generated images of every type over HTTPS with configurable
+# latency, so downloads are measured without the network.
+#
+# Author: Ray Sun <xiaoquqi@gmail.com>
+# Version: 0.1
+# Date: October 17, 2026
+
+
+import argparse
+import http.server
+import io
+import logging
+import os
+import random
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from PIL import Image
+from PIL import ImageChops
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_LATENCY = 0.05
+DEFAULT_IMAGE_SIZE = (1280, 720)
+
+SVG_TEMPLATE = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}">'
+    '<rect width="{0}" height="{1}" fill="#f8f8f8"/>'
+    '<circle cx="{2}" cy="{3}" r="{4}" fill="#1890ff"/>'
+    '<text x="20" y="40" font-size="24">yuque-tools</text>'
+    '</svg>'
+)
+CONTENT_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "gif": "image/gif",
+    "webp": "image/webp",
+    "svg": "image/svg+xml",
+}
+
+
+def generate_images(size=DEFAULT_IMAGE_SIZE, seed=0):
+    """Generate an image of each type served by the stub
+
+    Images are noisy so that compression takes about the time of real
+    screenshots instead of a single color.
+
+    Returns:
+        dict: Image bytes by type
+    """
+    rand = random.Random(seed)
+    width, height = size
+    # Blocks of noise, compressing about like a screenshot
+    blocks = (width // 8, height // 8)
+    # Random.randbytes is only available from Python 3.9
+    noise_size = blocks[0] * blocks[1] * 3
+    noise = Image.frombytes(
+        "RGB", blocks,
+        rand.getrandbits(8 * noise_size).to_bytes(noise_size, "little"))
+    base = Image.blend(Image.new("RGB", size, (248, 248, 248)),
+                       noise.resize(size, Image.NEAREST), 0.3)
+
+    images = {}
+    for image_type, mode in (("png", "RGBA"), ("jpeg", "RGB"),
+                             ("webp", "RGBA")):
+        buffer = io.BytesIO()
+        base.convert(mode).save(buffer, image_type.upper())
+        images[image_type] = buffer.getvalue()
+
+    # Animated gif like screen recordings
+    frames = [
+        ImageChops.offset(base, offset, 0).convert(
+            "P", palette=Image.ADAPTIVE, dither=Image.NONE)
+        for offset in (0, 8, 16)]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, "GIF", save_all=True,
+                   append_images=frames[1:], duration=100, loop=0)
+    images["gif"] = buffer.getvalue()
+
+    images["svg"] = SVG_TEMPLATE.format(
+        width, height, width // 2, height // 2, height // 4).encode("utf-8")
+    return images
+
+
+def generate_certificate(cert_dir, host=DEFAULT_HOST):
+    """Generate a self-signed certificate of host with openssl
+
+    Returns:
+        tuple: Paths of the certificate and the key
+    """
+    cert_path = os.path.join(cert_dir, "cert.pem")
+    key_path = os.path.join(cert_dir, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+         "-days", "1", "-subj", f"/CN={host}",
+         "-addext", f"subjectAltName=IP:{host}",
+         "-keyout", key_path, "-out", cert_path],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_path, key_path
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, as the real CDN
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub.count_request()
+        time.sleep(stub.latency)
+
+        image_type = self.path.split("?", 1)[0].rsplit(".", 1)[-1]
+        content = stub.images.get(image_type)
+        if content is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES[image_type])
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.debug("CDN stub: " + format % args)
+
+
+class CdnStub(object):
+    """HTTPS server answering image urls of the Yuque CDN
+
+    The type of the image is told by the extension of the url, any path
+    is accepted. Every response is delayed by latency seconds.
+    """
+
+    def __init__(self, latency=DEFAULT_LATENCY, host=DEFAULT_HOST, port=0,
+                 image_size=DEFAULT_IMAGE_SIZE):
+        self.latency = latency
+        self.host = host
+        self.port = port
+        self.images = generate_images(image_size)
+        self.requests = 0
+        self.cert_path = None
+
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self._cert_dir = None
+
+    @property
+    def url(self):
+        return f"https://{self.host}:{self.port}"
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        """Start serving in a background thread"""
+        self._cert_dir = tempfile.mkdtemp(prefix="yuque-cdn-stub-")
+        self.cert_path, key_path = generate_certificate(
+            self._cert_dir, self.host)
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.cert_path, key_path)
+
+        self._server = http.server.ThreadingHTTPServer(
+            (self.host, self.port), _Handler)
+        self._server.daemon_threads = True
+        # Handshake in the handler thread, not in the accepting one
+        self._server.socket = context.wrap_socket(
+            self._server.socket, server_side=True,
+            do_handshake_on_connect=False)
+        self._server.stub = self
+        self.port = self._server.server_address[1]
+
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="cdn-stub", daemon=True)
+        self._thread.start()
+        logging.info(f"CDN stub is serving on {self.url}")
+        return self
+
+    def stop(self):
+        """Stop serving and remove the certificate"""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._cert_dir:
+            shutil.rmtree(self._cert_dir, ignore_errors=True)
+            self._cert_dir = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def parse_sys_args(argv):
+    """Parses commaond-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Local stub of the Yuque CDN.")
+    parser.add_argument(
+        "--port", type=int, default=0,
+        help="Port to listen on (default: a free port)")
+    parser.add_argument(
+        "--latency", type=float, default=DEFAULT_LATENCY,
+        help=f"Seconds each response is delayed "
+             f"(default: {DEFAULT_LATENCY})")
+
+    return vars(parser.parse_args(argv[1:]))
+
+
+def main():
+    args = parse_sys_args(sys.argv)
+    logging.basicConfig(level=logging.INFO)
+
+    with CdnStub(latency=args["latency"], port=args["port"]) as stub:
+        print(f"Serving on {stub.url}, trust it with "
+              f"REQUESTS_CA_BUNDLE={stub.cert_path}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Program to Generate Synthetic Yuque Exports for Benchmarks
+#
+# Generates a tree of Yuque-style markdown documents with nested
+# Chinese directory names and images on the Yuque CDN.
+#
+# Author: Ray Sun <xiaoquqi@gmail.com>
+# Version: 0.1
+# Date: October 17, 2026
+
+
+import argparse
+import json
+import os
+import random
+import sys
+
+DEFAULT_CDN_URL = "https://cdn.nlark.com"
+DEFAULT_DOCS = 100
+DEFAULT_PARAGRAPHS = 20
+DEFAULT_IMAGES = 5
+DEFAULT_DEPTH = 2
+DEFAULT_SHARED_RATIO = 0.2
+IMAGE_TYPES = ("png", "jpeg", "svg", "webp", "gif")
+
+DIR_NAMES = (
+    "产品文档", "技术方案", "运维手册", "会议纪要", "第{}章 概述",
+    "附录 [{}]", "API 参考", "常见问题",
+)
+DOC_NAMES = (
+    "快速开始", "安装部署", "架构设计 [{}]", "接口说明", "版本发布记录",
+    "故障排查 {}", "最佳实践", "术语表",
+)
+WORDS = (
+    "语雀", "文档", "迁移", "图片", "格式", "转换", "目录", "知识库",
+    "部署", "服务", "配置", "数据", "备份", "恢复", "网络", "存储",
+    "markdown", "docker", "kubernetes", "API", "CDN",
+)
+IMAGE_PARAMS = (
+    "#averageHue=%23f8f8f8&clientId=u1a2b3c4d-1234&from=paste&height=360"
+    "&id=u5e6f7a8b&originHeight=720&originWidth=1280&originalType=binary"
+    "&ratio=2&rotation=0&showTitle=false&size=123456&status=done"
+    "&style=none&taskId=u9c0d1e2f&title=&width=640"
+)
+
+
+def parse_sys_args(argv):
+    """Parses commaond-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Synthetic Yuque export generator.")
+    parser.add_argument(
+        "-o", "--output-dir",
+        type=str,
+        required=True,
+        help="Directory to generate the export into"
+    )
+    parser.add_argument(
+        "-n", "--docs", type=int, default=DEFAULT_DOCS,
+        help=f"Number of documents (default: {DEFAULT_DOCS})")
+    parser.add_argument(
+        "--paragraphs", type=int, default=DEFAULT_PARAGRAPHS,
+        help=f"Number of paragraphs per document, each is followed by a "
+             f"list, table or code block at random "
+             f"(default: {DEFAULT_PARAGRAPHS})")
+    parser.add_argument(
+        "--images", type=int, default=DEFAULT_IMAGES,
+        help=f"Number of images per document (default: {DEFAULT_IMAGES})")
+    parser.add_argument(
+        "--depth", type=int, default=DEFAULT_DEPTH,
+        help=f"Max depth of nested directories (default: {DEFAULT_DEPTH})")
+    parser.add_argument(
+        "--shared-ratio", type=float, default=DEFAULT_SHARED_RATIO,
+        help=f"Ratio of images used by more than one document "
+             f"(default: {DEFAULT_SHARED_RATIO})")
+    parser.add_argument(
+        "--cdn-url", type=str, default=DEFAULT_CDN_URL,
+        help=f"Base url of images (default: {DEFAULT_CDN_URL})")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="Seed of the generator, same seed generates same export")
+
+    return vars(parser.parse_args(argv[1:]))
+
+
+def generate_export(output_dir, docs=DEFAULT_DOCS,
+                    paragraphs=DEFAULT_PARAGRAPHS, images=DEFAULT_IMAGES,
+                    depth=DEFAULT_DEPTH, shared_ratio=DEFAULT_SHARED_RATIO,
+                    cdn_url=DEFAULT_CDN_URL, seed=0):
+    """Generate a synthetic Yuque export
+
+    Returns:
+        dict: Number of documents, image references, unique image urls and
+            bytes generated
+    """
+    rand = random.Random(seed)
+    shared_urls = []
+    unique_urls = set()
+    stats = {"docs": 0, "images": 0, "unique_images": 0, "bytes": 0}
+
+    for index in range(docs):
+        doc_dir = output_dir
+        for _ in range(rand.randint(0, depth)):
+            name = rand.choice(DIR_NAMES).format(rand.randint(1, 5))
+            doc_dir = os.path.join(doc_dir, name)
+        os.makedirs(doc_dir, exist_ok=True)
+
+        doc_name = rand.choice(DOC_NAMES).format(index)
+        doc_path = os.path.join(doc_dir, "%s-%s.md" % (doc_name, index))
+
+        image_urls = []
+        for _ in range(images):
+            if shared_urls and rand.random() < shared_ratio:
+                url = rand.choice(shared_urls)
+            else:
+                url = _image_url(rand, cdn_url)
+                shared_urls.append(url)
+            image_urls.append(url)
+            unique_urls.add(url)
+
+        content = _document(rand, doc_name, paragraphs, image_urls)
+        with open(doc_path, "w", encoding="utf-8") as f:
+            f.write(content)
+
+        stats["docs"] += 1
+        stats["images"] += len(image_urls)
+        stats["bytes"] += len(content.encode("utf-8"))
+
+    stats["unique_images"] = len(unique_urls)
+    return stats
+
+
+def _image_url(rand, cdn_url):
+    image_type = rand.choice(IMAGE_TYPES)
+    return "%s/yuque/0/2024/%s/%s/%s-%032x.%s" % (
+        cdn_url, image_type, rand.randint(100000, 999999),
+        rand.randint(1700000000000, 1800000000000),
+        rand.getrandbits(128), image_type)
+
+
+def _sentence(rand, words=12):
+    return "".join(rand.choice(WORDS) for _ in range(words)) + "。"
+
+
+def _document(rand, title, paragraphs, image_urls):
+    # Yuque exports have no blank lines between blocks
+    lines = ["# %s" % title]
+    image_lines = [
+        "![image.%s](%s%s)" % (url.rsplit(".", 1)[1], url, IMAGE_PARAMS)
+        for url in image_urls]
+    image_positions = set(
+        rand.sample(range(paragraphs), min(len(image_lines), paragraphs))
+        if paragraphs else [])
+
+    for index in range(paragraphs):
+        if index % 5 == 0:
+            lines.append("## %s %s" % (rand.choice(WORDS), index))
+        lines.append(_sentence(rand, rand.randint(8, 40)))
+
+        block = rand.random()
+        if block < 0.2:
+            lines.extend("- %s" % _sentence(rand, 5) for _ in range(3))
+        elif block < 0.3:
+            lines.append("| 名称 | 说明 |")
+            lines.append("| --- | --- |")
+            lines.extend("| %s | %s |" % (rand.choice(WORDS), _sentence(rand))
+                         for _ in range(3))
+        elif block < 0.4:
+            lines.append("```bash")
+            lines.extend("echo %s" % rand.choice(WORDS) for _ in range(4))
+            lines.append("```")
+
+        if index in image_positions:
+            lines.append(image_lines.pop())
+
+    # Images left when there are fewer paragraphs than images
+    lines.extend(image_lines)
+    return "\n".join(lines) + "\n"
+
+
+def main():
+    args = parse_sys_args(sys.argv)
+    output_dir = args.pop("output_dir")
+    stats = generate_export(output_dir, **args)
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Program to Benchmark Startup Time of Yuque Tools
+#
+# Runs `yuque-tools <command> --help` of each command in fresh processes
+# and checks that the median time over a bare Python startup stays under
+# a target, and that heavy dependencies are not imported until they are
+# used.
+#
+# Author: Ray Sun <xiaoquqi@gmail.com>
+# Version: 0.1
+# Date: October 17, 2026
+
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from yuque_tools import cli
+from yuque_tools.utils import utils
+
+DEFAULT_REPEAT = 10
+DEFAULT_TARGET_MS = 100
+# Dependencies only imported when images, SVGs or Word documents are
+# actually handled
+HEAVY_MODULES = ("requests", "pypinyin", "PIL", "cairosvg", "pypandoc")
+
+
+def parse_sys_args(argv):
+    """Parses commaond-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Yuque tools startup benchmarks.")
+    parser.add_argument(
+        "-d", "--debug", action="store_true", dest="debug",
+        default=False, help="Enable debug message.")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", dest="verbose",
+        default=False, help="Show message in standard output.")
+    parser.add_argument(
+        "-o", "--output",
+        type=str,
+        default=None,
+        help="Save results to the JSON file"
+    )
+    parser.add_argument(
+        "--commands",
+        nargs="+",
+        choices=list(cli.COMMANDS),
+        default=list(cli.COMMANDS),
+        help="Commands to run (default: all)"
+    )
+    parser.add_argument(
+        "-n", "--repeat", type=int, default=DEFAULT_REPEAT,
+        help=f"Number of runs of each command (default: {DEFAULT_REPEAT})")
+    parser.add_argument(
+        "--target", type=float, default=DEFAULT_TARGET_MS,
+        help=f"Max median milliseconds of each command over a bare "
+             f"Python startup (default: {DEFAULT_TARGET_MS})")
+
+    return vars(parser.parse_args(argv[1:]))
+
+
+def _env():
+    # Run the tools of this source tree even if they are not installed
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        path for path in (root, env.get("PYTHONPATH")) if path)
+    return env
+
+
+def time_command(command, repeat):
+    """Return milliseconds of each run of `yuque-tools <command> --help`"""
+    argv = [sys.executable, "-m", "yuque_tools.cli", command, "--help"]
+    env = _env()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(argv, env=env, check=True, stdout=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def heavy_imports(command):
+    """Return heavy modules imported by loading the module of a command"""
+    module_name, _ = cli.COMMANDS[command]
+    code = (f"import sys, {module_name}; "
+            f"print(' '.join(name for name in {HEAVY_MODULES!r} "
+            f"if name in sys.modules))")
+    output = subprocess.run(
+        [sys.executable, "-c", code], env=_env(), check=True,
+        capture_output=True, text=True).stdout
+    return output.split()
+
+
+def python_startup(repeat):
+    """Return milliseconds of each run of a bare interpreter"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def run_benchmarks(args):
+    """Time the commands of args
+
+    Returns:
+        dict: Results of each command, with the median, min and max
+            milliseconds, the median over a bare Python startup, heavy
+            modules imported and if it passed
+    """
+    baseline = statistics.median(python_startup(args["repeat"]))
+    results = {
+        "meta": {
+            "version": utils.get_version(),
+            "python": sys.version.split()[0],
+            "repeat": args["repeat"],
+            "target_ms": args["target"],
+            "python_startup_ms": round(baseline, 2),
+        },
+        "commands": {},
+    }
+
+    for command in args["commands"]:
+        timings = time_command(command, args["repeat"])
+        heavy = heavy_imports(command)
+        median = statistics.median(timings)
+        result = {
+            "median_ms": round(median, 2),
+            "min_ms": round(min(timings), 2),
+            "max_ms": round(max(timings), 2),
+            "overhead_ms": round(median - baseline, 2),
+            "heavy_imports": heavy,
+            "passed": median - baseline <= args["target"] and not heavy,
+        }
+        results["commands"][command] = result
+        logging.info(f"{command}: {result}")
+    return results
+
+
+def main():
+    args = parse_sys_args(sys.argv)
+    utils.init_logging(debug=args["debug"], verbose=args["verbose"])
+
+    results = run_benchmarks(args)
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    if args["output"]:
+        with open(args["output"], "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+    failed = [command for command, result in results["commands"].items()
+              if not result["passed"]]
+    if failed:
+        print(f"Commands over {args['target']}ms or importing heavy "
+              f"modules: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Program to Benchmark Yuque Tools
+#
+# Generates a synthetic export with images on a local CDN stub, times
+# downloading, formatting, image conversion and Word conversion
+# separately and end to end, and saves the results as JSON so runs
+# could be compared.
+#
+# Author: Ray Sun <xiaoquqi@gmail.com>
+# Version: 0.1
+# Date: October 17, 2026
+
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import cdn_stub
+from benchmarks import generate_export
+from yuque_tools import migrate
+from yuque_tools import yuque_images_downloader
+from yuque_tools.markdown_to_word import convert_file
+from yuque_tools.utils import http_client
+from yuque_tools.utils import utils
+from yuque_tools.utils.image_converter import convert_image_to_png
+from yuque_tools.utils.image_downloader import YuqueImageDownloder
+from yuque_tools.utils.markdown_formatter import MarkdownFormatter
+
+DEFAULT_WORKERS = 8
+DEFAULT_JOBS = os.cpu_count()
+DEFAULT_IMAGE_COPIES = 20
+STAGES = (
+    "downloader_serial",
+    "downloader_concurrent",
+    "formatter",
+    "convert_image_to_png",
+    "to_docx",
+    "end_to_end",
+)
+
+
+def parse_sys_args(argv):
+    """Parses commaond-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Yuque tools benchmarks.")
+    parser.add_argument(
+        "-d", "--debug", action="store_true", dest="debug",
+        default=False, help="Enable debug message.")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", dest="verbose",
+        default=False, help="Show message of the tools in standard output.")
+    parser.add_argument(
+        "-o", "--output",
+        type=str,
+        default=None,
+        help="Save results to the JSON file"
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="JSON results of a previous run to compare with"
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=STAGES,
+        default=list(STAGES),
+        help="Stages to run (default: all)"
+    )
+    parser.add_argument(
+        "-n", "--docs", type=int, default=50,
+        help="Number of documents of the export (default: 50)")
+    parser.add_argument(
+        "--paragraphs", type=int, default=generate_export.DEFAULT_PARAGRAPHS,
+        help=f"Number of paragraphs per document "
+             f"(default: {generate_export.DEFAULT_PARAGRAPHS})")
+    parser.add_argument(
+        "--images", type=int, default=generate_export.DEFAULT_IMAGES,
+        help=f"Number of images per document "
+             f"(default: {generate_export.DEFAULT_IMAGES})")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="Seed of the export generator")
+    parser.add_argument(
+        "--latency", type=float, default=cdn_stub.DEFAULT_LATENCY,
+        help=f"Seconds each response of the CDN stub is delayed "
+             f"(default: {cdn_stub.DEFAULT_LATENCY})")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=DEFAULT_WORKERS,
+        help=f"Number of download workers of concurrent stages "
+             f"(default: {DEFAULT_WORKERS})")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=DEFAULT_JOBS,
+        help=f"Number of Word conversion processes of end to end stage "
+             f"(default: {DEFAULT_JOBS})")
+    parser.add_argument(
+        "--image-copies", type=int, default=DEFAULT_IMAGE_COPIES,
+        help=f"Number of images of each type converted by "
+             f"convert_image_to_png stage (default: {DEFAULT_IMAGE_COPIES})")
+    parser.add_argument(
+        "--work-dir", type=str, default=None,
+        help="Directory of generated files, kept after the run "
+             "(default: a temporary dir removed after the run)")
+
+    return vars(parser.parse_args(argv[1:]))
+
+
+@contextlib.contextmanager
+def _patched_argv(argv):
+    old_argv = sys.argv
+    sys.argv = argv
+    try:
+        yield
+    finally:
+        sys.argv = old_argv
+
+
+def tool_args(module, argv):
+    """Return parsed arguments of a tool as its main would get them"""
+    argv = [module.__name__] + argv
+    with _patched_argv(argv):
+        return module.parse_sys_args(argv)
+
+
+class Benchmark(object):
+    """Run the stages on copies of one generated export"""
+
+    def __init__(self, work_dir, stub, args):
+        self.work_dir = work_dir
+        self.stub = stub
+        self.args = args
+        self.export_path = os.path.join(work_dir, "export")
+        self.export_stats = None
+
+    def generate(self):
+        self.export_stats = generate_export.generate_export(
+            self.export_path, docs=self.args["docs"],
+            paragraphs=self.args["paragraphs"], images=self.args["images"],
+            cdn_url=self.stub.url, seed=self.args["seed"])
+        logging.info(f"Generated export: {self.export_stats}")
+
+    def fresh_copy(self, name):
+        """Return a pristine copy of the export for a stage"""
+        path = os.path.join(self.work_dir, name)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        shutil.copytree(self.export_path, path)
+        return path
+
+    def tool_args(self, module, argv):
+        args = tool_args(module, argv)
+        # Processes of the tools log as the benchmark does
+        args.update(debug=self.args["debug"], verbose=self.args["verbose"])
+        return args
+
+    def run(self, stage):
+        """Run a stage
+
+        Only the stage itself is timed, not preparing its input.
+
+        Returns:
+            dict: Seconds taken, number of items processed, items per
+                second and number of requests to the CDN stub
+        """
+        prepare = getattr(self, f"prepare_{stage}", self.fresh_copy)
+        context = prepare(stage)
+        requests_before = self.stub.requests
+
+        started = time.perf_counter()
+        items = getattr(self, f"run_{stage}")(context)
+        seconds = time.perf_counter() - started
+
+        result = _result(seconds, items)
+        result["requests"] = self.stub.requests - requests_before
+        if isinstance(context, dict):
+            result["by_type"] = {
+                image_type: _result(seconds, len(image_paths))
+                for image_type, (image_paths, seconds) in context.items()}
+        logging.info(f"{stage}: {result}")
+        return result
+
+    def run_downloader_serial(self, path):
+        fetcher = http_client.create_fetcher(pool_size=1)
+        md_files = utils.find_md_files(path)
+        for md_file in md_files:
+            YuqueImageDownloder(md_file, "_images", session=fetcher).download()
+        return len(md_files)
+
+    def run_downloader_concurrent(self, path):
+        args = self.tool_args(yuque_images_downloader, [
+            "-p", path, "-w", str(self.args["workers"])])
+        md_files = utils.find_md_files(path)
+        yuque_images_downloader.download_all(md_files, path, args)
+        return len(md_files)
+
+    def run_formatter(self, path):
+        md_files = utils.find_md_files(path)
+        for md_file in md_files:
+            MarkdownFormatter(md_file).format()
+        return len(md_files)
+
+    def prepare_convert_image_to_png(self, stage):
+        path = os.path.join(self.work_dir, stage)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+        # Image paths and seconds of each type, seconds are filled in run
+        images = {}
+        for image_type, content in self.stub.images.items():
+            image_paths = []
+            for index in range(self.args["image_copies"]):
+                image_path = os.path.join(path, f"{index}.{image_type}")
+                with open(image_path, "wb") as f:
+                    f.write(content)
+                image_paths.append(image_path)
+            images[image_type] = (image_paths, None)
+        return images
+
+    def run_convert_image_to_png(self, images):
+        items = 0
+        for image_type, (image_paths, _) in images.items():
+            started = time.perf_counter()
+            for image_path in image_paths:
+                convert_image_to_png(image_path)
+            images[image_type] = (
+                image_paths, time.perf_counter() - started)
+            items += len(image_paths)
+        return items
+
+    def prepare_to_docx(self, stage):
+        # Images are downloaded first, pandoc would fetch them otherwise
+        path = self.fresh_copy(stage)
+        args = self.tool_args(yuque_images_downloader, [
+            "-p", path, "-w", str(self.args["workers"])])
+        md_files = utils.find_md_files(path)
+        yuque_images_downloader.download_all(md_files, path, args)
+        return md_files
+
+    def run_to_docx(self, md_files):
+        for md_file in md_files:
+            convert_file(md_file, os.path.splitext(md_file)[0] + ".docx")
+        return len(md_files)
+
+    def run_end_to_end(self, path):
+        args = self.tool_args(migrate, [
+            "-p", path, "-w", str(self.args["workers"]), "--docx",
+            "-j", str(self.args["jobs"])])
+        md_files = utils.find_md_files(path)
+        migrate.run(args)
+        return len(md_files)
+
+
+def _result(seconds, items):
+    return {
+        "seconds": round(seconds, 4),
+        "items": items,
+        "rate": round(items / seconds, 2) if seconds else None,
+    }
+
+
+def pandoc_version():
+    try:
+        import pypandoc
+        return pypandoc.get_pandoc_version()
+    except (ImportError, OSError):
+        return None
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args):
+    """Run the stages of args and return the results"""
+    stages = [stage for stage in STAGES if stage in args["stages"]]
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "version": utils.get_version(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "pandoc": pandoc_version(),
+            "params": {
+                name: args[name] for name in (
+                    "docs", "paragraphs", "images", "seed", "latency",
+                    "workers", "jobs", "image_copies")},
+        },
+        "stages": {},
+    }
+
+    if "to_docx" in stages and not results["meta"]["pandoc"]:
+        logging.warning("Pandoc is not found, skipping to_docx")
+        stages.remove("to_docx")
+
+    work_dir = args["work_dir"] or tempfile.mkdtemp(prefix="yuque-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        with cdn_stub.CdnStub(latency=args["latency"]) as stub:
+            # Trust the certificate of the stub in the tools
+            os.environ["REQUESTS_CA_BUNDLE"] = stub.cert_path
+            benchmark = Benchmark(work_dir, stub, args)
+            benchmark.generate()
+            results["meta"]["export"] = benchmark.export_stats
+
+            for stage in stages:
+                results["stages"][stage] = benchmark.run(stage)
+    finally:
+        if not args["work_dir"]:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def compare(results, baseline):
+    """Return lines of seconds of each stage against the baseline"""
+    lines = [f"{'stage':<24}{'baseline':>12}{'current':>12}{'change':>10}"]
+    for stage, result in results["stages"].items():
+        old = baseline.get("stages", {}).get(stage)
+        if not old:
+            lines.append(f"{stage:<24}{'-':>12}{result['seconds']:>12.3f}"
+                         f"{'-':>10}")
+            continue
+
+        change = (result["seconds"] - old["seconds"]) / old["seconds"] * 100
+        lines.append(f"{stage:<24}{old['seconds']:>12.3f}"
+                     f"{result['seconds']:>12.3f}{change:>+9.1f}%")
+
+    if baseline.get("meta", {}).get("params") != results["meta"]["params"]:
+        lines.append("Warning: parameters of the runs are different")
+    return lines
+
+
+def main():
+    args = parse_sys_args(sys.argv)
+    utils.init_logging(debug=args["debug"], verbose=args["verbose"])
+
+    results = run_benchmarks(args)
+    output = json.dumps(results, indent=2, ensure_ascii=False)
+    if args["output"]:
+        with open(args["output"], "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+    if args["compare"]:
+        with open(args["compare"]) as f:
+            baseline = json.load(f)
+        print("\n".join(compare(results, baseline)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import base64
+import importlib.util
+import io
+import os
+import tempfile
+import unittest
+
+from yuque_tools.utils.docx_writer import UnsupportedMarkdown
+from yuque_tools.utils.docx_writer import write_docx
+
+HAS_PIL = importlib.util.find_spec("PIL") is not None
+
+
+@unittest.skipUnless(HAS_PIL, "Pillow is not installed")
+class CorruptImageTest(unittest.TestCase):
+    """Images which cannot be read are left to pandoc"""
+
+    def test_corrupt_image_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "a.png"), "wb") as f:
+                f.write(b"notapng")
+            with self.assertRaises(UnsupportedMarkdown):
+                write_docx("![a](a.png)\n", io.BytesIO(), tmp)
+
+    def test_corrupt_data_uri(self):
+        encoded = base64.b64encode(b"notapng").decode("ascii")
+        with self.assertRaises(UnsupportedMarkdown):
+            write_docx(f"![a](data:image/png;base64,{encoded})\n",
+                       io.BytesIO())
+
+
+if __name__ == "__main__":
+    unittest.main()
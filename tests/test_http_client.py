@@ -0,0 +1,229 @@
+import http.server
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from yuque_tools.utils import http_client
+from yuque_tools.utils.image_downloader import fetch_image
+
+IMAGE = b"\x89PNG\r\n\x1a\n" + b"x" * 1024
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the responses queued for each path, then 200 with IMAGE"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            queue = server.responses.get(self.path)
+            action = queue.pop(0) if queue else "ok"
+
+        if action == "drop":
+            # Close without any response
+            self.close_connection = True
+            return
+        if action == "truncate":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(IMAGE)))
+            self.end_headers()
+            self.wfile.write(IMAGE[:len(IMAGE) // 2])
+            self.close_connection = True
+            return
+        if isinstance(action, tuple) and action[0] == "sleep":
+            time.sleep(action[1])
+            action = "ok"
+        if isinstance(action, tuple) and action[0] == "redirect":
+            self.send_response(302)
+            self.send_header("Location", self.path)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        status, headers = (200, {}) if action == "ok" else action
+        body = IMAGE if status == 200 else b""
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.responses = {}
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        # Backoff is kept short, sleeps are still counted
+        patcher = mock.patch.object(http_client, "BACKOFF_BASE", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server.server_port, path)
+
+    def queue(self, path, *responses):
+        self.server.responses[path] = list(responses)
+
+    def fetcher(self, **kwargs):
+        kwargs.setdefault("retries", 3)
+        kwargs.setdefault("max_concurrency", 4)
+        return http_client.Fetcher(session=requests.Session(), **kwargs)
+
+
+class FetcherTest(StubServerTestCase):
+
+    def test_retry_after_is_honoured(self):
+        self.queue("/a.png", (429, {"Retry-After": "0.5"}))
+        fetcher = self.fetcher()
+
+        started = time.monotonic()
+        with fetcher.get(self.url("/a.png")) as response:
+            self.assertEqual(200, response.status_code)
+        self.assertGreaterEqual(time.monotonic() - started, 0.5)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_5xx_is_retried_with_backoff_then_given_up(self):
+        self.queue("/a.png", *[(503, {})] * 2 + [(500, {})] * 10)
+        fetcher = self.fetcher(retries=3)
+
+        with mock.patch.object(http_client, "backoff_delay",
+                               wraps=http_client.backoff_delay) as backoff:
+            with fetcher.get(self.url("/a.png")) as response:
+                self.assertEqual(500, response.status_code)
+        self.assertEqual(4, len(self.server.requests))
+        self.assertEqual([0, 1, 2], [call.args[0]
+                                     for call in backoff.call_args_list])
+
+    def test_connection_error_is_retried(self):
+        self.queue("/a.png", "drop", "drop")
+        fetcher = self.fetcher()
+
+        with fetcher.get(self.url("/a.png")) as response:
+            self.assertEqual(200, response.status_code)
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_connection_refused_gives_up(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        fetcher = self.fetcher(retries=2)
+
+        with mock.patch.object(http_client.time, "sleep") as sleep:
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                fetcher.get("http://127.0.0.1:%d/a.png" % port)
+        self.assertEqual(2, sleep.call_count)
+        limiter = fetcher._get_limiter("http://127.0.0.1:%d/" % port)
+        self.assertEqual(0, limiter._active)
+
+    def test_timeout_is_retried(self):
+        self.queue("/a.png", ("sleep", 1.0))
+        fetcher = self.fetcher(timeout=(1, 0.2))
+
+        with fetcher.get(self.url("/a.png")) as response:
+            self.assertEqual(200, response.status_code)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_other_errors_release_the_slot(self):
+        self.queue("/loop.png", *[("redirect",)] * 100)
+        fetcher = self.fetcher(max_concurrency=1)
+        session = fetcher.session
+        session.max_redirects = 3
+
+        for _ in range(2):
+            with self.assertRaises(requests.exceptions.TooManyRedirects):
+                fetcher.get(self.url("/loop.png"))
+        limiter = fetcher._get_limiter(self.url("/"))
+        self.assertEqual(0, limiter._active)
+        with fetcher.get(self.url("/a.png")) as response:
+            self.assertEqual(200, response.status_code)
+
+    def test_throttling_reduces_and_restores_concurrency(self):
+        self.queue("/a.png", (429, {"Retry-After": "0"}),
+                   (429, {"Retry-After": "0"}))
+        fetcher = self.fetcher(max_concurrency=8)
+        limiter = fetcher._get_limiter(self.url("/"))
+
+        fetcher.get(self.url("/a.png")).close()
+        # Halved twice by the throttled responses, then one success
+        self.assertEqual(2, limiter.limit)
+
+        # 2 + 3 + ... + 7 successes bring it back to the maximum
+        for _ in range(26):
+            fetcher.get(self.url("/a.png")).close()
+        self.assertEqual(8, limiter.limit)
+        self.assertEqual(0, limiter._active)
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+
+    def test_limit_is_halved_and_increased(self):
+        limiter = http_client.AdaptiveLimiter(8, minimum=2)
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(throttled=True)
+        self.assertEqual(2, limiter.limit)
+
+        # A limit's worth of successes increases the limit by one
+        for expected in (3, 4):
+            for _ in range(int(limiter.limit)):
+                limiter.acquire()
+                limiter.release()
+            self.assertEqual(expected, limiter.limit)
+
+    def test_acquire_blocks_at_the_limit(self):
+        limiter = http_client.AdaptiveLimiter(1)
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.2))
+        limiter.release()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+
+
+class FetchImageTest(StubServerTestCase):
+
+    def test_broken_body_is_retried(self):
+        self.queue("/a.png", "truncate")
+        buffer = fetch_image(self.fetcher(), self.url("/a.png"))
+
+        self.assertEqual(IMAGE, buffer.read())
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_broken_body_gives_up(self):
+        self.queue("/a.png", *["truncate"] * 10)
+        buffer = fetch_image(self.fetcher(retries=2), self.url("/a.png"))
+
+        self.assertIsNone(buffer)
+        self.assertEqual(3, len(self.server.requests))
+
+
+if __name__ == "__main__":
+    unittest.main()
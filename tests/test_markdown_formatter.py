@@ -0,0 +1,37 @@
+import os
+import tempfile
+import unittest
+
+from yuque_tools.utils.markdown_formatter import MarkdownFormatter
+
+TEXTS = [
+    "# Title\nfirst\u2028second\nthird\u2029\n",
+    "para\x0cgraph\nnext line\n",
+    "line\x85one\n line two\n",
+    "# Title\r\nfirst\r\n\r\nsecond\r\n",
+    "text\r\n```\r\ncode\r\n```\r\nafter\r\n",
+    "![a](./images/a.png)\ntext\n```\ncode\u2028more\n```\nend",
+]
+
+
+class FormatTextTest(unittest.TestCase):
+    """format_text gives the same result as format on a file"""
+
+    def format_file(self, text):
+        with tempfile.TemporaryDirectory() as tmp:
+            md_path = os.path.join(tmp, "doc.md")
+            with open(md_path, "w", encoding="utf-8", newline="") as f:
+                f.write(text)
+            MarkdownFormatter(md_path).format()
+            with open(md_path, "r", encoding="utf-8", newline="") as f:
+                return f.read()
+
+    def test_format_text_matches_format(self):
+        for text in TEXTS:
+            with self.subTest(text=text):
+                self.assertEqual(MarkdownFormatter().format_text(text),
+                                 self.format_file(text))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Entry Point of Yuque Tools
+#
+# Dispatches `yuque-tools <command>` to the module of the command. Only
+# the module of the command is imported, and modules import their heavy
+# dependencies when they are used, so the tools start fast when they are
+# called for each document, e.g. from hooks.
+#
+# Author: Ray Sun <xiaoquqi@gmail.com>
+# Version: 0.1
+# Date: October 17, 2026
+
+
+import importlib
+import sys
+
+# Command name: (module, help)
+COMMANDS = {
+    "download": (
+        "yuque_tools.yuque_images_downloader",
+        "Download images of markdown files to local dirs"
+    ),
+    "format": (
+        "yuque_tools.yuque_markdown_formatter",
+        "Format markdown files exported from Yuque"
+    ),
+    "to-word": (
+        "yuque_tools.markdown_to_word",
+        "Convert markdown files to Word documents"
+    ),
+    "migrate": (
+        "yuque_tools.migrate",
+        "Download images, format markdown and convert to Word in one pass"
+    ),
+    "restore": (
+        "yuque_tools.restore",
+        "Restore markdown dir from backup snapshots"
+    ),
+}
+
+
+def print_help(file):
+    print("usage: yuque-tools <command> [<args>]\n", file=file)
+    print("Tools for yuque exporter.\n", file=file)
+    print("commands:", file=file)
+    for name, (_, help) in COMMANDS.items():
+        print(f"  {name:<24}{help}", file=file)
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        if len(sys.argv) >= 2 and sys.argv[1] in ("-h", "--help"):
+            print_help(sys.stdout)
+            sys.exit(0)
+        print_help(sys.stderr)
+        sys.exit(1)
+
+    command = sys.argv[1]
+    module_name, _ = COMMANDS[command]
+
+    # Command modules parse sys.argv by themselves
+    sys.argv = [f"yuque-tools {command}"] + sys.argv[2:]
+    module = importlib.import_module(module_name)
+    module.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,12 +14,28 @@
 
 
 import argparse
+import collections
+import concurrent.futures
 import logging
+import multiprocessing
 import os
+import posixpath
 import sys
 
+from yuque_tools.utils import archive
+from yuque_tools.utils import docx_writer
+from yuque_tools.utils import markdown_book
+from yuque_tools.utils import metrics
 from yuque_tools.utils import utils
+from yuque_tools.utils.build_cache import BuildCache
+from yuque_tools.utils.markdown_handler import DEFAULT_ENGINE
+from yuque_tools.utils.markdown_handler import ENGINES
 from yuque_tools.utils.markdown_handler import MarkdownHandler
+from yuque_tools.utils.markdown_handler import pandoc_version
+from yuque_tools.utils.name_normalizer import RenamePlan
+
+DEFAULT_JOBS = 1
+TOOL_NAME = "yuque-markdown-to-word"
 
 
 def parse_sys_args(argv):
@@ -35,7 +51,82 @@ def parse_sys_args(argv):
     parser.add_argument(
         "-p", "--markdown-dir",
         type=str,
-        help="Directory containing Yuque exported markdown files"
+        help="Directory containing Yuque exported markdown files, or a "
+             "zip or tar archive of them"
+    )
+    parser.add_argument(
+        "-o", "--output-archive",
+        type=str,
+        default=None,
+        help="Archive the results are written to if markdown dir is an "
+             "archive, of the format told by its extension (default: "
+             ".converted inserted before the extension of the input)"
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default=DEFAULT_ENGINE,
+        help=f"Engine of conversions, native converts in-process and falls "
+             f"back to pandoc for markdown it does not support "
+             f"(default: {DEFAULT_ENGINE})"
+    )
+    parser.add_argument(
+        "--group-by",
+        choices=markdown_book.GROUP_MODES,
+        default=None,
+        help="Convert the markdown files of each directory (dir) or of "
+             "each top-level directory (book) to one Word document, with "
+             "headings shifted by the depth of each file (default: one "
+             "Word document for each markdown file)"
+    )
+    parser.add_argument(
+        "-f", "--force",
+        action="store_true",
+        default=False,
+        help="Convert all documents, ignoring the build cache of documents "
+             "converted by previous runs (default: False)"
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        nargs="?",
+        const=os.cpu_count(),
+        default=DEFAULT_JOBS,
+        help=f"Number of conversions running in parallel, processes for "
+             f"pandoc and threads for native engine, use all CPU cores if "
+             f"no number is given (default: {DEFAULT_JOBS})"
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=None,
+        help="Only process markdown files whose path relative to markdown "
+             "dir matches the pattern, could be given multiple times"
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=None,
+        help="Skip markdown files and directories whose path relative to "
+             "markdown dir matches the pattern, could be given multiple "
+             "times"
+    )
+
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Save timings of each stage and file to the report, as CSV if "
+             "the path ends with .csv or JSON otherwise"
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=metrics.DEFAULT_PROFILE_PATH,
+        default=None,
+        help=f"Profile the run with cProfile and save the stats to the "
+             f"file (default: {metrics.DEFAULT_PROFILE_PATH} if no file "
+             f"is given)"
     )
 
     if len(sys.argv) == 1:
@@ -49,6 +140,12 @@ def main():
     args = parse_sys_args(sys.argv)
     utils.init_logging(debug=args["debug"], verbose=args["verbose"])
 
+    with metrics.measure_run(TOOL_NAME, report_path=args["report"],
+                             profile_path=args["profile"]):
+        run(args)
+
+
+def run(args):
     markdown_dir = args["markdown_dir"]
     markdown_path = str(os.path.abspath(markdown_dir))
     converted_path = markdown_path + ".converted"
@@ -57,61 +154,224 @@ def main():
         logging.error(f"{markdown_dir} is not exists, please check.")
         sys.exit(1)
 
+    if archive.is_archive(markdown_dir):
+        run_archive(args)
+        return
+
     if not os.path.exists(converted_path):
         os.makedirs(converted_path)
         logging.info(f"Created converted directory at {converted_path}")
 
-    md_files = utils.find_md_files(markdown_path)
+    # Files are renamed below, so the whole tree is walked first
+    md_files = utils.find_md_files(
+        markdown_path, include=args["include"], exclude=args["exclude"])
     if not md_files:
         logging.warning("No markdown file found")
         sys.exit(1)
 
-    for md_file in md_files:
-        logging.info(f"Converting {md_file} to Word document...")
-        
-        # Get the relative path from markdown_path
-        rel_path = os.path.relpath(md_file, markdown_path)
-        rel_path_parts = rel_path.split(os.sep)
-        
-        # Process and rename directories/files
-        current_path = markdown_path
-        processed_parts = []
-        
-        for i, part in enumerate(rel_path_parts):
-            # Process name - replace brackets and remove spaces
-            processed = part.replace('［', '(').replace('］', ')')  # Full-width
-            processed = processed.replace('[', '(').replace(']', ')')  # Half-width
-            processed = processed.replace(' ', '')
-            
-            old_path = os.path.join(current_path, part)
-            new_path = os.path.join(current_path, processed)
-            
-            # Rename if needed
-            if old_path != new_path and os.path.exists(old_path):
-                os.rename(old_path, new_path)
-                logging.debug(f"Renamed {old_path} to {new_path}")
-            
-            current_path = new_path
-            processed_parts.append(processed)
-        
-        processed_rel_path = os.path.join(*processed_parts)
-        processed_full_path = os.path.join(markdown_path, processed_rel_path)
-        
-        # Create output path with .docx extension
-        output_file = os.path.join(
-            converted_path,
-            os.path.splitext(processed_rel_path)[0] + '.docx'
-        )
-        
-        # Create output directory if needed
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    # Rename all files first, so that conversions could run in parallel.
+    # The whole tree is planned at once, each directory is renamed once
+    # after all entries in it.
+    path_map = RenamePlan(markdown_path, md_files).apply()
+
+    # Each conversion is (item, markdown file or group, Word document,
+    # markdown files of the document)
+    conversions = []
+    if args["group_by"]:
+        convert = convert_group
+        for group in markdown_book.group_documents(
+                markdown_path, [path_map[md_file] for md_file in md_files],
+                args["group_by"]):
+            output_file = os.path.join(converted_path, group.name + ".docx")
+            conversions.append(
+                (group.name, group, output_file, group.md_files))
+    else:
+        convert = convert_file
+        for md_file in md_files:
+            new_file = path_map[md_file]
+            output_file = os.path.join(
+                converted_path,
+                os.path.splitext(
+                    os.path.relpath(new_file, markdown_path))[0] + '.docx')
+            conversions.append(
+                (new_file, new_file, output_file, [new_file]))
+
+    engine = args["engine"]
+    # Versions of what writes the documents, the native engine falls back
+    # to pandoc for markdown it does not support
+    writer_version = {"pandoc": pandoc_version()}
+    if engine == "native":
+        writer_version["docx_writer"] = docx_writer.VERSION
+    cache = BuildCache(converted_path, markdown_path, options=dict(
+        engine=engine, group_by=args["group_by"], **writer_version),
+        force=args["force"])
+    removed = cache.remove_stale(
+        [conversion[2] for conversion in conversions])
+    conversions = list(cache.filter_outdated(conversions))
+    logging.info(f"Skipped {cache.skipped} up to date and removed "
+                 f"{removed} stale Word documents")
+
+    output_dirs = set()
+    for _, _, output_file, _ in conversions:
+        output_dir = os.path.dirname(output_file)
+        if output_dir not in output_dirs:
+            os.makedirs(output_dir, exist_ok=True)
+            output_dirs.add(output_dir)
         logging.debug(f"Output file will be saved to {output_file}")
 
-        md_handler = MarkdownHandler(processed_full_path)
-        markdown_content = md_handler.to_docx(output_file)
-        logging.info(
-            f"Successfully converted {processed_full_path} to {output_file}"
-        )
+    try:
+        convert_all(conversions, convert, engine, max(1, args["jobs"]),
+                    cache, args)
+    finally:
+        cache.save()
+
+
+def convert_all(conversions, convert, engine, jobs, cache, args):
+    """Run conversions, recording each converted document in the cache"""
+    if jobs == 1:
+        for item, source, output_file, md_files in conversions:
+            dependencies = cache.dependencies(md_files)
+            with metrics.timer(engine, item=item):
+                convert(source, output_file, engine)
+            cache.update(output_file, dependencies)
+        return
+
+    workers = "threads" if engine == "native" else "processes"
+    logging.info(f"Converting {len(conversions)} files with {jobs} "
+                 f"{workers}")
+    with create_docx_executor(jobs, engine, args) as executor:
+        futures = {}
+        for item, source, output_file, md_files in conversions:
+            future = executor.submit(
+                metrics.call_timed, convert, source, output_file, engine)
+            futures[future] = (item, output_file,
+                               cache.dependencies(md_files))
+        for future in concurrent.futures.as_completed(futures):
+            item, output_file, dependencies = futures[future]
+            try:
+                _, seconds = future.result()
+                metrics.record(engine, seconds, item=item)
+                cache.update(output_file, dependencies)
+            except Exception as e:
+                logging.error(f"Failed to convert {item}: {str(e)}")
+
+
+def create_docx_executor(jobs, engine, args):
+    """Return executor of Word conversions
+
+    Native conversions start no pandoc process and release the GIL while
+    compressing, they run in threads of this process. Pandoc conversions
+    run in worker processes.
+    """
+    if engine == "native":
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs, thread_name_prefix="docx")
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        # Forking while download threads are running is not safe
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=utils.init_worker,
+        initargs=(args["debug"], args["verbose"]))
+
+
+def run_archive(args):
+    """Convert markdown files of an archive to Word documents in an archive
+
+    Images of each document are read from the archive and embedded into
+    the markdown as data URIs, both engines take them from the text and
+    nothing is extracted. Documents are
+    named like the files of a converted dir, in the order of the input.
+    """
+    if args["group_by"]:
+        logging.error("Grouping documents of an archive is not supported")
+        sys.exit(1)
+
+    input_path = args["markdown_dir"]
+    output_path = (args["output_archive"] or
+                   archive.output_path(input_path, "converted"))
+    engine = args["engine"]
+    jobs = max(1, args["jobs"])
+
+    # Each conversion is (markdown member, Word document member, future),
+    # documents are written in order and at most a few are kept in memory
+    pending = collections.deque()
+
+    def write_done(limit):
+        while len(pending) > limit:
+            name, output_name, future = pending.popleft()
+            try:
+                data, seconds = future.result()
+            except Exception as e:
+                logging.error(f"Failed to convert {name}: {str(e)}")
+                continue
+            metrics.record(engine, seconds, item=name)
+            writer.write(output_name, data)
+            logging.info(f"Successfully converted {name} to {output_name}")
+
+    found = 0
+    # Conversions wait for pandoc or release the GIL, threads are enough.
+    # The archive is only read from this thread.
+    with archive.ArchiveReader(input_path) as reader, \
+            archive.create_archive(output_path) as writer, \
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs) as executor:
+        for member in reader:
+            if not utils.is_md_path(member.name, include=args["include"],
+                                    exclude=args["exclude"]):
+                continue
+
+            found += 1
+            text = markdown_book.embed_images(
+                reader.read(member).decode("utf-8"), member.name,
+                reader.read_name)
+            output_name = "/".join(
+                utils.normalize_name(part) for part in
+                posixpath.splitext(member.name)[0].split("/")) + ".docx"
+            pending.append((member.name, output_name, executor.submit(
+                metrics.call_timed, convert_text, text, engine,
+                member.name)))
+            write_done(jobs * 2)
+        write_done(0)
+
+    if not found:
+        logging.warning("No markdown file found")
+        sys.exit(1)
+
+
+def convert_text(text, engine=DEFAULT_ENGINE, name=None):
+    """Convert markdown text to a Word document returned as bytes"""
+    logging.info(f"Converting {name} to Word document...")
+    md_handler = MarkdownHandler(content=text, name=name)
+    return md_handler.to_docx_bytes(engine=engine)
+
+
+def convert_file(md_file, output_file, engine=DEFAULT_ENGINE):
+    """Convert a single markdown file to Word document"""
+    logging.info(f"Converting {md_file} to Word document...")
+    md_handler = MarkdownHandler(md_file)
+    md_handler.to_docx(output_file, engine=engine)
+    logging.info(f"Successfully converted {md_file} to {output_file}")
+
+
+def convert_content(text, md_file, output_file, engine=DEFAULT_ENGINE):
+    """Convert markdown text of md_file already in memory to Word document
+
+    Relative images are resolved against the dir of md_file, the file is
+    not read again.
+    """
+    logging.info(f"Converting {md_file} to Word document...")
+    md_handler = MarkdownHandler(
+        content=text, resource_path=os.path.dirname(os.path.abspath(md_file)),
+        name=md_file)
+    md_handler.to_docx(output_file, engine=engine)
+    logging.info(f"Successfully converted {md_file} to {output_file}")
+
+
+def convert_group(group, output_file, engine=DEFAULT_ENGINE):
+    """Convert a group of markdown files to one Word document"""
+    group.to_docx(output_file, engine=engine)
+    logging.info(f"Successfully converted {len(group.md_files)} files of "
+                 f"{group.name} to {output_file}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,578 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Program to Migrate Yuque Markdown Documents
+#
+# This program downloads images, formats markdown and optionally
+# converts to Word documents in a single pipeline. Each document
+# is read once, processed in memory and written once, stages of
+# different documents run at the same time. With --watch it keeps
+# running and migrates documents as they are created or modified.
+#
+# Author: Ray Sun <xiaoquqi@gmail.com>
+# Version: 0.1
+# Date: October 17, 2026
+
+
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import logging
+import os
+import signal
+import sys
+import time
+
+from yuque_tools.markdown_to_word import convert_content
+from yuque_tools.markdown_to_word import create_docx_executor
+from yuque_tools.utils import backup
+from yuque_tools.utils import http_client
+from yuque_tools.utils import image_converter
+from yuque_tools.utils import journal as run_journal
+from yuque_tools.utils import metrics
+from yuque_tools.utils import utils
+from yuque_tools.utils import watcher as tree_watcher
+from yuque_tools.utils.image_downloader import YuqueImageDownloder
+from yuque_tools.utils.image_pipeline import DEFAULT_QUEUE_SIZE
+from yuque_tools.utils.image_pipeline import ImagePipeline
+from yuque_tools.utils.manifest import ProcessedManifest
+from yuque_tools.utils.manifest import file_record
+from yuque_tools.utils.manifest import is_record_current
+from yuque_tools.utils.markdown_formatter import MarkdownFormatter
+from yuque_tools.utils.markdown_handler import DEFAULT_ENGINE
+from yuque_tools.utils.markdown_handler import ENGINES
+from yuque_tools.yuque_images_downloader import DEFAULT_IMAGE_PATH
+from yuque_tools.yuque_images_downloader import DEFAULT_IMAGE_STORE_PATH
+from yuque_tools.yuque_images_downloader import get_encoding_policy
+from yuque_tools.yuque_images_downloader import get_image_store
+
+DEFAULT_CONVERTED_PATH = ".converted"
+DEFAULT_WORKERS = 4
+DEFAULT_JOBS = 1
+DEFAULT_CONTROL_SOCKET = ".watch.sock"
+# Seconds the watch loop sleeps at most, a stop request is noticed within
+WATCH_WAKE_INTERVAL = 1.0
+TOOL_NAME = "yuque-tools-migrate"
+
+
+def parse_sys_args(argv):
+    """Parses commaond-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Yuque documents migration pipeline.")
+    parser.add_argument(
+        "-d", "--debug", action="store_true", dest="debug",
+        default=False, help="Enable debug message.")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", dest="verbose",
+        default=True, help="Show message in standard output.")
+    parser.add_argument(
+        "-p", "--markdown-dir",
+        type=str,
+        help="Directory containing Yuque exported markdown files"
+    )
+    parser.add_argument(
+        "-i", "--image-download-dir",
+        type=str,
+        default=DEFAULT_IMAGE_PATH,
+        help=(
+            f"Directory to save downloaded images (default is "
+            f"{DEFAULT_IMAGE_PATH} at the same level of markdown "
+            f"file)"
+        )
+    )
+    parser.add_argument(
+        "-b", "--backup",
+        action="store_true",
+        default=False,
+        help="Backup original markdown files before processing, "
+             "unchanged files are hardlinked into the snapshot "
+             "(default: False, backup to .bak in the same level as "
+             "markdown dir)"
+    )
+    parser.add_argument(
+        "--keep-backups",
+        type=int,
+        default=backup.DEFAULT_KEEP_SNAPSHOTS,
+        help=f"Number of backup snapshots to keep "
+             f"(default: {backup.DEFAULT_KEEP_SNAPSHOTS})"
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=f"Number of documents and image downloads processed at the "
+             f"same time (default: {DEFAULT_WORKERS})"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=http_client.DEFAULT_TIMEOUT[1],
+        help=f"Timeout in seconds of connecting and reading each chunk of "
+             f"an image (default: {http_client.DEFAULT_TIMEOUT[1]})"
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=http_client.DEFAULT_RETRIES,
+        help=f"Max number of retries of an image download on connection "
+             f"errors, timeouts and 429/5xx responses "
+             f"(default: {http_client.DEFAULT_RETRIES})"
+    )
+    parser.add_argument(
+        "--convert-workers",
+        type=int,
+        default=None,
+        help="Number of processes converting downloaded images "
+             "(default: number of CPU cores)"
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help=f"Max number of downloaded images waiting for conversion, "
+             f"downloads pause when the queue is full "
+             f"(default: {DEFAULT_QUEUE_SIZE})"
+    )
+    parser.add_argument(
+        "--image-format",
+        choices=image_converter.ENCODING_FORMATS,
+        default=image_converter.DEFAULT_ENCODING_FORMAT,
+        help=f"Format downloaded images are encoded to, keep to keep the "
+             f"original format, JPEG and WebP are much smaller than PNG "
+             f"for photos (default: "
+             f"{image_converter.DEFAULT_ENCODING_FORMAT})"
+    )
+    parser.add_argument(
+        "--image-quality",
+        type=int,
+        default=image_converter.DEFAULT_QUALITY,
+        help=f"Quality of JPEG and WebP images, 1 to 100 "
+             f"(default: {image_converter.DEFAULT_QUALITY})"
+    )
+    parser.add_argument(
+        "--max-image-pixels",
+        type=int,
+        default=None,
+        help="Downscale images whose width or height is larger than this, "
+             "JPEG images are decoded at reduced size (default: no limit)"
+    )
+    parser.add_argument(
+        "--max-image-bytes",
+        type=int,
+        default=None,
+        help="Byte budget of each image, larger images are re-encoded with "
+             "lower quality and downscaled to fit (default: no limit)"
+    )
+    parser.add_argument(
+        "--keep-alpha",
+        action="store_true",
+        default=False,
+        help="Keep transparency of re-encoded PNG and WebP images, it is "
+             "flattened over white by default"
+    )
+    parser.add_argument(
+        "-s", "--image-store",
+        nargs="?",
+        const="",
+        default=None,
+        help=f"Content-addressed image store, each image url is downloaded "
+             f"once and linked into every images dir. Without a value the "
+             f"store is saved to {DEFAULT_IMAGE_STORE_PATH} in the same "
+             f"level as markdown dir (default: disabled)"
+    )
+    parser.add_argument(
+        "--docx",
+        action="store_true",
+        default=False,
+        help=f"Convert documents to Word documents, saved to "
+             f"{DEFAULT_CONVERTED_PATH} in the same level as markdown dir "
+             f"(default: False)"
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default=DEFAULT_ENGINE,
+        help=f"Engine of Word conversions, native converts in-process and "
+             f"falls back to pandoc for markdown it does not support "
+             f"(default: {DEFAULT_ENGINE})"
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        nargs="?",
+        const=os.cpu_count(),
+        default=DEFAULT_JOBS,
+        help=f"Number of Word conversions running in parallel processes, "
+             f"use all CPU cores if no number is given "
+             f"(default: {DEFAULT_JOBS})"
+    )
+    parser.add_argument(
+        "-f", "--force",
+        action="store_true",
+        default=False,
+        help="Process all markdown files, ignoring the manifest of files "
+             "processed by previous runs (default: False)"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Resume an interrupted run, documents and images it finished "
+             "are not processed again (default: False)"
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=None,
+        help="Only process markdown files whose path relative to markdown "
+             "dir matches the pattern, could be given multiple times"
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=None,
+        help="Skip markdown files and directories whose path relative to "
+             "markdown dir matches the pattern, could be given multiple "
+             "times"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        default=False,
+        help="Keep running after the first pass and migrate markdown files "
+             "as they are created or modified, with the same session, "
+             "caches and pools (default: False)"
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=tree_watcher.DEFAULT_DEBOUNCE,
+        help=f"Seconds a changed markdown file must stay unchanged before "
+             f"it is migrated in watch mode "
+             f"(default: {tree_watcher.DEFAULT_DEBOUNCE})"
+    )
+    parser.add_argument(
+        "--polling",
+        action="store_true",
+        default=False,
+        help="Find changes by polling the tree instead of inotify in watch "
+             "mode, e.g. for network file systems (default: False)"
+    )
+    parser.add_argument(
+        "--control-socket",
+        type=str,
+        default=None,
+        help=f"Unix socket reporting status of watch mode, send status or "
+             f"stop to it (default: {DEFAULT_CONTROL_SOCKET} in the same "
+             f"level as markdown dir)"
+    )
+
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Save timings of each stage and file to the report, as CSV if "
+             "the path ends with .csv or JSON otherwise"
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=metrics.DEFAULT_PROFILE_PATH,
+        default=None,
+        help=f"Profile the run with cProfile and save the stats to the "
+             f"file (default: {metrics.DEFAULT_PROFILE_PATH} if no file "
+             f"is given)"
+    )
+
+    if len(sys.argv) == 1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    else:
+        return vars(parser.parse_args(argv[1:]))
+
+
+def main():
+    args = parse_sys_args(sys.argv)
+    utils.init_logging(debug=args["debug"], verbose=args["verbose"])
+
+    with metrics.measure_run(TOOL_NAME, report_path=args["report"],
+                             profile_path=args["profile"]):
+        run(args)
+
+
+def run(args):
+    markdown_dir = args["markdown_dir"]
+    markdown_path = str(os.path.abspath(markdown_dir))
+
+    if not os.path.exists(markdown_dir):
+        logging.error(f"{markdown_dir} is not exists, please check.")
+        sys.exit(1)
+
+    if args["backup"]:
+        backup.snapshot(markdown_dir, keep=args["keep_backups"])
+
+    prune = utils.DEFAULT_PRUNE_PATTERNS + (
+        os.path.basename(args["image_download_dir"]),)
+    md_files = utils.iter_md_files(
+        markdown_path, include=args["include"], exclude=args["exclude"],
+        prune=prune)
+
+    options = {
+        "image_download_dir": args["image_download_dir"],
+        "image_encoding": get_encoding_policy(args).options(),
+        "docx": args["docx"]
+    }
+    manifest = ProcessedManifest(
+        markdown_path, TOOL_NAME, options=options, force=args["force"])
+    journal = run_journal.Journal(
+        markdown_path, TOOL_NAME, options=options, resume=args["resume"])
+
+    with contextlib.ExitStack() as stack:
+        watcher = None
+        if args["watch"]:
+            # Started first, files changed during the first pass are seen
+            watcher = stack.enter_context(tree_watcher.TreeWatcher(
+                markdown_path, debounce=args["debounce"],
+                include=args["include"], exclude=args["exclude"],
+                prune=prune, polling=args["polling"]))
+        pipeline = stack.enter_context(open_pipeline(markdown_path, args))
+
+        # Markdown files are processed as they are found
+        try:
+            failed = migrate_batch(
+                journal.filter_pending(manifest.filter_changed(md_files),
+                                       manifest),
+                markdown_path, args, pipeline, manifest, journal)
+        except BaseException:
+            journal.close()
+            logging.info("Run is interrupted, continue it with --resume")
+            raise
+        else:
+            journal.finish()
+        finally:
+            manifest.save()
+
+        if not manifest.found:
+            logging.warning("No markdown file found")
+            if not watcher:
+                sys.exit(1)
+        logging.info(f"Skipped {manifest.skipped} unchanged markdown files")
+
+        if watcher:
+            watch(watcher, markdown_path, args, pipeline, manifest, failed)
+
+
+def watch(watcher, markdown_path, args, pipeline, manifest, failed=()):
+    """Migrate markdown files as they settle until stopped
+
+    Files are migrated in batches, changes seen while a batch runs go to
+    the next one. Files rewritten by the pipeline itself are unchanged in
+    the manifest and skipped, a file which failed is only retried once it
+    is changed again. The daemon stops on SIGTERM, Ctrl-C or stop
+    sent to the control socket, after the current batch.
+    """
+    status = tree_watcher.WatchStatus(
+        watcher, pipeline.image_pipeline.counters)
+    socket_path = (args["control_socket"] or
+                   markdown_path + DEFAULT_CONTROL_SOCKET)
+    signal.signal(signal.SIGTERM, lambda *_: status.stop())
+    # Record of each failed file taken after its batch
+    failures = {md_file: file_record(md_file) for md_file in failed
+                if os.path.isfile(md_file)}
+
+    with tree_watcher.ControlServer(socket_path, status):
+        while not status.stopped:
+            md_files = [
+                md_file for md_file in watcher.wait(WATCH_WAKE_INTERVAL)
+                if os.path.isfile(md_file) and not (
+                    md_file in failures and
+                    is_record_current(md_file, failures[md_file]))]
+            md_files = list(manifest.filter_changed(md_files))
+            if not md_files:
+                continue
+
+            logging.info(f"Migrating {len(md_files)} changed markdown files")
+            status.start_batch(md_files)
+            try:
+                failed = migrate_batch(md_files, markdown_path, args,
+                                       pipeline, manifest, status=status)
+            finally:
+                manifest.save()
+
+            for md_file in md_files:
+                failures.pop(md_file, None)
+            for md_file in failed:
+                if os.path.isfile(md_file):
+                    failures[md_file] = file_record(md_file)
+    logging.info(f"Stopped watching {markdown_path}")
+
+
+Pipeline = collections.namedtuple(
+    "Pipeline", ["session", "image_pipeline", "md_executor",
+                 "docx_executor", "converted_path"])
+
+
+@contextlib.contextmanager
+def open_pipeline(markdown_path, args):
+    """Start the session and pools shared by all documents of a run
+
+    Documents are processed in a thread pool, their images go through the
+    image pipeline and Word conversions run in a process pool, or a thread
+    pool with the native engine. In watch mode they are kept for all
+    batches, so later documents start with warm connections and workers.
+    """
+    policy = get_encoding_policy(args)
+    image_store = get_image_store(args, markdown_path)
+
+    converted_path = None
+    if args["docx"]:
+        converted_path = markdown_path + DEFAULT_CONVERTED_PATH
+
+    workers = max(1, args["workers"])
+    jobs = max(1, args["jobs"])
+    session = http_client.create_fetcher(
+        pool_size=workers, timeout=args["timeout"], retries=args["retries"])
+
+    with ImagePipeline(
+            session, workers,
+            convert_workers=args["convert_workers"],
+            queue_size=args["queue_size"],
+            image_store=image_store,
+            policy=policy,
+            debug=args["debug"],
+            verbose=args["verbose"]) as image_pipeline, \
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers,
+                thread_name_prefix="markdown") as md_executor, \
+            create_docx_executor(jobs, args["engine"], args) as docx_executor:
+        yield Pipeline(session, image_pipeline, md_executor, docx_executor,
+                       converted_path)
+
+
+def migrate_batch(md_files, markdown_path, args, pipeline, manifest=None,
+                  journal=None, status=None):
+    """Run markdown files through the pools of a started pipeline
+
+    Each file finished or failed is reported to status, if given. A file
+    with images which failed to download is still converted, but reported
+    as failed and not recorded as processed, so its images are retried.
+
+    Returns:
+        list: Markdown files which failed
+    """
+    engine = args["engine"]
+    failed_files = []
+
+    def done(md_file):
+        if journal:
+            journal.doc_done(md_file)
+        if manifest:
+            manifest.update(md_file)
+        if status:
+            status.doc_done(md_file)
+
+    def failed(md_file, action, error):
+        logging.error(f"Failed to {action} {md_file}: {str(error)}")
+        failed_files.append(md_file)
+        if status:
+            status.doc_failed(md_file, f"Failed to {action}: {str(error)}")
+
+    def finished(md_file, failed_images):
+        if failed_images:
+            failed(md_file, "download images of",
+                   f"{failed_images} images are left linked to Yuque")
+        else:
+            done(md_file)
+
+    md_futures = {
+        pipeline.md_executor.submit(
+            migrate_file, md_file, args["image_download_dir"],
+            pipeline.session, pipeline.image_pipeline, journal): md_file
+        for md_file in md_files}
+
+    docx_futures = {}
+    try:
+        for future in concurrent.futures.as_completed(md_futures):
+            md_file = md_futures[future]
+            try:
+                text, failed_images = future.result()
+            except Exception as e:
+                failed(md_file, "migrate", e)
+                continue
+
+            if not pipeline.converted_path:
+                finished(md_file, failed_images)
+                continue
+
+            output_file = get_output_file(
+                md_file, markdown_path, pipeline.converted_path)
+            # The formatted text is converted, the file is not read again
+            docx_future = pipeline.docx_executor.submit(
+                metrics.call_timed, convert_content, text, md_file,
+                output_file, engine)
+            docx_futures[docx_future] = (md_file, failed_images)
+
+        for future in concurrent.futures.as_completed(docx_futures):
+            md_file, failed_images = docx_futures[future]
+            try:
+                _, seconds = future.result()
+                metrics.record(engine, seconds, item=md_file)
+            except Exception as e:
+                failed(md_file, "convert", e)
+                continue
+
+            finished(md_file, failed_images)
+    except BaseException:
+        # Documents not started are left to a resumed run, the pools wait
+        # for the running ones when they are closed
+        utils.cancel_futures(md_futures)
+        utils.cancel_futures(docx_futures)
+        raise
+    return failed_files
+
+
+def migrate_file(md_file, image_download_dir, session, image_pipeline,
+                 journal=None):
+    """Download images and format a markdown file with one read and write
+
+    The file is only written if its text changed.
+
+    Returns:
+        tuple: The migrated text, to be converted without reading the
+            file, and the number of image links which failed to download
+    """
+    logging.info(f"Starting to migrate {md_file}")
+    started = time.perf_counter()
+    with open(md_file, "r", encoding="utf-8") as f:
+        original = f.read()
+
+    image_downloader = YuqueImageDownloder(
+        md_file, image_download_dir, session=session,
+        image_pipeline=image_pipeline, journal=journal)
+    text = image_downloader.download_text(original)
+
+    text = MarkdownFormatter(md_file).format_text(text)
+
+    if text != original:
+        with utils.atomic_open(md_file, "w", encoding="utf-8") as f:
+            f.write(text)
+    metrics.record("markdown", time.perf_counter() - started, item=md_file)
+    logging.info(f"Finish migrating {md_file}")
+    logging.info(f"Image pipeline: {image_pipeline.counters}")
+    return text, image_downloader.failed
+
+
+def get_output_file(md_file, markdown_path, converted_path):
+    """Return Word document path of a markdown file in converted dir"""
+    rel_path = os.path.relpath(md_file, markdown_path)
+    processed_rel_path = os.path.join(
+        *[utils.normalize_name(part) for part in rel_path.split(os.sep)])
+    output_file = os.path.join(
+        converted_path, os.path.splitext(processed_rel_path)[0] + ".docx")
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    return output_file
+
+
+if __name__ == "__main__":
+    main()
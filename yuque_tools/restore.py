@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Program to Restore Markdown Directory from Backup Snapshots
+#
+# Author: Ray Sun <xiaoquqi@gmail.com>
+# Version: 0.1
+# Date: October 17, 2026
+
+
+import argparse
+import logging
+import os
+import sys
+
+from yuque_tools.utils import backup
+from yuque_tools.utils import utils
+
+
+def parse_sys_args(argv):
+    """Parses commaond-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Restore markdown dir from backup snapshots.")
+    parser.add_argument(
+        "-d", "--debug", action="store_true", dest="debug",
+        default=False, help="Enable debug message.")
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", dest="verbose",
+        default=True, help="Show message in standard output.")
+    parser.add_argument(
+        "-p", "--markdown-dir",
+        type=str,
+        help="Directory containing Yuque exported markdown files"
+    )
+    parser.add_argument(
+        "-s", "--snapshot",
+        type=str,
+        default=None,
+        help="Name of the snapshot to restore (default: the latest one)"
+    )
+    parser.add_argument(
+        "-l", "--list",
+        action="store_true",
+        default=False,
+        help="List snapshots of markdown dir instead of restoring"
+    )
+
+    if len(sys.argv) == 1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    else:
+        return vars(parser.parse_args(argv[1:]))
+
+
+def main():
+    args = parse_sys_args(sys.argv)
+    utils.init_logging(debug=args["debug"], verbose=args["verbose"])
+
+    markdown_dir = args["markdown_dir"]
+    snapshots = backup.list_snapshots(markdown_dir)
+
+    if args["list"]:
+        backup_path = backup.get_backup_path(markdown_dir)
+        for name in snapshots:
+            print(os.path.join(backup_path, name))
+        return
+
+    try:
+        backup.restore(markdown_dir, args["snapshot"])
+    except ValueError as e:
+        logging.error(f"{str(e)}, please check.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+import collections
+import contextlib
+import copy
+import io
+import logging
+import os
+import shutil
+import struct
+import tarfile
+import time
+import zipfile
+
+from yuque_tools.utils import utils
+
+ZIP_SUFFIXES = (".zip",)
+TAR_SUFFIXES = {
+    ".tar": "",
+    ".tar.gz": "gz",
+    ".tgz": "gz",
+    ".tar.bz2": "bz2",
+    ".tbz2": "bz2",
+    ".tar.xz": "xz",
+    ".txz": "xz",
+}
+# Members already compressed are stored in zip archives as they are
+STORED_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".docx",
+                     ".zip", ".gz")
+COPY_CHUNK_SIZE = 1024 * 1024
+# Zip archives could not store earlier times
+ZIP_MIN_MTIME = time.mktime((1980, 1, 1, 0, 0, 0, 0, 0, -1))
+
+ZIP_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+ZIP_LOCAL_SIGNATURE = b"PK\x03\x04"
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+ZIP_UTF8_FLAG = 0x800
+ZIP_ENCRYPTED_FLAG = 0x01
+ZIP64_EXTRA_ID = 0x0001
+
+Member = collections.namedtuple("Member", ["name", "size", "mtime", "info"])
+
+
+def archive_suffix(path):
+    """Return the archive suffix of path, None if it is not an archive"""
+    lower = path.lower()
+    for suffix in ZIP_SUFFIXES + tuple(TAR_SUFFIXES):
+        if lower.endswith(suffix):
+            return suffix
+    return None
+
+
+def is_archive(path):
+    """Return True if path is an existing zip or tar archive"""
+    return bool(archive_suffix(path)) and os.path.isfile(path)
+
+
+def output_path(path, tag):
+    """Return the default output archive of path, e.g. a.tag.zip of a.zip"""
+    suffix = archive_suffix(path)
+    return path[:-len(suffix)] + "." + tag + path[-len(suffix):]
+
+
+def _member_name(name):
+    # Names of tar archives made of "." start with "./"
+    while name.startswith("./"):
+        name = name[2:]
+    return name
+
+
+def _zip_name(info):
+    # Names without the UTF-8 flag are decoded as cp437 by zipfile, but
+    # most tools write UTF-8 names without setting it
+    if info.flag_bits & ZIP_UTF8_FLAG:
+        return info.filename
+    try:
+        return info.filename.encode("cp437").decode("utf-8")
+    except UnicodeError:
+        return info.filename
+
+
+def _safe_name(name):
+    # Members are never placed outside of the tree
+    parts = name.split("/")
+    return not (name.startswith("/") or ".." in parts or
+                "\\" in name or ":" in parts[0])
+
+
+class ArchiveReader(object):
+    """Members of a zip or tar archive read as streams
+
+    Members are iterated in the order they are stored, a tar archive is
+    read once from start to end and never extracted. Directories, links
+    and members with unsafe names are skipped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if archive_suffix(path) in ZIP_SUFFIXES:
+            self.zip = zipfile.ZipFile(path)
+            self.tar = None
+        else:
+            self.zip = None
+            self.tar = tarfile.open(path, "r:*")
+        self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        (self.zip or self.tar).close()
+
+    def __iter__(self):
+        if self.zip:
+            infos = (info for info in self.zip.infolist()
+                     if not info.is_dir())
+            members = (Member(_member_name(_zip_name(info)), info.file_size,
+                              time.mktime(info.date_time + (0, 0, -1)),
+                              info) for info in infos)
+        else:
+            members = (Member(_member_name(info.name), info.size,
+                              info.mtime, info)
+                       for info in self.tar if info.isfile())
+
+        for member in members:
+            if not _safe_name(member.name):
+                logging.warning(f"Skip unsafe member {member.name} of "
+                                f"{self.path}")
+                continue
+            yield member
+
+    def _members_by_name(self):
+        if self._index is None:
+            if self.zip:
+                infos = ((_zip_name(info), info)
+                         for info in self.zip.infolist()
+                         if not info.is_dir())
+            else:
+                infos = ((info.name, info) for info in self.tar.getmembers()
+                         if info.isfile())
+            self._index = {_member_name(name): info for name, info in infos}
+        return self._index
+
+    def names(self):
+        """Return names of all file members
+
+        A compressed tar archive is decompressed once more to list them,
+        its members are not indexed until they are read.
+        """
+        return self._members_by_name().keys()
+
+    def open(self, member):
+        """Return a binary stream of a member"""
+        if self.zip:
+            return self.zip.open(member.info)
+        return self.tar.extractfile(member.info)
+
+    def read(self, member):
+        with self.open(member) as f:
+            return f.read()
+
+    def read_name(self, name):
+        """Return bytes of a file member by name, None if it is missing
+
+        A compressed tar archive might be decompressed again from its start
+        to reach a member behind the current position.
+        """
+        info = self._members_by_name().get(name)
+        if info is None:
+            return None
+        if self.zip:
+            return self.zip.read(info)
+        with self.tar.extractfile(info) as f:
+            return f.read()
+
+
+@contextlib.contextmanager
+def create_archive(path):
+    """Return an ArchiveWriter of a temp file which replaces path once done
+
+    A failed run never leaves a broken archive at path.
+    """
+    with utils.atomic_path(path) as tmp_path:
+        writer = ArchiveWriter(tmp_path, archive_suffix(path))
+        try:
+            yield writer
+        finally:
+            writer.close()
+    logging.info(f"Saved archive {path}, {writer.copied_raw} members "
+                 f"copied without recompressing")
+
+
+class ArchiveWriter(object):
+    """Zip or tar archive written member by member
+
+    A member is only written once, later members of the same name are
+    skipped.
+    """
+
+    def __init__(self, path, suffix=None):
+        """Create an archive
+
+        Args:
+            path (str): Path of the archive
+            suffix (str, optional): Archive suffix telling the format, the
+                suffix of path by default
+        """
+        self.path = path
+        suffix = suffix or archive_suffix(path)
+        if suffix in ZIP_SUFFIXES:
+            self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+            self.tar = None
+        else:
+            self.zip = None
+            self.tar = tarfile.open(path, "w:" + TAR_SUFFIXES[suffix])
+        self.copied_raw = 0
+        self._names = set()
+
+    def close(self):
+        (self.zip or self.tar).close()
+
+    def _add_name(self, name):
+        if name in self._names:
+            logging.warning(f"Skip duplicated member {name} of {self.path}")
+            return False
+        self._names.add(name)
+        return True
+
+    def _zip_info(self, name, mtime):
+        info = zipfile.ZipInfo(
+            name, time.localtime(max(mtime, ZIP_MIN_MTIME))[:6])
+        if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        return info
+
+    def write(self, name, data, mtime=None):
+        """Add a member of bytes data"""
+        if not self._add_name(name):
+            return
+        mtime = time.time() if mtime is None else mtime
+        if self.zip:
+            self.zip.writestr(self._zip_info(name, mtime), data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime
+            info.mode = 0o644
+            self.tar.addfile(info, io.BytesIO(data))
+
+    def write_file(self, name, path):
+        """Add a member of a file on disk"""
+        if not self._add_name(name):
+            return
+        mtime = os.path.getmtime(path)
+        if self.zip:
+            with open(path, "rb") as src, \
+                    self.zip.open(self._zip_info(name, mtime), "w") as dst:
+                shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        else:
+            self.tar.add(path, arcname=name, recursive=False)
+
+    def copy(self, reader, member):
+        """Copy an unchanged member of reader
+
+        A member of a zip archive is copied into a zip archive as it is
+        stored, without decompressing and compressing it again. Other
+        members are streamed through.
+        """
+        if not self._add_name(member.name):
+            return
+        if self.zip and reader.zip and self._copy_raw(reader, member):
+            self.copied_raw += 1
+            return
+
+        with reader.open(member) as src:
+            if self.zip:
+                with self.zip.open(self._zip_info(member.name, member.mtime),
+                                   "w") as dst:
+                    shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+            else:
+                info = tarfile.TarInfo(member.name)
+                info.size = member.size
+                info.mtime = member.mtime
+                info.mode = 0o644
+                self.tar.addfile(info, src)
+
+    def _copy_raw(self, reader, member):
+        # Compressed data is copied with a new local header, the CRC and
+        # sizes of the member stay valid. ZipFile has no public API for
+        # it, the same attributes as ZipFile.write are updated. If they are
+        # not what this expects or the copy fails, the output is rolled
+        # back and the member is streamed through instead.
+        info = member.info
+        if (info.flag_bits & ZIP_ENCRYPTED_FLAG or
+                info.compress_size >= zipfile.ZIP64_LIMIT or
+                info.file_size >= zipfile.ZIP64_LIMIT or
+                not self._can_copy_raw()):
+            return False
+
+        dst = self.zip.fp
+        offset = dst.tell()
+        try:
+            new_info = self._write_raw(reader, member, dst)
+        except (OSError, ValueError, AttributeError, struct.error) as e:
+            logging.debug(f"Failed to copy {member.name} without "
+                          f"recompressing: {str(e)}")
+            dst.seek(offset)
+            dst.truncate()
+            return False
+        if not new_info:
+            return False
+
+        self.zip.filelist.append(new_info)
+        self.zip.NameToInfo[new_info.filename] = new_info
+        self.zip.start_dir = dst.tell()
+        return True
+
+    def _can_copy_raw(self):
+        # Members are appended where the central directory starts, in a
+        # file which could be rolled back
+        try:
+            return (callable(zipfile.ZipInfo.FileHeader) and
+                    isinstance(self.zip.filelist, list) and
+                    isinstance(self.zip.NameToInfo, dict) and
+                    self.zip.fp.seekable() and
+                    self.zip.fp.tell() == self.zip.start_dir)
+        except (AttributeError, OSError):
+            return False
+
+    def _write_raw(self, reader, member, dst):
+        info = member.info
+        with open(reader.path, "rb") as src:
+            src.seek(info.header_offset)
+            header = ZIP_LOCAL_HEADER.unpack(
+                src.read(ZIP_LOCAL_HEADER.size))
+            if header[0] != ZIP_LOCAL_SIGNATURE:
+                return None
+            src.seek(header[-2] + header[-1], os.SEEK_CUR)
+
+            new_info = copy.copy(info)
+            new_info.filename = member.name
+            new_info.orig_filename = member.name
+            # Sizes are in the new local header, no data descriptor
+            new_info.flag_bits &= ~ZIP_DATA_DESCRIPTOR_FLAG
+            new_info.extra = _strip_zip64(info.extra)
+            new_info.header_offset = dst.tell()
+            new_header = new_info.FileHeader(zip64=False)
+            dst.write(new_header)
+
+            remaining = info.compress_size
+            while remaining:
+                chunk = src.read(min(COPY_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ValueError(f"Member {info.filename} of "
+                                     f"{reader.path} is truncated")
+                dst.write(chunk)
+                remaining -= len(chunk)
+
+        if dst.tell() != (new_info.header_offset + len(new_header) +
+                          info.compress_size):
+            raise ValueError(f"Member {member.name} is not fully copied")
+        return new_info
+
+
+def _strip_zip64(extra):
+    # Extra fields without zip64 sizes, the copy is written without zip64
+    fields = []
+    position = 0
+    while position + 4 <= len(extra):
+        field_id, size = struct.unpack("<HH", extra[position:position + 4])
+        if field_id != ZIP64_EXTRA_ID:
+            fields.append(extra[position:position + 4 + size])
+        position += 4 + size
+    return b"".join(fields)
@@ -0,0 +1,207 @@
+import errno
+import fnmatch
+import logging
+import os
+import re
+import shutil
+import time
+
+DEFAULT_BACKUP_PATH = ".bak"
+DEFAULT_KEEP_SNAPSHOTS = 3
+
+# Files rewritten in place by the tools, they are copied into snapshots,
+# all other files are never modified and are hardlinked
+DEFAULT_COPY_PATTERNS = ("*.md",)
+
+SNAPSHOT_NAME_FORMAT = "%Y%m%d-%H%M%S"
+SNAPSHOT_NAME_PATTERN = re.compile(r"^\d{8}-\d{6}(-\d+)?$")
+
+# ioctl to clone a file on Linux, e.g. on btrfs and xfs
+FICLONE = 0x40049409
+
+
+class _TreeCloner(object):
+    """Clone a tree with hardlinks, reflinks or copies"""
+
+    def __init__(self, copy_patterns=DEFAULT_COPY_PATTERNS):
+        self.copy_patterns = copy_patterns
+        self.reflink_supported = True
+        self.counters = {"hardlink": 0, "reflink": 0, "copy": 0}
+
+    def clone(self, src_dir, dst_dir):
+        for dir_path, dir_names, file_names in os.walk(src_dir):
+            rel_dir = os.path.relpath(dir_path, src_dir)
+            target_dir = os.path.normpath(os.path.join(dst_dir, rel_dir))
+            os.makedirs(target_dir, exist_ok=True)
+
+            for name in file_names:
+                self.clone_file(os.path.join(dir_path, name),
+                                os.path.join(target_dir, name))
+
+            # Symlinks to directories are kept as links, not followed
+            for name in list(dir_names):
+                path = os.path.join(dir_path, name)
+                if os.path.islink(path):
+                    os.symlink(os.readlink(path),
+                               os.path.join(target_dir, name))
+                    dir_names.remove(name)
+
+        logging.info(
+            "Cloned {} files with hardlinks, {} with reflinks and copied {} "
+            "files".format(self.counters["hardlink"], self.counters["reflink"],
+                           self.counters["copy"]))
+
+    def clone_file(self, src, dst):
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dst)
+            return
+
+        name = os.path.basename(src)
+        will_modify = any(fnmatch.fnmatch(name, pattern)
+                          for pattern in self.copy_patterns)
+
+        # Hardlinks share content, only for files never modified in place
+        if not will_modify:
+            try:
+                os.link(src, dst)
+                self.counters["hardlink"] += 1
+                return
+            except OSError as e:
+                logging.debug(f"Failed to hardlink {src}: {str(e)}")
+
+        # Reflinks are copy-on-write, safe for any file
+        if self.reflink_supported and self._reflink(src, dst):
+            self.counters["reflink"] += 1
+            return
+
+        shutil.copy2(src, dst)
+        self.counters["copy"] += 1
+
+    def _reflink(self, src, dst):
+        try:
+            import fcntl
+        except ImportError:
+            self.reflink_supported = False
+            return False
+
+        try:
+            with open(src, "rb") as rfile, open(dst, "wb") as wfile:
+                fcntl.ioctl(wfile.fileno(), FICLONE, rfile.fileno())
+            shutil.copystat(src, dst)
+            return True
+        except OSError as e:
+            if os.path.exists(dst):
+                os.remove(dst)
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                           errno.EXDEV, errno.ENOSYS):
+                logging.debug(f"Reflink is not supported: {str(e)}")
+                self.reflink_supported = False
+            return False
+
+
+def get_backup_path(src_dir):
+    """Return the dir keeping snapshots of src_dir"""
+    src_full_path = os.path.abspath(src_dir)
+    return src_full_path + DEFAULT_BACKUP_PATH
+
+
+def list_snapshots(src_dir):
+    """Return names of snapshots of src_dir, the oldest first"""
+    backup_path = get_backup_path(src_dir)
+    if not os.path.isdir(backup_path):
+        return []
+
+    return sorted(
+        (name for name in os.listdir(backup_path)
+         if SNAPSHOT_NAME_PATTERN.match(name) and
+         os.path.isdir(os.path.join(backup_path, name))),
+        key=_snapshot_order)
+
+
+def _snapshot_order(name):
+    # Snapshots taken in the same second are numbered, -10 is after -2
+    return name[:15], int(name[16:] or 0)
+
+
+def snapshot(src_dir, keep=DEFAULT_KEEP_SNAPSHOTS,
+             copy_patterns=DEFAULT_COPY_PATTERNS):
+    """Take a snapshot backup of src_dir
+
+    The snapshot is saved as <src_dir>.bak/<timestamp>. Files matching
+    copy_patterns are rewritten by the tools, so they are copied, with a
+    reflink if the filesystem supports it. Other files are hardlinked,
+    they take no extra disk space. Only the last keep snapshots are kept,
+    the new one always is.
+
+    Returns:
+        str: Path of the snapshot
+    """
+    src_full_path = os.path.abspath(src_dir)
+    backup_path = get_backup_path(src_dir)
+
+    name = time.strftime(SNAPSHOT_NAME_FORMAT)
+    snapshot_path = os.path.join(backup_path, name)
+    index = 1
+    while os.path.exists(snapshot_path):
+        snapshot_path = os.path.join(backup_path, "%s-%s" % (name, index))
+        index += 1
+
+    logging.info(f"Backuping {src_full_path} to {snapshot_path}...")
+    tmp_path = snapshot_path + ".tmp"
+    _TreeCloner(copy_patterns).clone(src_full_path, tmp_path)
+    # Half done snapshot never looks like a snapshot
+    os.rename(tmp_path, snapshot_path)
+    logging.info(f"Success to backup {src_full_path} to {snapshot_path}.")
+
+    rotate(src_dir, keep)
+    return snapshot_path
+
+
+def rotate(src_dir, keep=DEFAULT_KEEP_SNAPSHOTS):
+    """Remove snapshots of src_dir except the last keep ones
+
+    The latest snapshot is never removed, even if keep is less than 1.
+    """
+    backup_path = get_backup_path(src_dir)
+    snapshots = list_snapshots(src_dir)
+    for name in snapshots[:max(0, len(snapshots) - max(1, keep))]:
+        logging.info(f"Removing old snapshot {name} in {backup_path}")
+        shutil.rmtree(os.path.join(backup_path, name))
+
+
+def restore(src_dir, name=None, copy_patterns=DEFAULT_COPY_PATTERNS):
+    """Restore src_dir from a snapshot, the latest one if name is not given
+
+    The snapshot is cloned the same way it was taken, so it stays intact
+    and could be restored again.
+
+    Returns:
+        str: Path of the restored snapshot
+    """
+    snapshots = list_snapshots(src_dir)
+    if not snapshots:
+        raise ValueError(f"No snapshot of {src_dir} found")
+
+    name = name or snapshots[-1]
+    if name not in snapshots:
+        raise ValueError(f"Snapshot {name} of {src_dir} is not found")
+
+    src_full_path = os.path.abspath(src_dir)
+    snapshot_path = os.path.join(get_backup_path(src_dir), name)
+    logging.info(f"Restoring {src_full_path} from {snapshot_path}...")
+
+    tmp_path = src_full_path + ".restoring"
+    old_path = src_full_path + ".restored"
+    for path in (tmp_path, old_path):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    _TreeCloner(copy_patterns).clone(snapshot_path, tmp_path)
+    if os.path.exists(src_full_path):
+        os.rename(src_full_path, old_path)
+    os.rename(tmp_path, src_full_path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+    logging.info(f"Success to restore {src_full_path} from {snapshot_path}.")
+    return snapshot_path
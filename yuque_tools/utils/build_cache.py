@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+import threading
+
+from yuque_tools.utils import utils
+from yuque_tools.utils.manifest import file_record
+from yuque_tools.utils.manifest import is_record_current
+from yuque_tools.utils.markdown_book import scan_local_images
+
+BUILD_CACHE_NAME = ".yuque-tools-build.json"
+
+
+class BuildCache(object):
+    """Dependencies of each Word document in a converted dir, like make
+
+    Each document records the markdown files it was converted from and
+    the local images they reference, with size, mtime and content hash of
+    each. A document is up to date if it exists, is made of the same
+    markdown files and none of its dependencies changed; missing images
+    appearing later make it out of date too. Changing the tool version or
+    the options, e.g. the pandoc version, makes all documents out of date.
+    """
+
+    def __init__(self, output_dir, source_dir, options=None, force=False):
+        """Load the build cache of a converted dir
+
+        Args:
+            output_dir (str): Converted dir the documents are saved to
+            source_dir (str): Root of the markdown tree
+            options (dict, optional): Options affecting the documents
+            force (bool): Ignore the recorded documents, all documents
+                are out of date
+        """
+        self.output_dir = os.path.abspath(output_dir)
+        self.source_dir = os.path.abspath(source_dir)
+        self.path = os.path.join(self.output_dir, BUILD_CACHE_NAME)
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+        data = self._load()
+        self._data = {
+            "version": utils.get_version(),
+            "options": options or {},
+            "outputs": {}
+        }
+        # Records of other options are only used to remove stale outputs
+        self._old_outputs = data.get("outputs", {})
+        if force:
+            logging.info("Ignoring build cache, converting all documents")
+        elif (data.get("version") == self._data["version"] and
+                data.get("options") == self._data["options"]):
+            self._data["outputs"] = self._old_outputs
+        elif data:
+            logging.info("Version or options changed, converting all "
+                         "documents")
+        self._outputs = self._data["outputs"]
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError as e:
+            logging.warning(f"Ignore broken build cache {self.path}: "
+                            f"{str(e)}")
+            return {}
+
+    def _output_key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.output_dir)
+
+    def _source_key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.source_dir)
+
+    def _source_path(self, key):
+        return os.path.normpath(os.path.join(self.source_dir, key))
+
+    def is_up_to_date(self, output_file, md_files):
+        """Return True if output_file need not be converted again
+
+        Args:
+            output_file (str): Path of the Word document
+            md_files (list): Markdown files it is converted from
+        """
+        record = self._outputs.get(self._output_key(output_file))
+        if not record or not os.path.exists(output_file):
+            return False
+        if set(record["sources"]) != {self._source_key(md_file)
+                                      for md_file in md_files}:
+            return False
+
+        for key, file in record["sources"].items():
+            if not is_record_current(self._source_path(key), file):
+                return False
+        for key, image in record["images"].items():
+            path = self._source_path(key)
+            if image is None:
+                if os.path.exists(path):
+                    return False
+            elif not is_record_current(path, image):
+                return False
+        return True
+
+    def filter_outdated(self, conversions):
+        """Yield conversions whose documents are out of date
+
+        Args:
+            conversions (iterable): Tuples with Word document and the list
+                of its markdown files as the last two items
+        """
+        for conversion in conversions:
+            output_file, md_files = conversion[-2:]
+            if self.is_up_to_date(output_file, md_files):
+                logging.debug(f"Skip up to date {output_file}")
+                self.skipped += 1
+                continue
+            yield conversion
+
+    def dependencies(self, md_files):
+        """Return dependencies of a document to be converted
+
+        They should be taken before converting, a file changed while
+        converting is seen as changed by the next run.
+        """
+        sources = {}
+        images = {}
+        for md_file in md_files:
+            sources[self._source_key(md_file)] = file_record(md_file)
+            with open(md_file, "r", encoding="utf-8") as f:
+                text = f.read()
+            for path in scan_local_images(text, os.path.dirname(md_file)):
+                key = self._source_key(path)
+                if key not in images:
+                    images[key] = file_record(path) \
+                        if os.path.isfile(path) else None
+        return {"sources": sources, "images": images}
+
+    def update(self, output_file, dependencies):
+        """Record output_file converted with dependencies"""
+        with self._lock:
+            self._outputs[self._output_key(output_file)] = dependencies
+
+    def remove_stale(self, output_files):
+        """Remove recorded documents whose markdown files are all deleted
+
+        Documents in output_files are planned by this run. Other documents
+        with any markdown file left are kept, they might be excluded from
+        this run only.
+
+        Returns:
+            int: Number of documents removed
+        """
+        planned = {self._output_key(path) for path in output_files}
+        removed = 0
+        for key, record in list(self._old_outputs.items()):
+            if key in planned or any(
+                    os.path.exists(self._source_path(source))
+                    for source in record["sources"]):
+                continue
+
+            path = os.path.join(self.output_dir, key)
+            if os.path.exists(path):
+                os.remove(path)
+                logging.info(f"Removed {path}, its markdown files are "
+                             f"deleted")
+                removed += 1
+                self._remove_empty_dirs(os.path.dirname(path))
+            self._outputs.pop(key, None)
+        return removed
+
+    def _remove_empty_dirs(self, path):
+        while path != self.output_dir and path.startswith(self.output_dir):
+            try:
+                os.rmdir(path)
+            except OSError:
+                # Not empty
+                return
+            path = os.path.dirname(path)
+
+    def save(self):
+        """Write the build cache to disk, replacing the old one at once"""
+        with self._lock, \
+                utils.atomic_open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self._data, f, ensure_ascii=False, indent=2)
+        logging.debug(f"Saved build cache {self.path}")
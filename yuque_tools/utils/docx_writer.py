@@ -0,0 +1,864 @@
+import base64
+import collections
+import html
+import io
+import os
+import re
+import urllib.parse
+import zipfile
+
+# Bumped when documents written change, so cached documents are rebuilt
+VERSION = 1
+
+# Images are sized like pandoc does: at 72 DPI if they have no DPI, and
+# scaled down to the text width of its default page
+MAX_IMAGE_WIDTH = 5334000
+DEFAULT_DPI = 72
+EMUS_PER_INCH = 914400
+TEXT_WIDTH_TWIPS = 7920
+
+IMAGE_CONTENT_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".bmp": "image/bmp",
+}
+DATA_URI_EXTENSIONS = {
+    content_type: extension
+    for extension, content_type in IMAGE_CONTENT_TYPES.items()
+    if extension != ".jpeg"}
+BULLETS = ("\u2022", "\u25e6", "\u25aa")
+LIST_LEVELS = 9
+
+FENCE = re.compile(r"^( {0,3})(`{3,}|~{3,})\s*([^`\s{]*)[^`]*$")
+ATX_HEADING = re.compile(
+    r"^ {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$")
+SETEXT_UNDERLINE = re.compile(r"^ {0,3}(=+|-+)[ \t]*$")
+RULE = re.compile(r"^ {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$")
+LIST_ITEM = re.compile(r"^( *)([-*+]|\d{1,9}[.)])(?:[ \t]+(.*))?$")
+TASK = re.compile(r"^\[([ xX])\][ \t]+")
+TABLE_DELIMITER = re.compile(
+    r"^ {0,3}\|?[ \t]*:?-+:?[ \t]*(?:\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$")
+QUOTE = re.compile(r"^ {0,3}> ?(.*)$")
+HTML_BLOCK = re.compile(r"^ {0,3}<(?:[A-Za-z][A-Za-z0-9-]*|/[A-Za-z]|!--|\?)")
+REFERENCE = re.compile(r"^ {0,3}\[[^\]]+\]:")
+SIMPLE_TABLE = re.compile(r"^ *-{3,}(?: +-{3,})+ *$")
+
+INLINE = re.compile(r"""
+    (?P<hardbreak>(?:\\|[ ]{2,})\n)
+  | (?P<softbreak>[ \t]*\n)
+  | (?P<escape>\\(?P<escaped>[!"#$%&'()*+,\-./:;<=>?@\[\\\]^_`{|}~ ]))
+  | (?P<code>(?P<ticks>`+)[ ]?(?P<code_text>.+?)[ ]?(?<!`)(?P=ticks)(?!`))
+  | (?P<image>!\[(?P<image_alt>(?:[^\[\]\\]|\\.)*)\]
+        \([ ]*<?(?P<image_src>[^()\s>]*)>?(?:[ ]+"[^"]*")?[ ]*\))
+  | (?P<link>\[(?P<link_text>(?:[^\[\]\\]|\\.|\[(?:[^\[\]\\]|\\.)*\])*)\]
+        \([ ]*<?(?P<link_url>[^()\s>]*)>?(?:[ ]+"[^"]*")?[ ]*\))
+  | (?P<autolink><(?P<autolink_url>(?:https?|ftp|mailto):[^<>\s]+)>)
+  | (?P<html><[A-Za-z/!?])
+  | (?P<footnote>\[\^)
+  | (?P<math>\$(?=[^\s$])(?:[^$\\\n]|\\.)+?(?<=\S)\$(?!\d))
+  | (?P<tex>\\[A-Za-z]+)
+  | (?P<strong_emph>\*\*\*(?![\s*])(?P<strong_emph_text>[^*]+?)(?<!\s)\*\*\*)
+  | (?P<strong>\*\*(?![\s*])(?P<strong_text>(?:[^*]|\*[^*]+\*)+?)(?<!\s)\*\*
+      | (?<![A-Za-z0-9])__(?![\s_])(?P<strong_text2>.+?)(?<!\s)__
+        (?![A-Za-z0-9]))
+  | (?P<emph>\*(?![\s*])(?P<emph_text>(?:[^*]|\*\*[^*]+\*\*)+?)(?<![\s*])\*
+      | (?<![A-Za-z0-9])_(?![\s_])(?P<emph_text2>.+?)(?<![\s_])_
+        (?![A-Za-z0-9]))
+  | (?P<strike>~~(?=\S)(?P<strike_text>.+?)(?<=\S)~~)
+  | (?P<sub>~(?P<sub_text>[^~\s]+)~)
+  | (?P<sup>\^(?P<sup_text>[^^\s]+)\^)
+""", re.VERBOSE | re.DOTALL)
+ENTITY = re.compile(r"&(?:#[0-9]+|#[xX][0-9a-fA-F]+|[A-Za-z][A-Za-z0-9]*);")
+# Characters which are not allowed in XML 1.0
+INVALID_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+Heading = collections.namedtuple("Heading", ["level", "inlines"])
+Paragraph = collections.namedtuple("Paragraph", ["inlines", "style"])
+Figure = collections.namedtuple("Figure", ["image", "caption"])
+CodeBlock = collections.namedtuple("CodeBlock", ["lines"])
+Rule = collections.namedtuple("Rule", [])
+Quote = collections.namedtuple("Quote", ["paragraphs"])
+Table = collections.namedtuple("Table", ["aligns", "header", "rows"])
+ListBlock = collections.namedtuple("ListBlock", ["items", "loose"])
+# Paragraphs of an item, the first one is numbered
+ListItem = collections.namedtuple(
+    "ListItem", ["level", "ordered", "marker", "paragraphs"])
+
+Text = collections.namedtuple("Text", ["text", "style"])
+Break = collections.namedtuple("Break", [])
+Link = collections.namedtuple("Link", ["url", "inlines"])
+# Images embedded as data URIs have their bytes in data, only the extension
+# of their path is used
+Image = collections.namedtuple(
+    "Image", ["path", "alt", "src", "width", "height", "data"],
+    defaults=(None,))
+
+
+class UnsupportedMarkdown(ValueError):
+    """Markdown uses syntax the native writer does not support"""
+
+
+def write_docx(text, output, resource_path=None):
+    """Convert markdown text to a Word document without pandoc
+
+    Only the markdown Yuque exports is supported: headings, paragraphs,
+    emphasis, links, images, lists, pipe tables, block quotes, code blocks
+    and rules, with the semantics of pandoc markdown. Images are local
+    files or base64 data URIs, like those of documents read from archives.
+    The whole document is checked before anything is written.
+
+    Args:
+        text (str): Markdown text
+        output: Path or binary file object the document is written to
+        resource_path (str, optional): Dir relative image paths are
+            resolved against, current dir if not provided
+
+    Raises:
+        UnsupportedMarkdown: If text uses syntax which is not supported,
+            e.g. raw HTML, footnotes, math or remote images
+    """
+    blocks = MarkdownParser(resource_path).parse(text)
+    DocxBuilder(blocks).write(output)
+
+
+class MarkdownParser(object):
+    """Parse the markdown subset into blocks of inline nodes"""
+
+    def __init__(self, resource_path=None):
+        self.resource_path = resource_path or os.getcwd()
+        self._image_sizes = {}
+
+    def parse(self, text):
+        text = INVALID_XML.sub("", text)
+        lines = text.replace("\r\n", "\n").replace("\r", "\n").expandtabs(
+            4).split("\n")
+        if lines and lines[0].rstrip() == "---" and any(
+                line.rstrip() in ("---", "...") for line in lines[1:]):
+            raise UnsupportedMarkdown("YAML metadata block")
+        return self._parse_blocks(lines)
+
+    def _parse_blocks(self, lines):
+        blocks = []
+        i = 0
+        after_heading = True
+        while i < len(lines):
+            line = lines[i]
+            if not line.strip():
+                i += 1
+                continue
+
+            block, i = self._parse_block(lines, i, after_heading)
+            after_heading = isinstance(block, Heading)
+            blocks.append(block)
+        return blocks
+
+    def _parse_block(self, lines, i, after_heading):
+        line = lines[i]
+        if FENCE.match(line):
+            return self._parse_code(lines, i)
+
+        match = ATX_HEADING.match(line)
+        if match:
+            level = len(match.group(1))
+            text = match.group(2) or ""
+            if re.search(r"\{[#.][^}]*\}\s*$", text):
+                raise UnsupportedMarkdown("heading attributes")
+            return Heading(level, self._parse_inlines(text)), i + 1
+
+        if RULE.match(line):
+            return Rule(), i + 1
+        if LIST_ITEM.match(line):
+            return self._parse_list(lines, i)
+        if ("|" in line and i + 1 < len(lines) and "|" in lines[i + 1] and
+                TABLE_DELIMITER.match(lines[i + 1])):
+            return self._parse_table(lines, i)
+        if QUOTE.match(line):
+            return self._parse_quote(lines, i)
+
+        if HTML_BLOCK.match(line):
+            raise UnsupportedMarkdown("raw HTML block")
+        if REFERENCE.match(line):
+            raise UnsupportedMarkdown("reference or footnote definition")
+        if line.startswith("    "):
+            raise UnsupportedMarkdown("indented code block")
+        if line.lstrip().startswith("|"):
+            raise UnsupportedMarkdown("line block")
+        if line.strip().startswith("$$"):
+            raise UnsupportedMarkdown("display math")
+        if SIMPLE_TABLE.match(line):
+            raise UnsupportedMarkdown("simple or multiline table")
+
+        return self._parse_paragraph(lines, i, after_heading)
+
+    def _parse_code(self, lines, i):
+        match = FENCE.match(lines[i])
+        indent = len(match.group(1))
+        fence = match.group(2)
+        code = []
+        i += 1
+        while i < len(lines):
+            line = lines[i]
+            stripped = line.strip()
+            if (stripped.startswith(fence[0] * len(fence)) and
+                    not stripped.strip(fence[0])):
+                i += 1
+                break
+            # Indentation of the fence is removed from the lines
+            code.append(line[min(indent, len(line) - len(line.lstrip())):])
+            i += 1
+        return CodeBlock(code), i
+
+    def _parse_paragraph(self, lines, i, after_heading):
+        # Only a fenced code block interrupts a paragraph, lists, headings,
+        # tables and quotes need a blank line before them
+        start = i
+        while (i < len(lines) and lines[i].strip() and
+               not FENCE.match(lines[i])):
+            i += 1
+        paragraph = lines[start:i]
+
+        if len(paragraph) > 1 and SETEXT_UNDERLINE.match(paragraph[1]):
+            if len(paragraph) > 2:
+                raise UnsupportedMarkdown("text after setext heading")
+            level = 1 if paragraph[1].strip()[0] == "=" else 2
+            return Heading(level, self._parse_inlines(paragraph[0])), i
+        if any(SETEXT_UNDERLINE.match(line) for line in paragraph[2:]):
+            raise UnsupportedMarkdown("setext heading in paragraph")
+
+        inlines = self._parse_inlines("\n".join(
+            line.lstrip() for line in paragraph).rstrip())
+        # Image alone in a paragraph is a figure captioned by its alt text
+        if (len(inlines) == 1 and isinstance(inlines[0], Image) and
+                inlines[0].alt):
+            return Figure(inlines[0], self._parse_inlines(
+                inlines[0].alt)), i
+        style = "FirstParagraph" if after_heading else "BodyText"
+        return Paragraph(inlines, style), i
+
+    def _parse_list(self, lines, i):
+        items = []
+        # (marker indent, content indent) of each nesting level
+        levels = []
+        loose = False
+        kind = _list_kind(LIST_ITEM.match(lines[i]).group(2))
+
+        while i < len(lines):
+            line = lines[i]
+            if not line.strip():
+                j = i
+                while j < len(lines) and not lines[j].strip():
+                    j += 1
+                if j == len(lines):
+                    break
+
+                match = LIST_ITEM.match(lines[j])
+                indent = len(lines[j]) - len(lines[j].lstrip())
+                if match and (indent > 0 or
+                              _list_kind(match.group(2)) == kind):
+                    loose = True
+                    i = j
+                    continue
+                if not match and indent >= levels[0][1]:
+                    if FENCE.match(lines[j]) or lines[j].strip()[0] in "|>#":
+                        raise UnsupportedMarkdown("block in list item")
+                    # Indented paragraph continues the item
+                    loose = True
+                    items[-1].paragraphs.append([])
+                    i = j
+                    continue
+                break
+
+            match = LIST_ITEM.match(line)
+            if not match:
+                if FENCE.match(line):
+                    raise UnsupportedMarkdown("code block in list item")
+                # Lazy continuation of the last paragraph of the item
+                items[-1].paragraphs[-1].append(line.strip())
+                i += 1
+                continue
+
+            indent = len(match.group(1))
+            marker = match.group(2)
+            content = match.group(3) or ""
+            if not levels or indent >= levels[-1][1]:
+                levels.append((indent, indent + len(marker) + 1))
+            else:
+                while len(levels) > 1 and indent < levels[-1][0]:
+                    levels.pop()
+            level = len(levels) - 1
+            if level >= LIST_LEVELS:
+                raise UnsupportedMarkdown("list nested too deep")
+            if level == 0 and _list_kind(marker) != kind:
+                # Another kind of list starts
+                break
+
+            task = TASK.match(content)
+            if task:
+                content = ("\u2612 " if task.group(1) != " " else
+                           "\u2610 ") + content[task.end():]
+            items.append(ListItem(level, marker[0].isdigit(), marker,
+                                  [[content]]))
+            i += 1
+
+        items = [item._replace(paragraphs=[
+            self._parse_inlines("\n".join(paragraph).rstrip())
+            for paragraph in item.paragraphs]) for item in items]
+        return ListBlock(items, loose), i
+
+    def _parse_table(self, lines, i):
+        header = _split_row(lines[i])
+        aligns = []
+        for cell in _split_row(lines[i + 1]):
+            if cell.startswith(":") and cell.endswith(":"):
+                aligns.append("center")
+            elif cell.endswith(":"):
+                aligns.append("right")
+            else:
+                aligns.append("left")
+        if len(aligns) != len(header):
+            raise UnsupportedMarkdown("table header and delimiter differ")
+
+        rows = []
+        i += 2
+        while i < len(lines) and lines[i].strip() and "|" in lines[i]:
+            row = _split_row(lines[i])
+            row = (row + [""] * len(header))[:len(header)]
+            rows.append([self._parse_inlines(cell) for cell in row])
+            i += 1
+        header = [self._parse_inlines(cell) for cell in header]
+        return Table(aligns, header, rows), i
+
+    def _parse_quote(self, lines, i):
+        quoted = []
+        while i < len(lines) and lines[i].strip():
+            match = QUOTE.match(lines[i])
+            quoted.append(match.group(1) if match else lines[i])
+            i += 1
+
+        blocks = self._parse_blocks(quoted)
+        if not all(isinstance(block, Paragraph) for block in blocks):
+            raise UnsupportedMarkdown("block in block quote")
+        return Quote([block.inlines for block in blocks]), i
+
+    def _parse_inlines(self, text, style=frozenset()):
+        nodes = []
+        position = 0
+        for match in INLINE.finditer(text):
+            if match.start() > position:
+                nodes.append(Text(_smart(text[position:match.start()]),
+                                  style))
+            position = match.end()
+            # Name of the outermost group, the alternative matched
+            kind = match.lastgroup
+
+            if kind == "hardbreak":
+                nodes.append(Break())
+            elif kind == "softbreak":
+                nodes.append(Text(" ", style))
+            elif kind == "escape":
+                escaped = match.group("escaped")
+                nodes.append(Text("\u00a0" if escaped == " " else escaped,
+                                  style))
+            elif kind == "code":
+                nodes.append(Text(match.group("code_text").replace("\n", " "),
+                                  style | {"code"}))
+            elif kind == "image":
+                nodes.append(self._image(match.group("image_src"),
+                                         _unescape(match.group("image_alt"))))
+            elif kind == "link":
+                nodes.append(Link(
+                    self._link_url(match.group("link_url")),
+                    self._parse_inlines(match.group("link_text"), style)))
+            elif kind == "autolink":
+                url = match.group("autolink_url")
+                label = url[len("mailto:"):] if url.startswith("mailto:") \
+                    else url
+                nodes.append(Link(url, [Text(label, style)]))
+            elif kind == "html":
+                raise UnsupportedMarkdown("raw HTML")
+            elif kind == "footnote":
+                raise UnsupportedMarkdown("footnote")
+            elif kind == "math":
+                raise UnsupportedMarkdown("TeX math")
+            elif kind == "tex":
+                raise UnsupportedMarkdown("raw TeX")
+            elif kind == "strong_emph":
+                nodes.extend(self._parse_inlines(
+                    match.group("strong_emph_text"),
+                    style | {"strong", "emph"}))
+            elif kind == "strong":
+                inner = match.group("strong_text") or \
+                    match.group("strong_text2")
+                nodes.extend(self._parse_inlines(inner, style | {"strong"}))
+            elif kind == "emph":
+                inner = match.group("emph_text") or match.group("emph_text2")
+                nodes.extend(self._parse_inlines(inner, style | {"emph"}))
+            elif kind == "strike":
+                nodes.extend(self._parse_inlines(
+                    match.group("strike_text"), style | {"strike"}))
+            elif kind == "sub":
+                nodes.extend(self._parse_inlines(
+                    match.group("sub_text"), style | {"sub"}))
+            elif kind == "sup":
+                nodes.extend(self._parse_inlines(
+                    match.group("sup_text"), style | {"sup"}))
+
+        if position < len(text):
+            nodes.append(Text(_smart(text[position:]), style))
+        return nodes
+
+    def _link_url(self, url):
+        if url.startswith("#"):
+            raise UnsupportedMarkdown("internal link")
+        return _unescape(url)
+
+    def _image(self, src, alt):
+        if src.startswith("data:"):
+            return self._data_image(src, alt)
+
+        parsed = urllib.parse.urlsplit(src)
+        if parsed.scheme or parsed.netloc:
+            raise UnsupportedMarkdown(f"remote image {src}")
+
+        path = os.path.join(self.resource_path,
+                            urllib.parse.unquote(parsed.path))
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in IMAGE_CONTENT_TYPES:
+            raise UnsupportedMarkdown(f"image format of {src}")
+        if not os.path.isfile(path):
+            raise UnsupportedMarkdown(f"missing image {src}")
+
+        if path not in self._image_sizes:
+            self._image_sizes[path] = self._image_size(path, src)
+        width, height = self._image_sizes[path]
+        return Image(path, alt, src, width, height)
+
+    def _data_image(self, src, alt):
+        header, _, encoded = src.partition(",")
+        extension = DATA_URI_EXTENSIONS.get(
+            header[len("data:"):].split(";")[0].lower())
+        if not extension or not header.endswith(";base64"):
+            raise UnsupportedMarkdown(f"image format of {header}")
+        try:
+            data = base64.b64decode(encoded, validate=True)
+        except ValueError:
+            raise UnsupportedMarkdown(f"invalid data URI of {header}")
+
+        if src not in self._image_sizes:
+            self._image_sizes[src] = self._image_size(io.BytesIO(data), header)
+        width, height = self._image_sizes[src]
+        # The data is not repeated in the description of the picture
+        return Image("embedded" + extension, alt, "", width, height, data)
+
+    def _image_size(self, source, src):
+        # Images which failed to convert are saved as downloaded, they might
+        # not be images at all, pandoc decides what to do with them
+        try:
+            return _image_size(source)
+        except (OSError, ValueError):
+            raise UnsupportedMarkdown(f"unreadable image {src}")
+
+
+def _list_kind(marker):
+    # Lists of another delimiter are separate lists, like in pandoc
+    return marker[-1] if marker[0].isdigit() else "bullet"
+
+
+def _split_row(line):
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|") and not line.endswith("\\|"):
+        line = line[:-1]
+    return [cell.strip().replace("\\|", "|")
+            for cell in re.split(r"(?<!\\)\|", line)]
+
+
+def _quoteattr(value):
+    # Like xml.sax.saxutils.quoteattr, which imports urllib.request
+    return '"%s"' % html.escape(value, quote=True)
+
+
+def _unescape(text):
+    return re.sub(r"\\([^A-Za-z0-9\s])", r"\1", text)
+
+
+def _smart(text):
+    """Convert quotes, dashes and ellipses like pandoc's smart extension"""
+    text = ENTITY.sub(lambda match: html.unescape(match.group(0)), text)
+    text = text.replace("---", "\u2014").replace("--", "\u2013")
+    text = text.replace("...", "\u2026")
+    text = re.sub(r"(^|(?<=[\s(\[{]))\"(?=\S)", "\u201c", text)
+    text = text.replace("\"", "\u201d")
+    text = re.sub(r"(^|(?<=[\s(\[{]))'(?=\S)", "\u2018", text)
+    return text.replace("'", "\u2019")
+
+
+def _image_size(source):
+    """Return width and height in EMUs of an image path or file object"""
+    from PIL import Image as PILImage
+
+    with PILImage.open(source) as image:
+        width, height = image.size
+        dpi = image.info.get("dpi") or (DEFAULT_DPI, DEFAULT_DPI)
+
+    width = int(width * EMUS_PER_INCH / (dpi[0] or DEFAULT_DPI))
+    height = int(height * EMUS_PER_INCH / (dpi[1] or DEFAULT_DPI))
+    if width > MAX_IMAGE_WIDTH:
+        height = int(height * MAX_IMAGE_WIDTH / width)
+        width = MAX_IMAGE_WIDTH
+    return width, height
+
+
+class DocxBuilder(object):
+    """Write parsed blocks into a docx package
+
+    The document XML is streamed into the zip entry while blocks are
+    rendered, images and relationships are added after it.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self._relationships = []
+        self._images = {}
+        self._lists = []
+        self._drawings = 0
+
+    def write(self, output):
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as package:
+            package.writestr("[Content_Types].xml", CONTENT_TYPES)
+            package.writestr("_rels/.rels", PACKAGE_RELATIONSHIPS)
+            package.writestr("word/styles.xml", STYLES)
+
+            with package.open("word/document.xml", "w") as raw:
+                stream = io.TextIOWrapper(raw, encoding="utf-8")
+                self._write_document(stream)
+                stream.flush()
+                stream.detach()
+
+            for name, _, image in self._images.values():
+                if image.data is not None:
+                    package.writestr("word/media/" + name, image.data)
+                else:
+                    package.write(image.path, "word/media/" + name)
+            package.writestr("word/numbering.xml", self._numbering())
+            package.writestr("word/_rels/document.xml.rels",
+                             self._document_relationships())
+
+    def _relationship(self, kind, target, external=False):
+        relationship_id = f"rId{len(self._relationships) + 3}"
+        self._relationships.append((relationship_id, kind, target, external))
+        return relationship_id
+
+    def _write_document(self, stream):
+        stream.write(DOCUMENT_START)
+        for block in self.blocks:
+            stream.write(self._block(block))
+        stream.write(DOCUMENT_END)
+
+    def _block(self, block):
+        if isinstance(block, Heading):
+            return _paragraph(f"Heading{block.level}",
+                              self._inlines(block.inlines))
+        if isinstance(block, Paragraph):
+            return _paragraph(block.style, self._inlines(block.inlines))
+        if isinstance(block, Figure):
+            return (_paragraph("CaptionedFigure", self._image(block.image)) +
+                    _paragraph("ImageCaption", self._inlines(block.caption)))
+        if isinstance(block, CodeBlock):
+            runs = "<w:r><w:br/></w:r>".join(
+                _run(line, {"code"}) for line in block.lines)
+            return _paragraph("SourceCode", runs)
+        if isinstance(block, Rule):
+            return ('<w:p><w:pPr><w:pBdr><w:bottom w:val="single" w:sz="6" '
+                    'w:space="1" w:color="auto"/></w:pBdr></w:pPr></w:p>')
+        if isinstance(block, Quote):
+            return "".join(_paragraph("BlockText", self._inlines(inlines))
+                           for inlines in block.paragraphs)
+        if isinstance(block, Table):
+            return self._table(block)
+        if isinstance(block, ListBlock):
+            return self._list(block)
+        raise TypeError(f"Unknown block {block!r}")
+
+    def _list(self, block):
+        self._lists.append(block)
+        num_id = len(self._lists)
+        style = "BodyText" if block.loose else "Compact"
+        parts = []
+        for item in block.items:
+            for index, inlines in enumerate(item.paragraphs):
+                if index:
+                    properties = (f'<w:ind w:left="{720 * (item.level + 1)}"'
+                                  f'/>')
+                else:
+                    properties = (f'<w:numPr><w:ilvl w:val="{item.level}"/>'
+                                  f'<w:numId w:val="{num_id}"/></w:numPr>')
+                parts.append(_paragraph(style, self._inlines(inlines),
+                                        properties))
+        return "".join(parts)
+
+    def _table(self, table):
+        columns = len(table.header)
+        width = TEXT_WIDTH_TWIPS // max(1, columns)
+        parts = ['<w:tbl><w:tblPr><w:tblStyle w:val="Table"/>'
+                 '<w:tblW w:type="auto" w:w="0"/><w:tblLook w:firstRow="1" '
+                 'w:lastRow="0" w:firstColumn="0" w:lastColumn="0" '
+                 'w:noHBand="0" w:noVBand="0" w:val="0020"/></w:tblPr>'
+                 '<w:tblGrid>']
+        parts.append(f'<w:gridCol w:w="{width}"/>' * columns)
+        parts.append('</w:tblGrid>')
+        for index, row in enumerate([table.header] + table.rows):
+            parts.append('<w:tr>')
+            if not index:
+                parts.append('<w:trPr><w:tblHeader w:val="on"/></w:trPr>')
+            for align, cell in zip(table.aligns, row):
+                properties = (f'<w:jc w:val="{align}"/>'
+                              if align != "left" else "")
+                parts.append('<w:tc><w:tcPr/>' + _paragraph(
+                    "Compact", self._inlines(cell), properties) + '</w:tc>')
+            parts.append('</w:tr>')
+        parts.append('</w:tbl>')
+        return "".join(parts)
+
+    def _inlines(self, inlines):
+        parts = []
+        for node in inlines:
+            if isinstance(node, Text):
+                parts.append(_run(node.text, node.style))
+            elif isinstance(node, Break):
+                parts.append("<w:r><w:br/></w:r>")
+            elif isinstance(node, Link):
+                relationship_id = self._relationship(
+                    "hyperlink", node.url, external=True)
+                runs = "".join(
+                    _run(child.text, child.style | {"link"})
+                    if isinstance(child, Text) else self._inlines([child])
+                    for child in node.inlines)
+                parts.append(f'<w:hyperlink r:id="{relationship_id}">'
+                             f'{runs}</w:hyperlink>')
+            elif isinstance(node, Image):
+                parts.append(self._image(node))
+        return "".join(parts)
+
+    def _image(self, image):
+        # Each file or embedded image is stored once
+        key = image.path if image.data is None else image.data
+        if key not in self._images:
+            name = (f"image{len(self._images) + 1}"
+                    f"{os.path.splitext(image.path)[1].lower()}")
+            self._images[key] = (
+                name, self._relationship("image", "media/" + name), image)
+        _, relationship_id, _ = self._images[key]
+
+        self._drawings += 1
+        drawing_id = self._drawings
+        alt = _quoteattr(image.alt)
+        src = _quoteattr(image.src)
+        return (
+            f'<w:r><w:drawing><wp:inline>'
+            f'<wp:extent cx="{image.width}" cy="{image.height}"/>'
+            f'<wp:effectExtent b="0" l="0" r="0" t="0"/>'
+            f'<wp:docPr descr={alt} id="{drawing_id}" name="Picture"/>'
+            f'<a:graphic><a:graphicData uri="http://schemas.openxmlformats'
+            f'.org/drawingml/2006/picture"><pic:pic><pic:nvPicPr>'
+            f'<pic:cNvPr descr={src} id="{drawing_id}" name="Picture"/>'
+            f'<pic:cNvPicPr><a:picLocks noChangeArrowheads="1" '
+            f'noChangeAspect="1"/></pic:cNvPicPr></pic:nvPicPr>'
+            f'<pic:blipFill><a:blip r:embed="{relationship_id}"/>'
+            f'<a:stretch><a:fillRect/></a:stretch></pic:blipFill>'
+            f'<pic:spPr bwMode="auto"><a:xfrm><a:off x="0" y="0"/>'
+            f'<a:ext cx="{image.width}" cy="{image.height}"/></a:xfrm>'
+            f'<a:prstGeom prst="rect"><a:avLst/></a:prstGeom><a:noFill/>'
+            f'</pic:spPr></pic:pic></a:graphicData></a:graphic>'
+            f'</wp:inline></w:drawing></w:r>')
+
+    def _numbering(self):
+        abstracts = []
+        nums = []
+        for num_id, block in enumerate(self._lists, 1):
+            formats = {}
+            for item in block.items:
+                formats.setdefault(item.level, item)
+
+            levels = []
+            for level in range(LIST_LEVELS):
+                item = formats.get(level)
+                indent = (f'<w:pPr><w:ind w:left="{720 * (level + 1)}" '
+                          f'w:hanging="360"/></w:pPr>')
+                if item and item.ordered:
+                    start = int(item.marker[:-1])
+                    levels.append(
+                        f'<w:lvl w:ilvl="{level}"><w:start w:val="{start}"/>'
+                        f'<w:numFmt w:val="decimal"/><w:lvlText '
+                        f'w:val="%{level + 1}{item.marker[-1]}"/>'
+                        f'<w:lvlJc w:val="left"/>{indent}</w:lvl>')
+                else:
+                    bullet = BULLETS[level % len(BULLETS)]
+                    levels.append(
+                        f'<w:lvl w:ilvl="{level}"><w:numFmt w:val="bullet"/>'
+                        f'<w:lvlText w:val="{bullet}"/><w:lvlJc '
+                        f'w:val="left"/>{indent}</w:lvl>')
+            abstracts.append(
+                f'<w:abstractNum w:abstractNumId="{num_id}">'
+                f'<w:multiLevelType w:val="multilevel"/>{"".join(levels)}'
+                f'</w:abstractNum>')
+            nums.append(f'<w:num w:numId="{num_id}"><w:abstractNumId '
+                        f'w:val="{num_id}"/></w:num>')
+        return (XML_DECLARATION + f'<w:numbering {W_NAMESPACE}>' +
+                "".join(abstracts) + "".join(nums) + '</w:numbering>')
+
+    def _document_relationships(self):
+        base = "http://schemas.openxmlformats.org/officeDocument/2006/" \
+            "relationships/"
+        relationships = [
+            ("rId1", "styles", "styles.xml", False),
+            ("rId2", "numbering", "numbering.xml", False),
+        ] + self._relationships
+        parts = [XML_DECLARATION, '<Relationships xmlns="http://schemas.'
+                 'openxmlformats.org/package/2006/relationships">']
+        for relationship_id, kind, target, external in relationships:
+            mode = ' TargetMode="External"' if external else ""
+            parts.append(f'<Relationship Id="{relationship_id}" '
+                         f'Type="{base}{kind}" Target={_quoteattr(target)}'
+                         f'{mode}/>')
+        parts.append('</Relationships>')
+        return "".join(parts)
+
+
+def _paragraph(style, content, properties=""):
+    return (f'<w:p><w:pPr><w:pStyle w:val="{style}"/>{properties}</w:pPr>'
+            f'{content}</w:p>')
+
+
+RUN_PROPERTIES = (
+    ("code", '<w:rStyle w:val="VerbatimChar"/>'),
+    ("link", '<w:rStyle w:val="Hyperlink"/>'),
+    ("strong", '<w:b/><w:bCs/>'),
+    ("emph", '<w:i/><w:iCs/>'),
+    ("strike", '<w:strike/>'),
+    ("sub", '<w:vertAlign w:val="subscript"/>'),
+    ("sup", '<w:vertAlign w:val="superscript"/>'),
+)
+
+
+def _run(text, style):
+    properties = "".join(xml for name, xml in RUN_PROPERTIES
+                         if name in style)
+    if properties:
+        properties = f"<w:rPr>{properties}</w:rPr>"
+    # Tabs are elements of their own
+    content = "<w:tab/>".join(
+        f'<w:t xml:space="preserve">{html.escape(part, quote=False)}</w:t>'
+        if part else "" for part in text.split("\t"))
+    return f"<w:r>{properties}{content}</w:r>"
+
+
+XML_DECLARATION = \
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+W_NAMESPACE = \
+    'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"'
+
+CONTENT_TYPES = XML_DECLARATION + (
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/'
+    'content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-'
+    'package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>' +
+    "".join(f'<Default Extension="{extension[1:]}" '
+            f'ContentType="{content_type}"/>'
+            for extension, content_type in IMAGE_CONTENT_TYPES.items()) +
+    '<Override PartName="/word/document.xml" ContentType="application/'
+    'vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '<Override PartName="/word/styles.xml" ContentType="application/'
+    'vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+    '<Override PartName="/word/numbering.xml" ContentType="application/'
+    'vnd.openxmlformats-officedocument.wordprocessingml.numbering+xml"/>'
+    '</Types>')
+
+PACKAGE_RELATIONSHIPS = XML_DECLARATION + (
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/'
+    'relationships"><Relationship Id="rId1" Type="http://schemas.'
+    'openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/></Relationships>')
+
+DOCUMENT_START = XML_DECLARATION + (
+    f'<w:document {W_NAMESPACE} '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/'
+    'relationships" '
+    'xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/'
+    'wordprocessingDrawing" '
+    'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+    'xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture">'
+    '<w:body>')
+DOCUMENT_END = '<w:sectPr/></w:body></w:document>'
+
+
+def _style(style_id, name, kind="paragraph", based_on=None, properties="",
+           run_properties="", extra=""):
+    based = f'<w:basedOn w:val="{based_on}"/>' if based_on else ""
+    paragraph = f'<w:pPr>{properties}</w:pPr>' if properties else ""
+    run = f'<w:rPr>{run_properties}</w:rPr>' if run_properties else ""
+    return (f'<w:style w:type="{kind}" w:customStyle="1" '
+            f'w:styleId="{style_id}"><w:name w:val="{name}"/>{based}'
+            f'{extra}<w:qFormat/>{paragraph}{run}</w:style>')
+
+
+HEADING_SIZES = (32, 28, 24, 24, 22, 22)
+
+STYLES = XML_DECLARATION + (
+    f'<w:styles {W_NAMESPACE}>'
+    '<w:docDefaults><w:rPrDefault><w:rPr><w:rFonts w:ascii="Calibri" '
+    'w:hAnsi="Calibri" w:cs="Calibri"/><w:sz w:val="24"/><w:szCs '
+    'w:val="24"/><w:lang w:val="en-US" w:eastAsia="zh-CN"/></w:rPr>'
+    '</w:rPrDefault><w:pPrDefault><w:pPr><w:spacing w:after="200"/>'
+    '</w:pPr></w:pPrDefault></w:docDefaults>'
+    '<w:style w:type="paragraph" w:default="1" w:styleId="Normal">'
+    '<w:name w:val="Normal"/><w:qFormat/></w:style>'
+    '<w:style w:type="character" w:default="1" '
+    'w:styleId="DefaultParagraphFont"><w:name w:val="Default Paragraph '
+    'Font"/></w:style>' +
+    _style("BodyText", "Body Text", based_on="Normal",
+           properties='<w:spacing w:before="180" w:after="180"/>') +
+    _style("FirstParagraph", "First Paragraph", based_on="BodyText",
+           extra='<w:next w:val="BodyText"/>') +
+    _style("Compact", "Compact", based_on="BodyText",
+           properties='<w:spacing w:before="36" w:after="36"/>') +
+    "".join(_style(
+        f"Heading{level}", f"heading {level}", based_on="Normal",
+        extra='<w:next w:val="BodyText"/>',
+        properties=(f'<w:keepNext/><w:keepLines/><w:spacing w:before='
+                    f'"{480 if level == 1 else 200}" w:after="0"/>'
+                    f'<w:outlineLvl w:val="{level - 1}"/>'),
+        run_properties=(f'<w:b/><w:bCs/><w:color w:val="4F81BD"/>'
+                        f'<w:sz w:val="{size}"/><w:szCs w:val="{size}"/>'))
+            for level, size in enumerate(HEADING_SIZES, 1)) +
+    _style("BlockText", "Block Text", based_on="BodyText",
+           properties='<w:ind w:left="720" w:right="720"/>',
+           run_properties='<w:i/><w:iCs/>') +
+    _style("SourceCode", "Source Code", based_on="Normal",
+           properties=('<w:wordWrap w:val="off"/><w:shd w:val="clear" '
+                       'w:color="auto" w:fill="F8F8F8"/>')) +
+    _style("VerbatimChar", "Verbatim Char", kind="character",
+           run_properties=('<w:rFonts w:ascii="Consolas" w:hAnsi="Consolas"'
+                           '/><w:sz w:val="22"/>')) +
+    _style("Hyperlink", "Hyperlink", kind="character",
+           run_properties='<w:color w:val="4F81BD"/>') +
+    _style("CaptionedFigure", "Captioned Figure", based_on="Normal",
+           properties='<w:keepNext/>') +
+    _style("ImageCaption", "Image Caption", based_on="Normal",
+           properties='<w:spacing w:before="0" w:after="120"/>',
+           run_properties='<w:i/><w:iCs/>') +
+    '<w:style w:type="table" w:default="1" w:styleId="Table">'
+    '<w:name w:val="Table"/><w:tblPr><w:tblBorders>' +
+    "".join(f'<w:{side} w:val="single" w:sz="4" w:space="0" '
+            f'w:color="auto"/>'
+            for side in ("top", "left", "bottom", "right", "insideH",
+                         "insideV")) +
+    '</w:tblBorders><w:tblCellMar><w:left w:w="108" w:type="dxa"/>'
+    '<w:right w:w="108" w:type="dxa"/></w:tblCellMar></w:tblPr>'
+    '<w:tblStylePr w:type="firstRow"><w:rPr><w:b/><w:bCs/></w:rPr>'
+    '</w:tblStylePr></w:style>'
+    '</w:styles>')
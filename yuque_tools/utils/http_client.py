@@ -0,0 +1,236 @@
+import email.utils
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+DEFAULT_POOL_SIZE = 10
+
+# Connect and read timeout in seconds
+DEFAULT_TIMEOUT = (10, 60)
+DEFAULT_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60
+MAX_RETRY_AFTER = 300
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Status codes telling us to slow down
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE):
+    """Create a keep-alive HTTP session shared by all downloads
+
+    The connection pool is sized to the number of workers so that
+    concurrent downloads reuse connections instead of opening a new
+    one for every image.
+
+    Args:
+        pool_size (int): Max number of pooled connections per host
+
+    Returns:
+        requests.Session: Session with pooled HTTP(S) adapters mounted
+    """
+    # Imported with the first session, runs without any image to fetch
+    # never load it
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    logging.debug(f"Creating HTTP session with pool size {pool_size}")
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def create_fetcher(pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                   retries=DEFAULT_RETRIES):
+    """Create a fetcher on a pooled session, see Fetcher
+
+    The session is created with the first request.
+    """
+    return Fetcher(timeout=timeout, retries=retries,
+                   max_concurrency=pool_size)
+
+
+def backoff_delay(attempt):
+    """Return seconds to wait before retry number attempt + 1
+
+    Full jitter, spreading retries of concurrent workers.
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class AdaptiveLimiter(object):
+    """Concurrency limit adapting to throttling of a host
+
+    The limit is halved when the host throttles us and increased by one
+    after a limit's worth of successful requests, like TCP congestion
+    control.
+    """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = maximum
+        self._active = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= int(self.limit):
+                self._cond.wait()
+            self._active += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self._active -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+                self._successes = 0
+                logging.debug(f"Throttled, concurrency limit is {self.limit}")
+            elif self.limit < self.maximum:
+                self._successes += 1
+                if self._successes >= self.limit:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self._successes = 0
+            self._cond.notify_all()
+
+
+class _LimitedResponse(object):
+    """Response holding a slot of the limiter until it is closed"""
+
+    def __init__(self, response, limiter):
+        self._response = response
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def close(self):
+        if self._limiter:
+            self._limiter.release()
+            self._limiter = None
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Fetcher(object):
+    """HTTP GET with timeouts, retries and per-host concurrency limits
+
+    Connection errors, timeouts and 429/5xx responses are retried with
+    jittered exponential backoff, Retry-After of the response is honoured.
+    Errors while the body is read are left to the caller, fetch_image
+    restarts the download up to retries times.
+    Requests to each host are limited by an AdaptiveLimiter. The get method
+    is compatible with requests.Session.get, so a fetcher can be used
+    wherever a session is expected.
+    """
+
+    def __init__(self, session=None, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES, max_concurrency=DEFAULT_POOL_SIZE):
+        """
+        Args:
+            session (requests.Session, optional): Session sending the
+                requests, a session pooling max_concurrency connections is
+                created with the first request if not provided
+            timeout: Timeout in seconds, or a (connect, read) tuple
+            retries (int): Max number of retries of a request
+            max_concurrency (int): Max number of requests to a host
+        """
+        self._session = session
+        self.timeout = timeout
+        self.retries = retries
+        self.max_concurrency = max_concurrency
+        self._lock = threading.Lock()
+        self._limiters = {}
+
+    @property
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                self._session = create_session(self.max_concurrency)
+            return self._session
+
+    def _get_limiter(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if not limiter:
+                limiter = AdaptiveLimiter(self.max_concurrency)
+                self._limiters[host] = limiter
+            return limiter
+
+    def get(self, url, **kwargs):
+        """Send a GET request, retrying failures
+
+        Returns:
+            Response which releases the host slot when closed, the last
+            response is returned if retries are exhausted
+
+        Raises:
+            requests.exceptions.RequestException: If the last retry failed
+                with a connection error or timeout
+        """
+        import requests
+
+        kwargs.setdefault("timeout", self.timeout)
+        limiter = self._get_limiter(url)
+
+        for attempt in range(self.retries + 1):
+            limiter.acquire()
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                limiter.release(throttled=True)
+                if attempt >= self.retries:
+                    raise
+                delay = backoff_delay(attempt)
+                logging.warning(f"Failed to get {url}: {str(e)}, retrying "
+                                f"in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # Any other error, e.g. too many redirects or Ctrl-C, must
+                # not keep the slot of the host
+                limiter.release()
+                raise
+
+            if (response.status_code not in RETRY_STATUS_CODES or
+                    attempt >= self.retries):
+                return _LimitedResponse(response, limiter)
+
+            response.close()
+            limiter.release(
+                throttled=response.status_code in THROTTLE_STATUS_CODES)
+            delay = self._retry_after(response)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            logging.warning(f"Got status code {response.status_code} from "
+                            f"{url}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    def _retry_after(self, response):
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return None
+            delay = retry_at.timestamp() - time.time()
+        return min(MAX_RETRY_AFTER, max(0, delay))
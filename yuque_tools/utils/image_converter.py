@@ -1,56 +1,258 @@
+import io
 import os
 import logging
-from PIL import Image
-import cairosvg
+import shutil
+
+from yuque_tools.utils import utils
+
+ENCODING_FORMATS = ("keep", "png", "jpeg", "webp")
+DEFAULT_ENCODING_FORMAT = "png"
+DEFAULT_QUALITY = 85
+# Lossy images are re-encoded down to this quality to fit the byte budget,
+# then downscaled
+MIN_QUALITY = 40
+QUALITY_STEP = 10
+DOWNSCALE_FACTOR = 0.75
+MIN_DOWNSCALE_SIZE = 64
+
+PIL_FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}
+EXTNAMES = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp", "GIF": ".gif"}
+LOSSY_FORMATS = ("JPEG", "WEBP")
+PNG_MODES = ("1", "L", "LA", "P", "RGB", "RGBA", "I", "I;16")
+
+
+class EncodingPolicy(object):
+    """How downloaded images are encoded
+
+    The format is keep to keep the original format, or png, jpeg or webp
+    to re-encode images into it. Images larger than max_pixels in width or
+    height are downscaled, JPEG images are decoded at a reduced size
+    already. Images larger than max_bytes are re-encoded with a lower
+    quality, then downscaled until they fit. Transparent pixels of
+    re-encoded images are flattened over white, as Word shows them, unless
+    keep_alpha is set.
+    """
+
+    def __init__(self, format=DEFAULT_ENCODING_FORMAT,
+                 quality=DEFAULT_QUALITY, max_pixels=None, max_bytes=None,
+                 keep_alpha=False):
+        """
+        Args:
+            format (str): One of ENCODING_FORMATS
+            quality (int): Quality of JPEG and WebP, 1 to 100
+            max_pixels (int, optional): Max width and height of images
+            max_bytes (int, optional): Max size in bytes of each image
+            keep_alpha (bool): Keep alpha channel in PNG and WebP images
+        """
+        if format not in ENCODING_FORMATS:
+            raise ValueError(f"Unknown image format {format}")
+        self.format = format
+        self.quality = quality
+        self.max_pixels = max_pixels
+        self.max_bytes = max_bytes
+        self.keep_alpha = keep_alpha
+
+    @property
+    def limited(self):
+        return bool(self.max_pixels or self.max_bytes)
+
+    def options(self):
+        """Return the policy as a dict, e.g. to be saved in a manifest"""
+        return {"format": self.format, "quality": self.quality,
+                "max_pixels": self.max_pixels, "max_bytes": self.max_bytes,
+                "keep_alpha": self.keep_alpha}
+
+    def store_key(self, url):
+        """Return the key of an image url encoded with this policy
+
+        Images of the default policy are keyed by the url itself, so image
+        stores of previous versions are still used.
+        """
+        if self.options() == EncodingPolicy().options():
+            return url
+        return "%s#%s-q%s-p%s-b%s%s" % (
+            url, self.format, self.quality, self.max_pixels or 0,
+            self.max_bytes or 0, "-a" if self.keep_alpha else "")
+
+    def fits(self, image, size):
+        """Return if an opened image of size bytes is within the limits"""
+        if self.max_pixels and max(image.size) > self.max_pixels:
+            return False
+        return not self.max_bytes or size <= self.max_bytes
+
+
+def convert_image(source, save_path, policy=None):
+    """Encode an image following the policy, decoding straight from source
+
+    Only the final image is written, atomically, no intermediate file is
+    created. If conversion fails, the original image is saved instead.
 
-def convert_image_to_png(image_path):
-    """Convert any image format to PNG format
-    
     Args:
-        image_path: Path to the source image
-        
+        source: Image data as bytes, a path, or a binary file object
+        save_path: Path of the downloaded image, its extension tells the
+            original format
+        policy (EncodingPolicy, optional): Encoding of the image, converted
+            to PNG by default
+
     Returns:
-        str: Path to the converted PNG image
+        str: Path of the saved image, the extension tells the new format
     """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    elif isinstance(source, str):
+        with open(source, "rb") as f:
+            return convert_image(f, save_path, policy)
+
+    policy = policy or EncodingPolicy()
+    extension = os.path.splitext(save_path)[1].lower()
+
     try:
-        # Get the file extension
-        _, extension = os.path.splitext(image_path)
-        
-        # Handle SVG files separately
-        if extension.lower() == '.svg':
-            png_image_path = os.path.splitext(image_path)[0] + '.png'
-            cairosvg.svg2png(url=image_path, write_to=png_image_path)
-            os.remove(image_path)
-            logging.debug(f"Converted SVG {image_path} to {png_image_path}")
-            return png_image_path
-            
-        # Check if the image is already in PNG format
-        if extension.lower() == '.png':
-            return image_path
-        
-        # Open the image using PIL
-        image = Image.open(image_path)
-        
-        # Convert the image to PNG format
-        png_image_path = os.path.splitext(image_path)[0] + '.png'
-        
-        # Save as PNG (if image is in RGBA mode, convert to RGB first)
-        if image.mode in ('RGBA', 'LA'):
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1])
-            background.save(png_image_path, 'PNG')
+        if policy.format == "keep" and not policy.limited:
+            _save_original(source, save_path)
+            return save_path
+
+        # Handle SVG files separately, they are rendered to PNG first
+        if extension == '.svg':
+            if policy.format == "keep":
+                _save_original(source, save_path)
+                return save_path
+
+            # Imported only when an SVG is converted, it is slow to load
+            import cairosvg
+            rendered = io.BytesIO()
+            cairosvg.svg2png(file_obj=source, write_to=rendered)
+            logging.debug(f"Rendered SVG {save_path}")
+            return _encode(rendered, os.path.splitext(save_path)[0] + '.png',
+                           policy)
+
+        return _encode(source, save_path, policy)
+
+    except Exception as e:
+        logging.error(f"Failed to convert image {save_path}: {str(e)}")
+        _save_original(source, save_path)
+        return save_path
+
+
+def _encode(source, save_path, policy):
+    from PIL import Image
+
+    source.seek(0, os.SEEK_END)
+    size = source.tell()
+    source.seek(0)
+
+    with Image.open(source) as image:
+        if policy.format == "keep":
+            target_format = image.format
         else:
-            image.convert('RGB').save(png_image_path, 'PNG')
-        
-        # Close the image
-        image.close()
-        
+            target_format = PIL_FORMATS[policy.format]
+
+        if target_format == image.format:
+            # Same format keeps the extension, e.g. .jpeg or .jpg
+            output_path = save_path
+        else:
+            output_path = os.path.splitext(save_path)[0] + \
+                EXTNAMES[target_format]
+
+        # Nothing to do, or frames of animations would be lost
+        if (target_format == image.format and
+                (policy.fits(image, size) or
+                 getattr(image, "is_animated", False))):
+            _save_original(source, output_path)
+            return output_path
+
+        if policy.max_pixels and max(image.size) > policy.max_pixels:
+            box = (policy.max_pixels, policy.max_pixels)
+            # JPEG is decoded at the nearest reduced scale, much cheaper
+            # than decoding the full image and resizing it
+            image.draft("RGB", box)
+            image.thumbnail(box, Image.LANCZOS)
+
+        image = _prepare_mode(image, target_format, policy.keep_alpha)
+        data = _save_within_budget(image, target_format, policy)
+
+    with utils.atomic_open(output_path, "wb") as f:
+        f.write(data)
+    logging.debug(f"Converted {save_path} to {output_path}, {size} bytes "
+                  f"to {len(data)} bytes")
+    return output_path
+
+
+def _prepare_mode(image, target_format, keep_alpha=False):
+    from PIL import Image
+
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (
+        image.mode == 'P' and 'transparency' in image.info)
+
+    if target_format == 'JPEG' or (has_alpha and not keep_alpha):
+        if not has_alpha:
+            return image.convert('RGB')
+        # Transparent pixels are shown as white, JPEG has no alpha at all
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+
+    # PNG and WebP keep the alpha channel if asked to
+    modes = PNG_MODES if target_format == 'PNG' else ('RGB', 'RGBA')
+    if image.mode in modes:
+        return image
+    return image.convert('RGBA' if has_alpha else 'RGB')
+
+
+def _save_within_budget(image, target_format, policy):
+    from PIL import Image
+
+    quality = policy.quality
+    while True:
+        buffer = io.BytesIO()
+        if target_format in LOSSY_FORMATS:
+            image.save(buffer, target_format, quality=quality)
+        else:
+            # Optimizing is several times slower for a few percent smaller
+            # files, it is only worth it to fit the budget
+            image.save(buffer, target_format,
+                       optimize=bool(policy.max_bytes))
+        data = buffer.getvalue()
+
+        if not policy.max_bytes or len(data) <= policy.max_bytes:
+            return data
+
+        if (target_format in LOSSY_FORMATS and
+                quality - QUALITY_STEP >= MIN_QUALITY):
+            quality -= QUALITY_STEP
+            continue
+
+        width, height = image.size
+        size = (int(width * DOWNSCALE_FACTOR), int(height * DOWNSCALE_FACTOR))
+        if min(size) < MIN_DOWNSCALE_SIZE:
+            logging.warning(f"Image is still {len(data)} bytes, larger than "
+                            f"{policy.max_bytes} bytes")
+            return data
+        image = image.resize(size, Image.LANCZOS)
+
+
+def _save_original(source, save_path):
+    source.seek(0)
+    with utils.atomic_open(save_path, "wb") as f:
+        shutil.copyfileobj(source, f)
+
+
+def convert_image_to_png(image_path, policy=None):
+    """Convert any image format to PNG format, or as the policy tells
+
+    Args:
+        image_path: Path to the source image
+        policy (EncodingPolicy, optional): Encoding of the image
+
+    Returns:
+        str: Path to the converted PNG image
+    """
+    _, extension = os.path.splitext(image_path)
+    if extension.lower() == '.png' and not policy:
+        return image_path
+
+    converted_path = convert_image(image_path, image_path, policy)
+    if converted_path != image_path:
         # Remove the original image file
         os.remove(image_path)
-        
-        logging.debug(f"Converted {image_path} to {png_image_path}")
-        return png_image_path
-        
-    except Exception as e:
-        logging.error(f"Failed to convert image {image_path}: {str(e)}")
-        return image_path 
\ No newline at end of file
+    return converted_path
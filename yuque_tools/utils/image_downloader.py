@@ -1,94 +1,362 @@
+import io
 import logging
 import os
-import re
-import requests
-from pypinyin import lazy_pinyin
+import tempfile
+import time
 
-from yuque_tools.utils.image_converter import convert_image_to_png
+from yuque_tools.utils import http_client
+from yuque_tools.utils import image_namer
+from yuque_tools.utils import image_scanner
+from yuque_tools.utils import metrics
+from yuque_tools.utils import utils
+from yuque_tools.utils.image_converter import EncodingPolicy
+from yuque_tools.utils.image_converter import convert_image
+
+CHUNK_SIZE = 64 * 1024
+# Images larger than this are spilled from memory to disk
+SPOOL_SIZE = 8 * 1024 * 1024
+MAX_IMAGE_SIZE = 128 * 1024 * 1024
 
 
 class YuqueImageDownloder(object):
 
-    def __init__(self, md_path, image_download_dir):
+    def __init__(self, md_path, image_download_dir,
+                 session=None, executor=None, image_store=None,
+                 image_pipeline=None, policy=None, journal=None,
+                 namer=None, saved_names=None):
+        """Initialize downloader for a single markdown file
+
+        Args:
+            md_path (str): Path of the markdown file
+            image_download_dir (str): Images dir relative to markdown file
+            session (requests.Session or Fetcher, optional): Shared pooled
+                session, a fetcher without retries is used if not provided
+            executor (concurrent.futures.Executor, optional): Executor used
+                to download images concurrently, images are downloaded one
+                by one if not provided
+            image_store (ImageStore, optional): Content-addressed store,
+                each url is downloaded once and linked into the images dir
+            image_pipeline (ImagePipeline, optional): Pipeline downloading
+                and converting images in separate stages, used instead of
+                executor and image_store if provided
+            policy (EncodingPolicy, optional): Encoding of downloaded
+                images, converted to PNG by default, not used with
+                image_pipeline which has its own policy
+            journal (Journal, optional): Journal of the run, images done by
+                an interrupted run are not downloaded again
+            namer (ImageNamer, optional): Names of images, the namer shared
+                by the whole process is used if not provided
+            saved_names (iterable, optional): Names of images saved by
+                previous runs, the images dir is listed if not provided
+        """
         self.md_path = md_path
         self.image_download_dir = image_download_dir
+        self.session = session or http_client.Fetcher(timeout=None,
+                                                      retries=0)
+        self.executor = executor
+        self.image_store = image_store
+        self.image_pipeline = image_pipeline
+        self.policy = policy or EncodingPolicy()
+        self.journal = journal
+        self.namer = namer
+        self.saved_names = saved_names
+        # Image links of the last text which failed to download
+        self.failed = 0
 
     def download(self):
-        base_file_path = os.path.dirname(self.md_path)
+        """Download images of the markdown file and rewrite it in place
+
+        Returns:
+            int: Number of image links which failed to download, they are
+                left linked to Yuque
+        """
+        self.failed = 0
+        with open(self.md_path, "rb") as rfhd:
+            data = rfhd.read()
+
+        # Most files of a re-run have no remote images, they are neither
+        # decoded nor written
+        if not image_scanner.has_images(data):
+            logging.debug(f"No Yuque image found in {self.md_path}")
+            return 0
+
+        text = data.decode("utf-8")
+        new_text = self.download_text(text)
+        if new_text != text:
+            with utils.atomic_open(
+                    self.md_path, "w", encoding="utf-8") as wfhd:
+                wfhd.write(new_text)
+        return self.failed
+
+    def download_lines(self, lines):
+        """Download images of markdown lines already read into memory
 
-        with open(self.md_path, "r") as rfhd:
-            lines = rfhd.readlines()
-            lines = self._download_images(lines, base_file_path)
+        Returns:
+            list: Lines with image links rewritten to the local images
+        """
+        text = self.download_text("".join(lines))
+        # Split on newlines only, as lines are read from a file
+        return io.StringIO(text, newline="\n").readlines()
 
-            with open(self.md_path, "w+") as wfhd:
-                wfhd.writelines(lines)
+    def download_text(self, text):
+        """Download images of markdown text already read into memory
 
-    def _download_images(self, lines, base_file_path):
-        """Download images and modify image links in markdown"""
+        Image links which failed to download are counted in failed.
+
+        Returns:
+            str: Text with image links rewritten to the local images
+        """
+        self.failed = 0
+        refs = image_scanner.scan_images(text)
+        if not refs:
+            return text
+
+        base_file_path = os.path.dirname(self.md_path)
+        return self._download_images(text, refs, base_file_path)
+
+    def _download_images(self, text, refs, base_file_path):
+        """Download images and splice local image links into markdown"""
         image_full_path = os.path.join(base_file_path, self.image_download_dir)
         image_relative_path = "./%s" % self.image_download_dir
 
         # Ensure images path is exists
         if not os.path.exists(image_full_path):
-            os.makedirs(image_full_path)
-
-        for index, line in enumerate(lines):
-            # Replace image, by default the image url will be:
-            # ![image.png](https://cdn.nlark.com/yuque/path/xxxx.png#REMOVED_PART
-            if re.match(r"!\[(.*?)\].*yuque", line):
-                logging.debug(f"Found image line: {line}")
-                find_pattern = re.compile(
-                    r'https://.*?\.(jpeg|jpg|gif|png|svg|webp)')
-                match = find_pattern.search(line)
-                image_url = match.group()
-
-                md_basename = os.path.splitext(
-                    os.path.basename(self.md_path))[0]
-                
-                # Convert Chinese to pinyin and keep only alphanumeric characters
-                md_basename = ''.join(lazy_pinyin(md_basename))
-                md_basename = re.sub(r'[^a-zA-Z0-9]', '', md_basename)
-
-                image_extname = os.path.splitext(
-                    os.path.basename(image_url))[1]
-
-                # Use index line number for image name
-                image_name = "%s-%s%s" % (
-                    md_basename, str(index), image_extname)
-                save_path = os.path.join(image_full_path, image_name)
-
-                if os.path.exists(save_path):
-                    logging.warn(f"Skip to download image from {image_url} "
-                                 f"due to image is already exists in {save_path}")
-                    continue
-
-                logging.info("Downloading image %s to %s..." % (
-                    image_url, save_path))
-
-                response = requests.get(image_url)
-                if response.status_code == 200:
-                    with open(save_path, "wb") as file:
-                        file.write(response.content)
-                        
-                    # Convert the downloaded image to PNG format
-                    try:
-                        converted_path = convert_image_to_png(save_path)
-                        if converted_path != save_path:
-                            # Update image name and path if conversion was successful
-                            image_name = os.path.basename(converted_path)
-                            save_path = converted_path
-                    except Exception as e:
-                        logging.error(f"Failed to convert image {save_path}: {str(e)}")
-                else:
-                    logging.warning(
-                        f"Skip to download image, status code "
-                        f"is {response.status_code}")
-                    continue
-
-                replace_image_line = "![%s](%s/%s)\n\n" % (
-                    image_name, image_relative_path, image_name)
-                logging.debug("Old image line: %s" % line)
-                logging.debug("New image line: %s" % replace_image_line)
-                lines[index] = replace_image_line
-
-        return lines
\ No newline at end of file
+            os.makedirs(image_full_path, exist_ok=True)
+
+        namer = self.namer or image_namer.get_namer()
+        # Images saved by previous runs by name without extension, they
+        # might be converted to another format
+        saved_names = self.saved_names
+        if saved_names is None:
+            saved_names = os.listdir(image_full_path)
+        saved_images = {os.path.splitext(name)[0]: name
+                        for name in saved_names}
+
+        # Collect all images first, so that they could be downloaded
+        # concurrently, links are rewritten after all downloads finished.
+        # An image used several times is downloaded once.
+        tasks = {}
+        done = []
+        for ref in refs:
+            logging.debug(f"Found image: {text[ref.start:ref.end]}")
+            image_name = namer.image_name(
+                self.md_path, ref.url, image_full_path)
+            save_path = os.path.join(image_full_path, image_name)
+
+            if save_path in tasks:
+                tasks[save_path][1].append(ref)
+                continue
+
+            saved_path = self.journal and self.journal.get_image(
+                ref.url, save_path)
+            if saved_path:
+                logging.debug(f"Image {ref.url} was saved to {saved_path} "
+                              f"by interrupted run")
+                done.append((ref, saved_path))
+                continue
+
+            saved_name = saved_images.get(os.path.splitext(image_name)[0])
+            if saved_name:
+                logging.debug(f"Skip to download image from {ref.url} due "
+                              f"to image is already saved as {saved_name}")
+                done.append((ref, os.path.join(image_full_path, saved_name)))
+                continue
+
+            tasks[save_path] = (ref.url, [ref])
+
+        tasks = list(tasks.items())
+        if self.image_pipeline:
+            futures = [
+                self.image_pipeline.submit(image_url, path)
+                for path, (image_url, _) in tasks]
+            results = (future.result() for future in futures)
+        elif self.executor:
+            futures = [
+                self.executor.submit(self._download_image, image_url, path)
+                for path, (image_url, _) in tasks]
+            results = (future.result() for future in futures)
+        else:
+            results = (self._download_image(image_url, path)
+                       for path, (image_url, _) in tasks)
+
+        for (save_path, (image_url, image_refs)), saved_path in zip(
+                tasks, results):
+            # Each image is journaled once saved, not only with the document
+            if self.journal and saved_path:
+                self.journal.image_done(image_url, save_path, saved_path)
+            if not saved_path:
+                self.failed += len(image_refs)
+            done.extend((ref, saved_path) for ref in image_refs)
+        done.sort(key=lambda item: item[0].start)
+
+        replacements = []
+        for ref, save_path in done:
+            if not save_path:
+                continue
+
+            image_name = os.path.basename(save_path)
+            new_image = "![%s](%s/%s)" % (
+                image_name, image_relative_path, image_name)
+            # Image on a line of its own is followed by a blank line
+            if _is_whole_line(text, ref.start, ref.end):
+                new_image += "\n"
+            logging.debug("Old image: %s" % text[ref.start:ref.end])
+            logging.debug("New image: %s" % new_image)
+            replacements.append((ref.start, ref.end, new_image))
+
+        return image_scanner.splice(text, replacements)
+
+    def _download_image(self, image_url, save_path):
+        """Download a single image, through the image store if any
+
+        Returns:
+            str: Final path of the saved image, None if download failed
+        """
+        if not self.image_store:
+            return self._fetch_image(image_url, save_path)
+
+        # Each encoding of an url is stored separately
+        stored_path = self.image_store.fetch(
+            self.policy.store_key(image_url), os.path.splitext(save_path)[1],
+            lambda _, tmp_path: self._fetch_image(image_url, tmp_path))
+        if not stored_path:
+            return None
+
+        # Stored image might be converted to another format
+        return self.image_store.link_image(stored_path, save_path)
+
+    def _fetch_image(self, image_url, save_path):
+        """Download a single image and encode it following the policy
+
+        Returns:
+            str: Final path of the saved image, None if download failed
+        """
+        buffer = fetch_image(self.session, image_url)
+        if not buffer:
+            return None
+
+        with buffer:
+            size = buffer.seek(0, os.SEEK_END)
+            buffer.seek(0)
+            converted_path, seconds = metrics.call_timed(
+                convert_image, buffer, save_path, self.policy)
+        record_conversion(save_path, seconds, size, converted_path)
+        return converted_path
+
+
+class _BodyReadError(Exception):
+    """Connection broken while the body of a response was read"""
+
+
+def fetch_image(session, image_url, spool_path=None,
+                spool_size=SPOOL_SIZE, max_size=MAX_IMAGE_SIZE):
+    """Stream an image into an in-memory buffer
+
+    The image is kept in memory up to spool_size bytes, larger images are
+    spilled to spool_path, or an anonymous temp file if not provided.
+    Images larger than max_size are skipped. Errors of the request are
+    retried by a Fetcher session, a connection broken while the body is
+    read restarts the download as many times as the fetcher retries.
+
+    Returns:
+        file: Binary file object positioned at the start of the image,
+            None if download failed
+    """
+    import requests
+
+    logging.info(f"Downloading image {image_url}...")
+
+    started = time.perf_counter()
+    retries = getattr(session, "retries", 0)
+    attempt = 0
+    while True:
+        try:
+            result = _download_image(session, image_url, spool_path,
+                                     spool_size, max_size)
+            break
+        except _BodyReadError as e:
+            if attempt >= retries:
+                error = e
+            else:
+                delay = http_client.backoff_delay(attempt)
+                attempt += 1
+                logging.warning(f"Failed to read image {image_url}: "
+                                f"{str(e)}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+        except (requests.exceptions.RequestException, ValueError) as e:
+            error = e
+        logging.warning(f"Skip to download image {image_url}: {str(error)}")
+        metrics.add("images_failed")
+        return None
+
+    if result is None:
+        metrics.add("images_failed")
+        return None
+    buffer, size = result
+    metrics.record("fetch", time.perf_counter() - started, item=image_url,
+                   kind=image_type(image_url), size=size)
+    buffer.seek(0)
+    return buffer
+
+
+def _download_image(session, image_url, spool_path, spool_size, max_size):
+    # (buffer, size) of the image, None if the status code is not 200.
+    # Nothing is left behind if it fails.
+    import requests
+
+    buffer = io.BytesIO()
+    try:
+        with session.get(image_url, stream=True) as response:
+            if response.status_code != 200:
+                logging.warning(
+                    f"Skip to download image, status code "
+                    f"is {response.status_code}")
+                return None
+
+            size = 0
+            try:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_size:
+                        raise ValueError(
+                            f"size is larger than {max_size} bytes")
+
+                    if size > spool_size and isinstance(buffer, io.BytesIO):
+                        logging.debug(f"Spilling image {image_url} to disk")
+                        spilled = (open(spool_path, "w+b") if spool_path
+                                   else tempfile.TemporaryFile())
+                        spilled.write(buffer.getvalue())
+                        buffer = spilled
+                    buffer.write(chunk)
+            except (requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                raise _BodyReadError(str(e)) from e
+    except BaseException:
+        buffer.close()
+        if spool_path and os.path.exists(spool_path):
+            os.remove(spool_path)
+        raise
+    return buffer, size
+
+
+def _is_whole_line(text, start, end):
+    return ((start == 0 or text[start - 1] == "\n") and
+            (end == len(text) or text[end] == "\n"))
+
+
+def record_conversion(save_path, seconds, source_size, converted_path):
+    """Record time and bytes saved of an image conversion in metrics"""
+    size = None
+    if converted_path and os.path.exists(converted_path):
+        size = os.path.getsize(converted_path)
+        metrics.add("image_bytes_before", source_size)
+        metrics.add("image_bytes_after", size)
+    metrics.record("convert", seconds, item=save_path,
+                   kind=image_type(save_path), size=size)
+
+
+def image_type(path):
+    """Return the image format told by the extension of a path or url"""
+    return os.path.splitext(path)[1].lstrip(".").lower() or None
@@ -0,0 +1,86 @@
+import functools
+import hashlib
+import logging
+import os
+import re
+import threading
+
+DEFAULT_HASH_LENGTH = 12
+# Hash is lengthened by this many hex digits when names collide
+HASH_LENGTH_STEP = 4
+
+
+@functools.lru_cache(maxsize=None)
+def transliterate(name):
+    """Return name converted to pinyin with only alphanumeric characters
+
+    Results are cached for the whole run, every image of a document and
+    every document of the same name share one conversion.
+    """
+    # Imported only for files with images, its dictionaries are slow to
+    # load
+    from pypinyin import lazy_pinyin
+
+    return re.sub(r'[^a-zA-Z0-9]', '', ''.join(lazy_pinyin(name)))
+
+
+def url_hash(url, length=DEFAULT_HASH_LENGTH):
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()[:length]
+
+
+class ImageNamer(object):
+    """Stable names of images shared by all documents of a run
+
+    An image is named by the document name in pinyin and a hash of its
+    url, so the name does not change when lines are added to the document
+    and re-runs find images already downloaded. Each path of the tree is
+    given to one url only, if hashes of two urls collide in an images dir
+    a longer hash is used for the latter.
+    """
+
+    def __init__(self, hash_length=DEFAULT_HASH_LENGTH):
+        self.hash_length = hash_length
+        self.collisions = 0
+        self._lock = threading.Lock()
+        self._urls = {}
+
+    def image_name(self, md_path, image_url, image_dir):
+        """Return file name of an image of a markdown file
+
+        Args:
+            md_path (str): Path of the markdown file using the image
+            image_url (str): Url of the image, its extension is kept
+            image_dir (str): Dir the image is saved to
+
+        Returns:
+            str: Name of the image in image_dir, the same url in the same
+                document always gets the same name
+        """
+        prefix = transliterate(os.path.splitext(os.path.basename(md_path))[0])
+        extname = os.path.splitext(os.path.basename(image_url))[1]
+        image_dir = os.path.abspath(image_dir)
+
+        length = self.hash_length
+        with self._lock:
+            while True:
+                digest = url_hash(image_url, length)
+                name = f"{prefix}-{digest}{extname}" if prefix else \
+                    f"{digest}{extname}"
+                owner = self._urls.setdefault(
+                    os.path.join(image_dir, name), image_url)
+                if owner == image_url:
+                    return name
+
+                self.collisions += 1
+                logging.warning(f"Image name {name} of {image_url} collides "
+                                f"with {owner} in {image_dir}, using a "
+                                f"longer hash")
+                length += HASH_LENGTH_STEP
+
+
+# Names given in this process, shared by all documents like metrics
+_namer = ImageNamer()
+
+
+def get_namer():
+    return _namer
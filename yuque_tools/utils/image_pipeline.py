@@ -0,0 +1,249 @@
+import concurrent.futures
+import io
+import logging
+import multiprocessing
+import os
+import threading
+
+from yuque_tools.utils import metrics
+from yuque_tools.utils import utils
+from yuque_tools.utils.image_converter import EncodingPolicy
+from yuque_tools.utils.image_converter import convert_image
+from yuque_tools.utils.image_downloader import fetch_image
+from yuque_tools.utils.image_downloader import record_conversion
+
+DEFAULT_QUEUE_SIZE = 64
+SPOOL_EXTNAME = ".part"
+STAGES = ("fetch", "convert")
+
+
+class StageCounters(object):
+    """Thread-safe counters of tasks waiting, running and finished in stages"""
+
+    def __init__(self, stages=STAGES):
+        self._lock = threading.Lock()
+        self._counters = {
+            stage: {"queued": 0, "running": 0, "done": 0, "failed": 0}
+            for stage in stages}
+
+    def queued(self, stage):
+        with self._lock:
+            self._counters[stage]["queued"] += 1
+
+    def started(self, stage):
+        with self._lock:
+            self._counters[stage]["queued"] -= 1
+            self._counters[stage]["running"] += 1
+
+    def finished(self, stage, failed=False):
+        with self._lock:
+            self._counters[stage]["running"] -= 1
+            self._counters[stage]["failed" if failed else "done"] += 1
+
+    def snapshot(self):
+        """Return a copy of all counters"""
+        with self._lock:
+            return {stage: dict(counters)
+                    for stage, counters in self._counters.items()}
+
+    def __str__(self):
+        return "; ".join(
+            f"{stage} " + " ".join(
+                f"{name}={value}" for name, value in counters.items())
+            for stage, counters in self.snapshot().items())
+
+
+class ImagePipeline(object):
+    """Download images in threads and convert them in processes
+
+    Network workers only fetch bytes into memory, conversions run in a process
+    pool sized to the number of CPU cores. At most queue_size downloaded
+    images wait for or run conversion, network workers block when the
+    queue is full. If an image store is given, each url is fetched and
+    converted once and linked into every images dir using it, an url which
+    failed is fetched again when it is submitted again.
+    """
+
+    def __init__(self, session, fetch_workers, convert_workers=None,
+                 queue_size=DEFAULT_QUEUE_SIZE, image_store=None,
+                 policy=None, debug=False, verbose=True):
+        """Start the worker pools of the pipeline
+
+        Args:
+            session (requests.Session or Fetcher): Shared pooled session
+            fetch_workers (int): Number of network workers
+            convert_workers (int, optional): Number of conversion processes,
+                number of CPU cores if not provided
+            queue_size (int): Max number of images between the two stages
+            image_store (ImageStore, optional): Content-addressed store
+            policy (EncodingPolicy, optional): Encoding of images, converted
+                to PNG by default
+            debug (bool): Enable debug message in conversion processes
+            verbose (bool): Show message of conversion processes
+        """
+        self.session = session
+        self.image_store = image_store
+        self.policy = policy or EncodingPolicy()
+        self.counters = StageCounters()
+
+        self._fetch_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=fetch_workers, thread_name_prefix="fetch")
+        self._convert_executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=convert_workers or os.cpu_count(),
+            # Forking while network threads are running is not safe
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=utils.init_worker,
+            initargs=(debug, verbose))
+        self._convert_slots = threading.BoundedSemaphore(queue_size)
+
+        self._lock = threading.Lock()
+        self._stored = {}
+
+    def submit(self, image_url, save_path):
+        """Download and convert an image in the pipeline
+
+        Returns:
+            concurrent.futures.Future: Resolves to the final path of the
+                image, or None if it failed
+        """
+        if not self.image_store:
+            future = concurrent.futures.Future()
+            self._submit_fetch(image_url, save_path, future)
+            return future
+
+        # Each encoding of an url is stored separately
+        store_key = self.policy.store_key(image_url)
+        with self._lock:
+            stored_future = self._stored.get(store_key)
+            if not stored_future:
+                stored_future = concurrent.futures.Future()
+                stored_path = self.image_store.get(store_key)
+                if stored_path:
+                    stored_future.set_result(stored_path)
+                else:
+                    # Only images being fetched are shared, so the dict
+                    # does not grow in a long watch run
+                    self._stored[store_key] = stored_future
+                    stored_future.add_done_callback(
+                        lambda f: self._forget(store_key, f))
+                    tmp_path = self.image_store.tmp_path(
+                        os.path.splitext(save_path)[1])
+                    self._submit_fetch(
+                        image_url, tmp_path, stored_future,
+                        store_key=store_key)
+
+        future = concurrent.futures.Future()
+        stored_future.add_done_callback(
+            lambda f: self._link(f.result(), save_path, future))
+        return future
+
+    def _forget(self, store_key, future):
+        # A stored image is found in the image store from now on, a failed
+        # one is fetched again by the next document using it
+        with self._lock:
+            if self._stored.get(store_key) is future:
+                del self._stored[store_key]
+
+    def _submit_fetch(self, image_url, save_path, future, store_key=None):
+        self.counters.queued("fetch")
+        self._fetch_executor.submit(
+            self._fetch, image_url, save_path, future, store_key)
+
+    def _fetch(self, image_url, save_path, future, store_key):
+        self.counters.started("fetch")
+        spool_path = save_path + SPOOL_EXTNAME
+        try:
+            buffer = fetch_image(
+                self.session, image_url, spool_path=spool_path)
+        except Exception as e:
+            logging.error(f"Failed to download image {image_url}: {str(e)}")
+            buffer = None
+        self.counters.finished("fetch", failed=not buffer)
+
+        if not buffer:
+            future.set_result(None)
+            return
+
+        # Small images are passed to conversion process in memory, large
+        # ones through the file they are spilled to
+        with buffer:
+            size = buffer.seek(0, os.SEEK_END)
+            if isinstance(buffer, io.BytesIO):
+                source = buffer.getvalue()
+                spool_path = None
+            else:
+                source = spool_path
+
+        # Block network worker if too many images are waiting for conversion
+        self.counters.queued("convert")
+        self._convert_slots.acquire()
+        self.counters.started("convert")
+        try:
+            convert_future = self._convert_executor.submit(
+                metrics.call_timed, convert_image, source, save_path,
+                self.policy)
+        except Exception as e:
+            # A broken or shut down pool, the image is given up so callers
+            # waiting for it never hang
+            self._convert_slots.release()
+            self.counters.finished("convert", failed=True)
+            if spool_path and os.path.exists(spool_path):
+                os.remove(spool_path)
+            logging.error(f"Failed to convert image {save_path}: {str(e)}")
+            future.set_result(None)
+            return
+        convert_future.add_done_callback(
+            lambda f: self._converted(
+                f, image_url, save_path, size, spool_path, future,
+                store_key))
+
+    def _converted(self, convert_future, image_url, save_path, size,
+                   spool_path, future, store_key):
+        self._convert_slots.release()
+        if spool_path:
+            # The future is resolved even if the spool file is already gone
+            try:
+                os.remove(spool_path)
+            except OSError as e:
+                logging.warning(f"Failed to remove {spool_path}: {str(e)}")
+
+        try:
+            converted_path, seconds = convert_future.result()
+            record_conversion(save_path, seconds, size, converted_path)
+            self.counters.finished("convert")
+        except Exception as e:
+            logging.error(f"Failed to convert image {save_path}: {str(e)}")
+            converted_path = None
+            self.counters.finished("convert", failed=True)
+
+        try:
+            if store_key and converted_path:
+                converted_path = self.image_store.put(
+                    store_key, converted_path)
+        except Exception as e:
+            logging.error(f"Failed to store image {image_url}: {str(e)}")
+            converted_path = None
+        future.set_result(converted_path)
+
+    def _link(self, stored_path, save_path, future):
+        if not stored_path:
+            future.set_result(None)
+            return
+
+        try:
+            future.set_result(
+                self.image_store.link_image(stored_path, save_path))
+        except Exception as e:
+            logging.error(f"Failed to link image {save_path}: {str(e)}")
+            future.set_result(None)
+
+    def shutdown(self):
+        """Wait for all images and stop the worker pools"""
+        self._fetch_executor.shutdown()
+        self._convert_executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
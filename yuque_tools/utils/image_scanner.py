@@ -0,0 +1,77 @@
+import collections
+import re
+
+# Every Yuque image url has it, files without it have nothing to download
+YUQUE_MARKER = "yuque"
+
+URL_CHAR = r"[^\s()<>\"']"
+IMAGE_URL = (r"https://" + URL_CHAR + r"*?yuque" + URL_CHAR +
+             r"*?\.(?:jpeg|jpg|gif|png|svg|webp)")
+
+# ![alt](url#params "title") and <img ... src="url" ...>
+IMAGE_PATTERN = re.compile(
+    r"!\[(?P<alt>[^\]\n]*)\]\((?P<md_url>" + IMAGE_URL + r")[^)\n]*\)"
+    r"|<img\b[^>]*?\bsrc=(?P<quote>[\"'])(?P<html_url>" + IMAGE_URL +
+    r")[^\"'>]*(?P=quote)[^>]*>",
+    re.IGNORECASE)
+
+ImageRef = collections.namedtuple(
+    "ImageRef", ["start", "end", "url", "alt", "line"])
+
+
+def has_images(data):
+    """Return if str or bytes data might have Yuque images
+
+    A plain substring search, much cheaper than scanning, to skip most
+    files of a re-run.
+    """
+    marker = YUQUE_MARKER if isinstance(data, str) else YUQUE_MARKER.encode()
+    return marker in data
+
+
+def scan_images(text):
+    """Find all Yuque image references in markdown text
+
+    Markdown images and HTML img tags are found anywhere, also inline or
+    several on one line.
+
+    Returns:
+        list: ImageRef of each reference, with offsets of the whole
+            reference in text, the image url, the alt text and the index
+            of the line it starts on
+    """
+    if not has_images(text):
+        return []
+
+    refs = []
+    line = 0
+    line_start = 0
+    for match in IMAGE_PATTERN.finditer(text):
+        line += text.count("\n", line_start, match.start())
+        line_start = match.start()
+        refs.append(ImageRef(
+            match.start(), match.end(),
+            match.group("md_url") or match.group("html_url"),
+            match.group("alt") or "", line))
+    return refs
+
+
+def splice(text, replacements):
+    """Replace spans of text
+
+    Args:
+        text (str): Original text
+        replacements (list): (start, end, new) tuples sorted by start, the
+            spans do not overlap
+
+    Returns:
+        str: Text with the spans replaced
+    """
+    parts = []
+    position = 0
+    for start, end, new in replacements:
+        parts.append(text[position:start])
+        parts.append(new)
+        position = end
+    parts.append(text[position:])
+    return "".join(parts)
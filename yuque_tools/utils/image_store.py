@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+
+from yuque_tools.utils import utils
+
+MANIFEST_NAME = "manifest.jsonl"
+OBJECTS_DIR = "objects"
+TMP_DIR = "tmp"
+
+
+class ImageStore(object):
+    """Content-addressed store shared by all images of a tree
+
+    Images are saved once under objects/<sha256[:2]>/<sha256><ext> and
+    linked into every _images dir that uses them. The url to object
+    mapping is appended to an on-disk manifest, so that a store reused
+    across runs never downloads the same url twice.
+    """
+
+    def __init__(self, store_dir):
+        """Initialize the store, loading an existing manifest if any
+
+        Args:
+            store_dir (str): Directory of the store, created if not exists
+        """
+        self.store_dir = os.path.abspath(store_dir)
+        self.manifest_path = os.path.join(self.store_dir, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self._url_locks = {}
+        self._urls = {}
+
+        os.makedirs(os.path.join(self.store_dir, OBJECTS_DIR), exist_ok=True)
+        os.makedirs(os.path.join(self.store_dir, TMP_DIR), exist_ok=True)
+        self._load_manifest()
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return
+
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line might be truncated by an interrupted run
+                    logging.warning(
+                        f"Ignore broken manifest line in "
+                        f"{self.manifest_path}: {line!r}")
+                    continue
+                self._urls[record["url"]] = record
+
+        logging.info(f"Loaded {len(self._urls)} images from image store "
+                     f"{self.store_dir}")
+
+    def _object_path(self, sha256, ext):
+        return os.path.join(
+            self.store_dir, OBJECTS_DIR, sha256[:2], sha256 + ext)
+
+    def get(self, url):
+        """Return stored path of the url, None if not stored yet"""
+        record = self._urls.get(url)
+        if not record:
+            return None
+
+        path = self._object_path(record["sha256"], record["ext"])
+        if not os.path.exists(path):
+            logging.warning(f"Object of {url} is missing in image store")
+            return None
+        return path
+
+    def fetch(self, url, ext, producer):
+        """Return stored path of url, producing it only once
+
+        Concurrent calls with the same url wait for the first one.
+
+        Args:
+            url (str): Image url, used as the key of the store
+            ext (str): Extension of the image before producing
+            producer (callable): Called as producer(url, tmp_path), saves
+                the image into tmp_path and returns the final path (it might
+                change the extension), or None if failed
+
+        Returns:
+            str: Path of the stored object, None if producing failed
+        """
+        with self._lock:
+            url_lock = self._url_locks.setdefault(url, threading.Lock())
+
+        with url_lock:
+            stored_path = self.get(url)
+            if stored_path:
+                logging.debug(f"Found {url} in image store: {stored_path}")
+                return stored_path
+
+            produced_path = producer(url, self.tmp_path(ext))
+            if not produced_path:
+                return None
+
+            return self.put(url, produced_path)
+
+    def tmp_path(self, ext):
+        """Return a unique path in the store to produce an image into"""
+        return os.path.join(self.store_dir, TMP_DIR, uuid.uuid4().hex + ext)
+
+    def put(self, url, src_path):
+        """Move src_path into the store and record it for url
+
+        Returns:
+            str: Path of the stored object
+        """
+        ext = os.path.splitext(src_path)[1]
+        sha256 = utils.file_sha256(src_path)
+        object_path = self._object_path(sha256, ext)
+
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        if os.path.exists(object_path):
+            # Same content from another url
+            os.remove(src_path)
+        else:
+            os.replace(src_path, object_path)
+
+        record = {"url": url, "sha256": sha256, "ext": ext}
+        with self._lock:
+            self._urls[url] = record
+            with open(self.manifest_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+        logging.debug(f"Stored {url} as {object_path}")
+        return object_path
+
+    def link_image(self, stored_path, save_path):
+        """Link a stored object as save_path, keeping the stored extension
+
+        Returns:
+            str: Path of the linked image
+        """
+        save_path = os.path.splitext(save_path)[0] + \
+            os.path.splitext(stored_path)[1]
+        self.link(stored_path, save_path)
+        logging.debug(f"Linked {stored_path} to {save_path}")
+        return save_path
+
+    def link(self, stored_path, dest_path):
+        """Link a stored object into dest_path
+
+        Hardlink is preferred, falls back to a relative symlink and then
+        a plain copy if links are not supported.
+        """
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+
+        try:
+            os.link(stored_path, dest_path)
+            return
+        except OSError as e:
+            logging.debug(f"Failed to hardlink {dest_path}: {str(e)}")
+
+        try:
+            os.symlink(os.path.relpath(
+                stored_path, os.path.dirname(dest_path)), dest_path)
+            return
+        except OSError as e:
+            logging.debug(f"Failed to symlink {dest_path}: {str(e)}")
+
+        shutil.copyfile(stored_path, dest_path)
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import threading
+
+from yuque_tools.utils import utils
+
+JOURNAL_NAME = ".yuque-tools-journal.jsonl"
+
+
+class Journal(object):
+    """Append-only journal of documents and images done by a run
+
+    Each finished image and document is appended as a JSON line, so an
+    interrupted run could be resumed where it stopped: documents done are
+    skipped and images done are linked without downloading them again.
+    The journal is removed when a run finishes, it only exists while a run
+    is going on or after it was interrupted.
+    """
+
+    def __init__(self, root_dir, tool, options=None, resume=False):
+        """Open the journal of a markdown tree
+
+        Args:
+            root_dir (str): Root of the markdown tree
+            tool (str): Name of the tool
+            options (dict, optional): Options affecting the output of tool,
+                a journal of other options is not resumed
+            resume (bool): Load the journal of an interrupted run, a new
+                journal is started otherwise
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        self.path = os.path.join(self.root_dir, JOURNAL_NAME)
+        self.tool = tool
+        self.options = options or {}
+        self._lock = threading.Lock()
+        self._docs = set()
+        self._images = {}
+
+        if resume:
+            self._load()
+        else:
+            self._start()
+
+    def _header(self):
+        return {"event": "start", "tool": self.tool,
+                "version": utils.get_version(), "options": self.options}
+
+    def _start(self):
+        self._open([self._header()])
+
+    def _open(self, records):
+        # The journal is always replaced before it is appended to, it might
+        # be hardlinked by a snapshot which must not change
+        with utils.atomic_open(self.path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            logging.info(f"No journal to resume in {self.root_dir}")
+            self._start()
+            return
+
+        with open(self.path, "r", encoding="utf-8") as f:
+            records = []
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Last line might be truncated by the interruption
+                    logging.warning(f"Ignore broken journal line in "
+                                    f"{self.path}: {line!r}")
+
+        header = records[0] if records else {}
+        expected = self._header()
+        if any(header.get(key) != expected[key]
+               for key in ("tool", "version", "options")):
+            logging.warning(f"Journal {self.path} was written by another "
+                            f"tool, version or options, not resuming it")
+            self._start()
+            return
+
+        for record in records[1:]:
+            if record.get("event") == "doc":
+                self._docs.add(record["path"])
+            elif record.get("event") == "image":
+                self._images[(record["url"], record["path"])] = \
+                    record["saved"]
+        logging.info(f"Resuming from journal {self.path}: {len(self._docs)} "
+                     f"documents and {len(self._images)} images done")
+        self._open(records)
+
+    def _relpath(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root_dir)
+
+    def _append(self, record, sync=False):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def is_doc_done(self, md_file):
+        return self._relpath(md_file) in self._docs
+
+    def doc_done(self, md_file):
+        """Record a document as done, synced to disk"""
+        relpath = self._relpath(md_file)
+        self._docs.add(relpath)
+        self._append({"event": "doc", "path": relpath}, sync=True)
+
+    def get_image(self, url, save_path):
+        """Return saved path of an image done by the interrupted run
+
+        Returns:
+            str: Path of the saved image, None if it is not done or the
+                image is missing
+        """
+        saved = self._images.get((url, self._relpath(save_path)))
+        if not saved:
+            return None
+
+        saved_path = os.path.join(self.root_dir, saved)
+        return saved_path if os.path.exists(saved_path) else None
+
+    def image_done(self, url, save_path, saved_path):
+        """Record an image downloaded to save_path and saved as saved_path"""
+        key = (url, self._relpath(save_path))
+        saved = self._relpath(saved_path)
+        self._images[key] = saved
+        self._append({"event": "image", "url": url, "path": key[1],
+                      "saved": saved})
+
+    def filter_pending(self, md_files, manifest=None):
+        """Yield markdown files which are not done yet
+
+        Files done by the interrupted run are recorded in the manifest, it
+        might not be saved when the run was interrupted.
+        """
+        for md_file in md_files:
+            if self.is_doc_done(md_file):
+                logging.debug(f"Skip {md_file} done by interrupted run")
+                if manifest:
+                    manifest.update(md_file)
+                continue
+            yield md_file
+
+    def finish(self):
+        """Remove the journal after the run finished"""
+        self._file.close()
+        os.remove(self.path)
+
+    def close(self):
+        """Keep the journal to be resumed"""
+        self._file.close()
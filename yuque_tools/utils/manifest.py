@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import threading
+
+from yuque_tools.utils import utils
+
+MANIFEST_NAME = ".yuque-tools-manifest.json"
+
+
+def file_record(path):
+    """Return size, mtime and content hash of a file as a dict"""
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": utils.file_sha256(path)
+    }
+
+
+def is_record_current(path, record):
+    """Return True if path still has the content recorded by file_record
+
+    The content hash is only compared when the mtime changed but the size
+    did not, the mtime of record is updated if the content is the same.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+
+    if stat.st_size != record["size"]:
+        return False
+    if stat.st_mtime_ns == record["mtime_ns"]:
+        return True
+
+    # Touched but maybe not modified, e.g. rewritten by another tool
+    if utils.file_sha256(path) != record["sha256"]:
+        return False
+
+    record["mtime_ns"] = stat.st_mtime_ns
+    return True
+
+
+class ProcessedManifest(object):
+    """Manifest of markdown files already processed by a tool
+
+    The manifest is saved in the root of the markdown tree, each tool has
+    its own section with the tool version and options it ran with. A file
+    is unchanged if its size and mtime are the same as recorded after it
+    was processed, the content hash is only compared when the mtime
+    changed but the size did not. Changing version or options of the tool
+    invalidates its whole section.
+    """
+
+    def __init__(self, root_dir, tool, options=None, force=False):
+        """Load the manifest of a markdown tree
+
+        Args:
+            root_dir (str): Root of the markdown tree
+            tool (str): Name of the tool
+            options (dict, optional): Options affecting the output of tool
+            force (bool): Ignore the recorded files, all files are changed
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        self.path = os.path.join(self.root_dir, MANIFEST_NAME)
+        self.tool = tool
+        self.found = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._data = self._load()
+
+        section = {
+            "version": utils.get_version(),
+            "options": options or {},
+            "files": {}
+        }
+        old_section = self._data.get(tool, {})
+        if force:
+            logging.info("Ignoring manifest of processed files")
+        elif (old_section.get("version") == section["version"] and
+                old_section.get("options") == section["options"]):
+            section["files"] = old_section.get("files", {})
+        elif old_section:
+            logging.info(f"Version or options of {tool} changed, "
+                         f"processing all files")
+        self._data[tool] = section
+        self._files = section["files"]
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError as e:
+            logging.warning(f"Ignore broken manifest {self.path}: {str(e)}")
+            return {}
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root_dir)
+
+    def is_unchanged(self, path):
+        """Return True if path is not changed since last processed"""
+        record = self._files.get(self._key(path))
+        if not record:
+            return False
+
+        return is_record_current(path, record)
+
+    def filter_changed(self, paths):
+        """Yield changed paths, counting found and skipped ones
+
+        The number of paths found and skipped are saved in found and
+        skipped attributes as the paths are consumed.
+        """
+        for path in paths:
+            self.found += 1
+            if self.is_unchanged(path):
+                logging.debug(f"Skip unchanged {path}")
+                self.skipped += 1
+                continue
+            yield path
+
+    def update(self, path):
+        """Record path as processed with its current content"""
+        record = file_record(path)
+        with self._lock:
+            self._files[self._key(path)] = record
+
+    def save(self):
+        """Write the manifest to disk, replacing the old one at once"""
+        with self._lock, \
+                utils.atomic_open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self._data, f, ensure_ascii=False, indent=2)
+        logging.debug(f"Saved manifest {self.path}")
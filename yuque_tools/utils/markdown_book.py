@@ -0,0 +1,359 @@
+import base64
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+
+from yuque_tools.utils import docx_writer
+from yuque_tools.utils import metrics
+from yuque_tools.utils import utils
+from yuque_tools.utils.docx_writer import ATX_HEADING
+from yuque_tools.utils.docx_writer import FENCE
+from yuque_tools.utils.docx_writer import LIST_ITEM
+from yuque_tools.utils.docx_writer import QUOTE
+from yuque_tools.utils.docx_writer import SETEXT_UNDERLINE
+from yuque_tools.utils.markdown_handler import DEFAULT_ENGINE
+from yuque_tools.utils.markdown_handler import convert_stream
+
+# dir makes one document of the markdown files directly in each directory,
+# book one document of each top-level directory with all files under it
+GROUP_MODES = ("dir", "book")
+MAX_HEADING_LEVEL = 6
+
+# ![alt](path "title"), path might be in angle brackets
+LOCAL_IMAGE = re.compile(r"(!\[[^\]\n]*\]\()(<[^>\n]+>|[^\s)]+)")
+URL_SCHEME = re.compile(r"^[A-Za-z][A-Za-z0-9+.-]*:")
+
+
+def shift_headings(text, levels):
+    """Return markdown text with headings moved down by levels
+
+    Headings in fenced code blocks and lines continuing a paragraph are
+    left as they are. Setext headings are written as ATX headings of the
+    shifted level, levels deeper than 6 are kept at 6. An unclosed fence
+    is closed at the end, so it never swallows the text after it.
+    """
+    lines = text.split("\n")
+    result = []
+    fence = None
+    block_start = True
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        if fence:
+            result.append(line)
+            stripped = line.strip()
+            if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                fence = None
+                block_start = True
+            continue
+
+        if not line.strip():
+            result.append(line)
+            block_start = True
+            continue
+
+        match = FENCE.match(line)
+        if match:
+            result.append(line)
+            fence = match.group(2)
+            continue
+
+        if block_start:
+            match = ATX_HEADING.match(line)
+            if match:
+                level = min(len(match.group(1)) + levels, MAX_HEADING_LEVEL)
+                result.append("#" * level + line.lstrip()[
+                    len(match.group(1)):])
+                continue
+
+            if (i < len(lines) and SETEXT_UNDERLINE.match(lines[i]) and
+                    not LIST_ITEM.match(line) and not QUOTE.match(line)):
+                level = 1 if lines[i].strip()[0] == "=" else 2
+                level = min(level + levels, MAX_HEADING_LEVEL)
+                result.append("#" * level + " " + line.strip())
+                i += 1
+                continue
+
+        # Lines after a paragraph line continue the paragraph
+        result.append(line)
+        block_start = False
+
+    if fence:
+        result.append(fence)
+    return "\n".join(result)
+
+
+def _local_path(match):
+    # Path of a local image, None for urls and anchors
+    target = match.group(2)
+    path = target[1:-1] if target.startswith("<") else target
+    if not path or URL_SCHEME.match(path) or path.startswith("#"):
+        return None
+    return path
+
+
+def _iter_lines(text):
+    # (line, is code) of each line, image links in fenced code blocks are
+    # not images
+    fence = None
+    for line in text.split("\n"):
+        if fence:
+            stripped = line.strip()
+            if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                fence = None
+            yield line, True
+            continue
+
+        match = FENCE.match(line)
+        if match:
+            fence = match.group(2)
+        yield line, bool(match)
+
+
+def rebase_images(text, doc_dir, base_dir):
+    """Return markdown text with local image paths relative to base_dir
+
+    Paths of images are relative to the markdown file, they are rewritten
+    so the file could be converted from another directory.
+    """
+    def rebase(match):
+        path = _local_path(match)
+        if not path or os.path.isabs(path):
+            return match.group(0)
+
+        path = os.path.relpath(os.path.join(doc_dir, path), base_dir)
+        path = path.replace(os.sep, "/")
+        if re.search(r"[\s()]", path):
+            path = f"<{path}>"
+        return match.group(1) + path
+
+    return "\n".join(
+        LOCAL_IMAGE.sub(rebase, line) if not code and "![" in line else line
+        for line, code in _iter_lines(text))
+
+
+def embed_images(text, doc_name, load):
+    """Return markdown text with local images embedded as data URIs
+
+    For documents whose images are not files on disk, e.g. members of an
+    archive, pandoc takes the images from the text itself.
+
+    Args:
+        text (str): Markdown text
+        doc_name (str): Name of the document, relative image paths are
+            resolved against its dir and separated by /
+        load (callable): Returns bytes of an image by its resolved name,
+            None if it is missing
+
+    Returns:
+        str: Text with links to images found rewritten
+    """
+    doc_dir = posixpath.dirname(doc_name)
+
+    def embed(match):
+        path = _local_path(match)
+        if not path or posixpath.isabs(path):
+            return match.group(0)
+
+        data = load(posixpath.normpath(posixpath.join(doc_dir, path)))
+        if data is None:
+            logging.warning(f"Image {path} of {doc_name} is not found")
+            return match.group(0)
+
+        content_type = mimetypes.guess_type(path)[0] or \
+            "application/octet-stream"
+        return (match.group(1) + f"data:{content_type};base64," +
+                base64.b64encode(data).decode("ascii"))
+
+    return "\n".join(
+        LOCAL_IMAGE.sub(embed, line) if not code and "![" in line else line
+        for line, code in _iter_lines(text))
+
+
+def scan_local_images(text, doc_dir):
+    """Return absolute paths of local images of markdown text
+
+    Args:
+        text (str): Markdown text
+        doc_dir (str): Dir relative image paths are resolved against
+
+    Returns:
+        list: Paths in the order of the references, without duplicates
+    """
+    paths = {}
+    for line, code in _iter_lines(text):
+        if code or "![" not in line:
+            continue
+        for match in LOCAL_IMAGE.finditer(line):
+            path = _local_path(match)
+            if path:
+                paths.setdefault(os.path.normpath(os.path.join(
+                    os.path.abspath(doc_dir), path)), None)
+    return list(paths)
+
+
+class DocumentGroup(object):
+    """Markdown files converted to one Word document
+
+    Files are ordered by the tree: entries of a directory by name, a file
+    named like a directory right before the directory, as Yuque exports a
+    document with children that way. A directory without such a file gets
+    a heading of its name. Headings of each file are shifted by its depth
+    in the group, so the tree is kept as the outline of the document.
+    """
+
+    def __init__(self, name, root_dir, tree):
+        """Group a tree of markdown files
+
+        Args:
+            name (str): Name of the group, the relative path of the Word
+                document without extension
+            root_dir (str): Dir paths in tree are relative to, image paths
+                are rebased to it
+            tree (dict): File path or subtree of each name of the top
+                level of the group
+        """
+        self.name = name
+        self.root_dir = root_dir
+        self.tree = tree
+
+    @property
+    def md_files(self):
+        return [path for _, kind, path in self.entries() if kind == "doc"]
+
+    def entries(self):
+        """Yield (depth, kind, value) of the group in tree order
+
+        kind is doc with the path of a markdown file as value, or section
+        with the name of a directory.
+        """
+        return self._walk(self.tree, 0)
+
+    def _walk(self, tree, depth):
+        def order(name):
+            # A file is named like its directory with .md extension
+            if isinstance(tree[name], dict):
+                return (name, 1)
+            return (os.path.splitext(name)[0], 0)
+
+        for name in sorted(tree, key=order):
+            node = tree[name]
+            if not isinstance(node, dict):
+                yield depth, "doc", node
+                continue
+
+            if not isinstance(tree.get(name + ".md"), str):
+                yield depth, "section", name
+            yield from self._walk(node, depth + 1)
+
+    def iter_markdown(self):
+        """Yield markdown of the whole group chunk by chunk
+
+        Each file is read only when its chunk is needed, chunks could be
+        streamed to pandoc without holding the whole group in memory.
+        """
+        for depth, kind, value in self.entries():
+            if kind == "section":
+                level = min(depth + 1, MAX_HEADING_LEVEL)
+                yield f"{'#' * level} {value}\n\n"
+                continue
+
+            with open(value, "r", encoding="utf-8") as f:
+                text = f.read()
+            text = shift_headings(text.replace("\r\n", "\n"), depth)
+            text = rebase_images(
+                text, os.path.dirname(value), self.root_dir)
+            # Blank lines keep the last block of a file from running into
+            # the first block of the next one
+            yield text.rstrip("\n") + "\n\n"
+
+    def to_docx(self, output_path, engine=DEFAULT_ENGINE):
+        """Convert all files of the group to one Word document
+
+        The pandoc engine runs one pandoc process for the group and streams
+        the files to it. The native engine falls back to pandoc if it does
+        not support the markdown of any file.
+        """
+        logging.info(f"Converting {len(self.md_files)} markdown files of "
+                     f"{self.name} to Word document {output_path}")
+        with utils.atomic_path(output_path) as tmp_path:
+            if engine == "native":
+                try:
+                    docx_writer.write_docx(
+                        "".join(self.iter_markdown()), tmp_path,
+                        resource_path=self.root_dir)
+                    return
+                except docx_writer.UnsupportedMarkdown as e:
+                    logging.info(f"Converting {self.name} with pandoc, "
+                                 f"native engine does not support {e}")
+                    metrics.add("native_fallbacks")
+
+            convert_stream(self.iter_markdown(), tmp_path,
+                           resource_path=self.root_dir)
+
+
+def group_documents(root_dir, md_files, group_by):
+    """Group markdown files under root_dir into Word documents
+
+    Args:
+        root_dir (str): Root of the markdown tree
+        md_files (list): Paths of markdown files under root_dir
+        group_by (str): One of GROUP_MODES
+
+    Returns:
+        list: DocumentGroup of each Word document, files directly in
+            root_dir are grouped as the name of root_dir
+    """
+    if group_by not in GROUP_MODES:
+        raise ValueError(f"Unknown group mode {group_by}")
+
+    root_dir = os.path.abspath(root_dir)
+    root_name = os.path.basename(root_dir)
+    tree = {}
+    for md_file in md_files:
+        parts = os.path.relpath(
+            os.path.abspath(md_file), root_dir).split(os.sep)
+        node = tree
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = os.path.abspath(md_file)
+
+    if group_by == "dir":
+        groups = []
+        _group_dirs(tree, (), root_dir, root_name, groups)
+        return groups
+
+    # A book is a top-level directory with the file named like it, other
+    # top-level files are grouped together
+    books = {name: {name: node} for name, node in tree.items()
+             if isinstance(node, dict)}
+    loose = {}
+    for name, node in tree.items():
+        if isinstance(node, dict):
+            continue
+        stem = os.path.splitext(name)[0]
+        if stem in books:
+            books[stem][name] = node
+        else:
+            loose[name] = node
+
+    groups = [DocumentGroup(name, root_dir, books[name])
+              for name in sorted(books)]
+    if loose:
+        groups.insert(0, DocumentGroup(root_name, root_dir, loose))
+    return groups
+
+
+def _group_dirs(tree, parts, root_dir, root_name, groups):
+    files = {name: node for name, node in tree.items()
+             if not isinstance(node, dict)}
+    if files:
+        name = os.path.join(*parts) if parts else root_name
+        groups.append(DocumentGroup(name, root_dir, files))
+    for name in sorted(tree):
+        if isinstance(tree[name], dict):
+            _group_dirs(tree[name], parts + (name,), root_dir, root_name,
+                        groups)
@@ -1,123 +1,225 @@
-import re
+import collections
+import io
 import logging
+import re
+
+from yuque_tools.utils import utils
+
+CODE_BLOCK_PATTERN = re.compile(r'^\s*```')
+LIST_OR_TABLE_PATTERN = re.compile(r'^\s*[-*|]\s|^\s*\d+\.\s')
+TITLE_OR_SEPARATOR_PATTERN = re.compile(r'^#+\s|^\s*[-=]+$')
+SEPARATOR_PATTERN = re.compile(r'^\s*---+')
+REDUNDANT_NEWLINES_PATTERN = re.compile(r'\n{3,}')
+
+
+class _BlankLineCollapser:
+    """
+    Writer wrapper which collapses three or more consecutive newlines into two,
+    only the trailing newlines of the written text are kept in memory.
+    """
+
+    def __init__(self, write):
+        """
+        Args:
+            write (callable): The function used to write the collapsed text.
+        """
+        self._write = write
+        self._newlines = 0
+
+    def write(self, text):
+        body = text.lstrip('\n')
+        self._newlines += len(text) - len(body)
+        if not body:
+            return
+
+        self._flush_newlines()
+        stripped_body = body.rstrip('\n')
+        self._newlines = len(body) - len(stripped_body)
+        self._write(REDUNDANT_NEWLINES_PATTERN.sub('\n\n', stripped_body))
+
+    def _flush_newlines(self):
+        if self._newlines:
+            self._write('\n' * min(self._newlines, 2))
+            self._newlines = 0
+
+    def close(self):
+        self._flush_newlines()
+
 
 class MarkdownFormatter:
     """
     Formats a Markdown file by ensuring appropriate blank lines around titles, paragraphs,
     code blocks, and separators.
+
+    Lines are processed in a single pass from an input iterator to an output writer, the
+    whole document is never held in memory. Text and streams are formatted without
+    touching the disk.
+
+    format_lines keeps the state of the document being formatted in the formatter, the
+    other methods use a fresh state for each call and are safe to call from many
+    threads at once.
     """
-    
-    def __init__(self, md_path):
+
+    def __init__(self, md_path=None):
         """
         Initializes the MarkdownFormatter with the path to the Markdown file.
-        
+
         Args:
-            md_path (str): The path to the Markdown file to be formatted.
+            md_path (str, optional): The path to the Markdown file to be formatted, only
+                needed by format.
         """
         self.md_path = md_path
         self.in_code_block = False
 
-    def _add_blank_lines(self, lines, index, reason):
+    def _reset(self, write):
+        self.in_code_block = False
+        self._out = _BlankLineCollapser(write)
+        self._debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        # Whether the last written line is not blank, False before the first line
+        self._prev_not_blank = False
+        # Number of blank lines inserted so far
+        self._inserted = 0
+        # Blank state of written lines which are behind the current input line,
+        # see _handle_code_block for the reason to keep them
+        self._pending = collections.deque()
+
+    def _emit(self, line, inserted=False):
+        not_blank = bool(line.strip())
+        self._out.write(line)
+        self._pending.append(not_blank)
+        self._prev_not_blank = not_blank
+        if inserted:
+            self._inserted += 1
+
+    def _drop_pending(self):
+        # Only the written lines after the current input line are needed
+        while len(self._pending) > self._inserted:
+            self._pending.popleft()
+
+    def _add_blank_lines_before(self, index, reason):
         """
-        Adds blank lines before and after the specified line if needed and logs the action.
-        
+        Adds blank lines before the current line if the previous line is not blank.
+
         Args:
-            lines (list): The list of lines from the Markdown file.
-            index (int): The index of the current line in the list.
+            index (int): The index of the current line in the input.
             reason (str): The reason for adding a blank line.
         """
-        logging.debug(f"Checking if a blank line is needed before and after line {index + 1}: {reason}")
-
-        # Add a blank line before the current line if needed
-        if index > 0 and not re.match(r'^\s*$', lines[index - 1].strip()):
-            lines.insert(index, '\n')
-            logging.debug(f"Added blank line before line {index + 1}: {reason}")
+        if self._prev_not_blank:
+            # Two blank lines are written and collapsed to one by the writer
+            self._emit('\n', inserted=True)
+            self._emit('\n', inserted=True)
+            if self._debug:
+                logging.debug(f"Added blank line before line {index + 1}: {reason}")
 
-        # Add a blank line after the current line if needed
-        if index == len(lines) - 1:
-            # Special case for the last line
-            lines.append('\n')
-            logging.debug(f"Added blank line after the last line {index + 1}: {reason}")
-        elif index < len(lines) - 1 and not re.match(r'^\s*$', lines[index + 1].strip()):
-            lines.insert(index + 1, '\n')
-            logging.debug(f"Added blank line after line {index + 1}: {reason}")
-
-    def _process_line(self, lines, line, index):
+    def _process_line(self, line, index):
         """
-        Processes each line and determines if blank lines need to be added.
-        
+        Processes each line and writes it with the blank lines it needs.
+
         Args:
-            lines (list): The list of lines from the Markdown file.
             line (str): The current line being processed.
-            index (int): The index of the current line in the list.
+            index (int): The index of the current line in the input.
         """
         stripped_line = line.strip()
-        logging.debug(f"Current line: {stripped_line}")
-
-        if re.match(r'^\s*```', stripped_line):
-            logging.debug(f"Code block detected at line {index + 1}")
-            self._handle_code_block(lines, line, index)
-        elif re.match(r'^\s*[-*|]\s', stripped_line) or re.match(r'^\s*\d+\.\s', stripped_line):
-            logging.debug(f"List item or table detected at line {index + 1}")
-            lines.append(line)
-        elif re.match(r'^#+\s', stripped_line) or re.match(r'^\s*[-=]+$', stripped_line):
-            logging.debug(f"Title or separator detected at line {index + 1}")
-            self._add_blank_lines(lines, len(lines), "Title or separator")
-            lines.append(line)
-            self._add_blank_lines(lines, len(lines) - 1, "Title or separator")
-        elif re.match(r'^\s*---+', stripped_line):
-            logging.debug(f"Separator detected at line {index + 1}")
-            self._add_blank_lines(lines, len(lines), "Separator")
-            lines.append(line)
-            self._add_blank_lines(lines, len(lines) - 1, "Separator")
-        elif re.match(r'^\s*$', stripped_line):
-            logging.debug(f"Blank line detected at line {index + 1}")
-            lines.append(line)
+        if self._debug:
+            logging.debug(f"Current line: {stripped_line}")
+
+        if CODE_BLOCK_PATTERN.match(stripped_line):
+            self._handle_code_block(line, index)
+        elif LIST_OR_TABLE_PATTERN.match(stripped_line):
+            self._emit(line)
+        elif (TITLE_OR_SEPARATOR_PATTERN.match(stripped_line) or
+                SEPARATOR_PATTERN.match(stripped_line)):
+            if self._debug:
+                logging.debug(f"Title or separator detected at line {index + 1}")
+            self._add_blank_lines_before(index, "Title or separator")
+            self._emit(line)
+            self._emit('\n', inserted=True)
+        elif not stripped_line:
+            self._emit(line)
         else:
             if not self.in_code_block:
-                logging.debug(f"Paragraph detected at line {index + 1}")
-                self._add_blank_lines(lines, len(lines), "Paragraph")
-            lines.append(line)
+                self._add_blank_lines_before(index, "Paragraph")
+            self._emit(line)
 
-    def _handle_code_block(self, lines, line, index):
+    def _handle_code_block(self, line, index):
         """
         Handles the formatting of code blocks, ensuring blank lines before and after.
-        
+
         Args:
-            lines (list): The list of lines from the Markdown file.
             line (str): The current line being processed.
-            index (int): The index of the current line in the list.
+            index (int): The index of the current line in the input.
         """
         if not self.in_code_block:
-            logging.debug(f"Starting code block at line {index + 1}")
-            if len(lines) > 0 and not re.match(r'^\s*$', lines[-1].strip()):
-                lines.append('\n')
-                logging.debug(f"Added blank line before code block start at line {index + 1}")
-        lines.append(line)
+            if self._debug:
+                logging.debug(f"Starting code block at line {index + 1}")
+            if self._prev_not_blank:
+                self._emit('\n', inserted=True)
+        self._emit(line)
         if self.in_code_block:
-            logging.debug(f"Ending code block at line {index + 1}")
-            if index + 1 < len(lines) and not re.match(r'^\s*$', lines[index + 1].strip()):
-                lines.append('\n')
-                logging.debug(f"Added blank line after code block end at line {index + 1}")
+            if self._debug:
+                logging.debug(f"Ending code block at line {index + 1}")
+            # The blank line after a code block has always been decided by the
+            # output line at the position of the next input line, which is the
+            # oldest pending line as one is written for every input line plus the
+            # inserted ones. Keeping this keeps the output of existing documents.
+            self._drop_pending()
+            if self._inserted and self._pending[0]:
+                self._emit('\n', inserted=True)
         self.in_code_block = not self.in_code_block
 
-    def format(self):
+    def format_lines(self, lines, write):
         """
-        Formats the Markdown file by reading its content, processing it, and writing back the formatted content.
+        Formats Markdown lines from an iterator and writes the result to a writer.
+
+        Args:
+            lines (iterable): The lines of the Markdown document, with line endings.
+            write (callable): The function used to write the formatted text.
         """
-        with open(self.md_path, "r") as file:
-            lines = file.readlines()
+        self._reset(write)
+        for index, line in enumerate(lines):
+            self._process_line(line, index)
+            self._drop_pending()
+        self._out.close()
 
-        formatted_lines = []
-        for i, line in enumerate(lines):
-            self._process_line(formatted_lines, line, i)
+    def format_stream(self, input, output):
+        """
+        Formats Markdown read from a text stream and writes the result to a text stream.
 
-        # Remove redundant blank lines
-        formatted_lines = re.sub(r'\n{3,}', '\n\n', ''.join(formatted_lines)).splitlines(keepends=True)
-        
-        with open(self.md_path, "w") as file:
-            file.writelines(formatted_lines)
+        Args:
+            input: The text stream to read the Markdown document from.
+            output: The text stream the formatted document is written to.
+        """
+        MarkdownFormatter(self.md_path).format_lines(input, output.write)
+
+    def format_text(self, text):
+        """
+        Formats a Markdown document held in a string.
+
+        Args:
+            text (str): The Markdown document.
+
+        Returns:
+            str: The formatted document.
+        """
+        # Lines are split and their endings translated as when reading a file
+        output = io.StringIO()
+        MarkdownFormatter(self.md_path).format_lines(
+            io.StringIO(text, newline=None), output.write)
+        return output.getvalue()
+
+    def format(self):
+        """
+        Formats the Markdown file by streaming its content through the formatter into a
+        temporary file, which then replaces the original file once synced to disk.
+        """
+        if not self.md_path:
+            raise ValueError("Markdown path must be provided to format a file")
+        with open(self.md_path, "r") as rfile, \
+                utils.atomic_open(self.md_path, "w") as wfile:
+            self.format_stream(rfile, wfile)
 
 # Example usage:
 # formatter = MarkdownFormatter('path_to_markdown_file.md')
-# formatter.format()
\ No newline at end of file
+# formatter.format()
+#
+# formatted = MarkdownFormatter().format_text(text)
@@ -1,52 +1,187 @@
+import functools
+import io
 import logging
 import os
-import tempfile
-import shutil
-import pypandoc
+import subprocess
+import threading
+
+from yuque_tools.utils import docx_writer
+from yuque_tools.utils import metrics
+from yuque_tools.utils import utils
+
+# pandoc runs a pandoc process for each document, native writes documents
+# in-process and falls back to pandoc for markdown it does not support
+ENGINES = ("pandoc", "native")
+DEFAULT_ENGINE = "pandoc"
+STDIN_ENCODING = "utf-8"
+
+
+def pandoc_version():
+    """Return version of the pandoc used by pypandoc, None if not found"""
+    # Imported only when needed, it is slow to load
+    import pypandoc
+
+    try:
+        return pypandoc.get_pandoc_version()
+    except OSError as e:
+        logging.warning(f"Failed to get pandoc version: {str(e)}")
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def pandoc_path():
+    """Return path of the pandoc used by pypandoc, looked up once"""
+    # Imported only when converting, it is slow to load
+    import pypandoc
+
+    return pypandoc.get_pandoc_path()
+
+
+def convert_stream(chunks, output_path=None, resource_path=None,
+                   name=None):
+    """Convert markdown chunks to a docx with one pandoc process
+
+    Chunks are written to stdin of pandoc as they are produced, a document
+    made of many markdown files is never joined in memory or written to
+    a temp file. Each call runs its own pandoc process, calls from many
+    threads do not share any state.
+
+    Args:
+        chunks (iterable): Markdown text chunks
+        output_path (str, optional): Path the docx is written to, pandoc
+            writes it directly so it should be a temp path. The docx is
+            read from stdout of pandoc and returned if not provided.
+        resource_path (str, optional): Dir relative paths are resolved
+            against
+        name (str, optional): Name of the document in messages, output
+            path by default
+
+    Returns:
+        bytes: The docx if output_path is not provided, None otherwise
+
+    Raises:
+        RuntimeError: If pandoc fails
+    """
+    name = name or output_path
+    command = [pandoc_path(), "--from=markdown", "--to=docx",
+               f"--output={output_path or '-'}"]
+    if resource_path:
+        command.append(f"--resource-path={resource_path}")
+
+    process = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+        stdout=None if output_path else subprocess.PIPE)
+    # Warnings are drained by a thread, a full stderr pipe would block
+    # pandoc while chunks are still written
+    errors = []
+    stderr_reader = threading.Thread(
+        target=lambda: errors.append(process.stderr.read()),
+        name="pandoc-stderr", daemon=True)
+    stderr_reader.start()
+    output = None
+    try:
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk.encode(STDIN_ENCODING))
+            process.stdin.close()
+        except BrokenPipeError:
+            # pandoc exited early, its error is reported below
+            pass
+        # pandoc reads the whole input before it writes anything, so
+        # stdout is read after stdin is closed
+        if not output_path:
+            output = process.stdout.read()
+            process.stdout.close()
+    except BaseException:
+        process.kill()
+        process.wait()
+        stderr_reader.join()
+        raise
+    returncode = process.wait()
+    stderr_reader.join()
+    process.stderr.close()
+
+    message = b"".join(errors).decode(STDIN_ENCODING, "replace").strip()
+    if returncode != 0:
+        raise RuntimeError(f"Pandoc failed with code {returncode} to "
+                           f"convert {name}: {message}")
+    if message:
+        logging.warning(f"Pandoc warnings of {name}: {message}")
+    return output
 
 
 class MarkdownHandler:
     """A class to handle markdown file operations and conversions.
     
     This class provides functionality to handle markdown files, including loading 
-    content from files or strings and converting markdown to other formats like 
-    docx.
+    content from files, strings, bytes or streams and converting markdown to
+    other formats like docx.
+
+    Content is held in memory, a handler of a string never touches the disk:
+    it is piped through pandoc over stdin and stdout, or written by the
+    native engine. A handler is not changed once created, it could be
+    converted from many threads at once.
     """
 
-    def __init__(self, path=None, content=None):
+    def __init__(self, path=None, content=None, resource_path=None,
+                 name=None):
         """Initialize MarkdownHandler with either markdown file path or content.
         
         Args:
             path (str, optional): Path to markdown file to load
             content (str, optional): Raw markdown content string to use
+            resource_path (str, optional): Dir relative paths (e.g. for
+                images) are resolved against, the markdown file's directory
+                by default, or the current directory for content
+            name (str, optional): Name of the document in messages, path
+                by default
             
         Raises:
             ValueError: If neither path nor content is provided, or if both are 
                 provided simultaneously
         """
-        content_len = len(content) if content else 0
+        content_len = len(content) if content is not None else 0
         logging.debug(
             f"Initializing MarkdownHandler: path={path}, content_len={content_len}"
         )
         self._validate_inputs(path, content)
-        self._temp_file = None  # Temporary file path for content string
-        self._temp_dir = None   # Temporary directory for content string
-        
-        if content:
-            logging.debug("Creating temporary directory and file for content")
-            # Create temporary directory and file if content is provided
-            self._temp_dir = tempfile.mkdtemp()
-            self._temp_file = os.path.join(self._temp_dir, 'content.md')
-            with open(self._temp_file, 'w', encoding='utf-8') as f:
-                f.write(content)
-            self.path = self._temp_file
-            logging.debug(f"Created temp file: {self._temp_file}")
+        self.path = path
+        self.name = name or path or "markdown content"
+
+        if content is not None:
+            self.content = content
+            self.resource_path = resource_path
         else:
-            self.path = path
-            
-        self.content = self._load_content()
+            self.content = self._load_content()
+            self.resource_path = (resource_path or
+                                  os.path.dirname(os.path.abspath(path)))
         logging.debug(f"Loaded content, length: {len(self.content)}")
 
+    @classmethod
+    def from_bytes(cls, data, encoding="utf-8", **kwargs):
+        """Create a handler of markdown bytes, e.g. an uploaded file
+
+        Args:
+            data (bytes): Encoded markdown content
+            encoding (str): Encoding of data
+            **kwargs: resource_path and name, see __init__
+        """
+        return cls(content=data.decode(encoding), **kwargs)
+
+    @classmethod
+    def from_stream(cls, stream, encoding="utf-8", **kwargs):
+        """Create a handler of a text or binary stream, read to its end
+
+        Args:
+            stream: File object of markdown content
+            encoding (str): Encoding of a binary stream
+            **kwargs: resource_path and name, see __init__
+        """
+        data = stream.read()
+        if isinstance(data, bytes):
+            return cls.from_bytes(data, encoding=encoding, **kwargs)
+        return cls(content=data, **kwargs)
+
     def _validate_inputs(self, path, content):
         """Validate the initialization input parameters.
         
@@ -60,10 +195,11 @@ class MarkdownHandler:
             ValueError: If both inputs are provided or if neither is provided
         """
         logging.debug("Validating input parameters")
-        if path and content:
+        # Empty content is still content, e.g. an empty markdown file
+        if path and content is not None:
             logging.error("Both path and content provided")
             raise ValueError("Cannot provide both path and content")
-        if not path and not content:
+        if not path and content is None:
             logging.error("Neither path nor content provided")
             raise ValueError("Must provide either path or content")
 
@@ -85,14 +221,86 @@ class MarkdownHandler:
             logging.error(f"Failed to read {self.path}: {str(e)}")
             raise
 
-    def to_docx(self, output_path):
+    def _write_native(self, output, engine):
+        """Write the document with the native engine if it is selected.
+
+        Args:
+            output: Path or binary file object the document is written to
+            engine (str): One of ENGINES
+
+        Returns:
+            bool: True if written, False if it should be converted by pandoc
+        """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine}")
+        if engine != "native":
+            return False
+
+        try:
+            docx_writer.write_docx(
+                self.content, output, resource_path=self.resource_path)
+            return True
+        except docx_writer.UnsupportedMarkdown as e:
+            logging.info(f"Converting {self.name} with pandoc, "
+                         f"native engine does not support {e}")
+            metrics.add("native_fallbacks")
+            return False
+
+    def to_docx_bytes(self, engine=DEFAULT_ENGINE):
+        """Convert markdown to a docx document returned as bytes.
+
+        Nothing is written to disk, pandoc reads the markdown from stdin
+        and writes the document to stdout.
+
+        Args:
+            engine (str): One of ENGINES
+
+        Returns:
+            bytes: The docx document
+
+        Raises:
+            ValueError: If engine is unknown
+            RuntimeError: If pandoc conversion fails
+        """
+        output = io.BytesIO()
+        if self._write_native(output, engine):
+            return output.getvalue()
+        return convert_stream([self.content],
+                              resource_path=self.resource_path,
+                              name=self.name)
+
+    def write_docx(self, stream, engine=DEFAULT_ENGINE):
+        """Convert markdown to docx written to a binary stream.
+
+        The native engine writes to the stream directly, a document
+        converted by pandoc is written once pandoc succeeded, so nothing is
+        written if the conversion fails.
+
+        Args:
+            stream: Binary file object, e.g. a response body
+            engine (str): One of ENGINES
+
+        Raises:
+            ValueError: If engine is unknown
+            RuntimeError: If pandoc conversion fails
+        """
+        if not self._write_native(stream, engine):
+            stream.write(convert_stream([self.content],
+                                        resource_path=self.resource_path,
+                                        name=self.name))
+
+    def to_docx(self, output_path, engine=DEFAULT_ENGINE):
         """Convert markdown to docx format.
         
         Converts the markdown content to a Word document using pandoc.
-        Changes working directory during conversion to handle relative paths.
+        The markdown file's directory is passed to pandoc as resource path
+        to handle relative paths, so the working directory of the process
+        is never changed and conversions can run in parallel.
         
         Args:
             output_path (str): Path where the docx file should be saved
+            engine (str): One of ENGINES, the native engine converts
+                without pandoc if it supports all syntax of the markdown
         
         Returns:
             None
@@ -103,46 +311,19 @@ class MarkdownHandler:
         """
         if not output_path:
             raise ValueError("Output path must be provided")
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine}")
 
-        # Save current working directory
-        original_cwd = os.getcwd()
-        
-        try:
-            # Change to markdown file's directory before conversion
-            # This ensures relative paths (e.g. for images) work correctly
-            os.chdir(os.path.dirname(self.path))
-            
-            # Convert markdown to docx using pandoc
-            logging.info(
-                f"Converting markdown file to Word document {output_path}"
-            )
-            pypandoc.convert_file(
-                self.path,
-                "docx", 
-                outputfile=output_path
-            )
-            logging.info("Successfully converted markdown to Word document")
-            
-        finally:
-            # Restore original working directory
-            os.chdir(original_cwd)
-
-    def __del__(self):
-        """Cleanup temporary files and directories on object destruction.
-        
-        Removes any temporary files and directories created for content string 
-        handling. Silently ignores any errors during cleanup.
-        """
-        if self._temp_file and os.path.exists(self._temp_file):
-            try:
-                logging.debug(f"Removing temp file: {self._temp_file}")
-                os.unlink(self._temp_file)
-            except (OSError, AttributeError) as e:
-                logging.warning(f"Failed to remove temp file: {str(e)}")
-                
-        if self._temp_dir and os.path.exists(self._temp_dir):
-            try:
-                logging.debug(f"Removing temp dir: {self._temp_dir}")
-                shutil.rmtree(self._temp_dir)
-            except (OSError, AttributeError) as e:
-                logging.warning(f"Failed to remove temp directory: {str(e)}")
+        logging.info(
+            f"Converting markdown file to Word document {output_path}"
+        )
+        # A temp file is written, an interrupted run never leaves a broken
+        # document
+        with utils.atomic_path(output_path) as tmp_path:
+            if not self._write_native(tmp_path, engine):
+                # Loaded content is piped to pandoc instead of the path,
+                # brackets in file names are never taken as patterns
+                convert_stream([self.content], tmp_path,
+                               resource_path=self.resource_path,
+                               name=self.name)
+        logging.info("Successfully converted markdown to Word document")
@@ -0,0 +1,286 @@
+import collections
+import contextlib
+import csv
+import io
+import json
+import logging
+import math
+import threading
+import time
+
+from yuque_tools.utils import utils
+
+DEFAULT_PROFILE_PATH = "yuque-tools.prof"
+PROFILE_TOP = 30
+SAMPLE_FIELDS = ("stage", "item", "type", "seconds", "bytes")
+# Samples kept for the report, older ones are dropped in long runs
+MAX_SAMPLES = 100000
+# Recent samples of each stage percentiles are taken over
+PERCENTILE_WINDOW = 10000
+
+
+class Metrics(object):
+    """Thread-safe timings of stages of a run
+
+    Each sample is the time one item, e.g. an image or a markdown file,
+    spent in a stage. Stages are summed up as samples are recorded, the
+    samples themselves are only kept for reports, at most MAX_SAMPLES of
+    them so a long watch run does not grow. Percentiles are taken over the
+    last PERCENTILE_WINDOW samples of each stage. Counters sum up anything
+    else, like bytes downloaded.
+    """
+
+    def __init__(self, keep_samples=False):
+        self._lock = threading.Lock()
+        self.reset(keep_samples)
+
+    def reset(self, keep_samples=None):
+        """Clear all samples and counters
+
+        Args:
+            keep_samples (bool, optional): Keep each sample for the report,
+                unchanged if not given
+        """
+        with self._lock:
+            if keep_samples is not None:
+                self.keep_samples = keep_samples
+            self.samples = collections.deque(maxlen=MAX_SAMPLES)
+            self.stages = {}
+            self.counters = {}
+            self.started = time.perf_counter()
+
+    def record(self, stage, seconds, item=None, kind=None, size=None):
+        """Record seconds an item spent in a stage
+
+        Args:
+            stage (str): Name of the stage, e.g. fetch or convert
+            seconds (float): Seconds the item spent in the stage
+            item (str, optional): Url or path of the item
+            kind (str, optional): Type of the item, e.g. image format
+            size (int, optional): Bytes of the item
+        """
+        with self._lock:
+            stats = self.stages.get(stage)
+            if not stats:
+                stats = self.stages[stage] = _StageStats()
+            stats.add(seconds, size)
+            if kind:
+                type_stats = stats.by_type.get(kind)
+                if not type_stats:
+                    type_stats = stats.by_type[kind] = _StageStats()
+                type_stats.add(seconds, size)
+
+            if self.keep_samples:
+                self.samples.append({
+                    "stage": stage, "item": item, "type": kind,
+                    "seconds": seconds, "bytes": size})
+
+    def add(self, name, value=1):
+        """Add value to a counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, stage, item=None, kind=None):
+        """Record time of the block as a sample of stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started,
+                        item=item, kind=kind)
+
+    def summary(self):
+        """Return count, total, p50, p95 and max seconds of each stage
+
+        Stages with typed samples, e.g. conversions of each image format,
+        are also summarized by type.
+        """
+        with self._lock:
+            summary = {}
+            for stage, stats in self.stages.items():
+                summary[stage] = stats.summarize()
+                if stats.by_type:
+                    summary[stage]["by_type"] = {
+                        name: type_stats.summarize()
+                        for name, type_stats in sorted(
+                            stats.by_type.items())}
+            return summary
+
+    def report(self, tool=None):
+        """Return the report of the run as a dict"""
+        wall_seconds = time.perf_counter() - self.started
+        summary = self.summary()
+        with self._lock:
+            counters = dict(self.counters)
+            samples = list(self.samples)
+
+        fetch = summary.get("fetch", {})
+        if "image_bytes_before" in counters:
+            counters["image_bytes_saved"] = (
+                counters["image_bytes_before"] -
+                counters["image_bytes_after"])
+        return {
+            "tool": tool,
+            "wall_seconds": round(wall_seconds, 6),
+            "counters": counters,
+            "throughput": {
+                "images_per_second": _rate(fetch.get("count", 0),
+                                           wall_seconds),
+                "bytes_per_second": _rate(fetch.get("bytes", 0),
+                                          wall_seconds),
+            },
+            "stages": summary,
+            "samples": samples,
+        }
+
+    def save(self, path, tool=None):
+        """Save the report as CSV of samples if path ends with .csv, or
+        as JSON otherwise
+        """
+        if path.lower().endswith(".csv"):
+            with self._lock:
+                samples = list(self.samples)
+            with utils.atomic_open(path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=SAMPLE_FIELDS)
+                writer.writeheader()
+                writer.writerows(samples)
+        else:
+            with utils.atomic_open(path, "w") as f:
+                json.dump(self.report(tool), f, indent=2, ensure_ascii=False)
+        logging.info(f"Saved metrics report to {path}")
+
+    def log_summary(self):
+        for stage, stats in self.summary().items():
+            logging.info(f"Stage {stage}: {_format_stats(stats)}")
+            for name, type_stats in stats.get("by_type", {}).items():
+                logging.info(f"Stage {stage} [{name}]: "
+                             f"{_format_stats(type_stats)}")
+        with self._lock:
+            before = self.counters.get("image_bytes_before")
+            after = self.counters.get("image_bytes_after")
+        if before:
+            logging.info(f"Encoded images from {before} bytes to {after} "
+                         f"bytes, saved {before - after} bytes "
+                         f"({(before - after) / before:.1%})")
+        logging.info(f"Finished in "
+                     f"{time.perf_counter() - self.started:.3f}s")
+
+
+class _StageStats(object):
+    """Running count, total, max and bytes of the samples of a stage"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes = None
+        self.window = collections.deque(maxlen=PERCENTILE_WINDOW)
+        self.by_type = {}
+
+    def add(self, seconds, size=None):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if size is not None:
+            self.bytes = (self.bytes or 0) + size
+        self.window.append(seconds)
+
+    def summarize(self):
+        values = sorted(self.window)
+        stats = {
+            "count": self.count,
+            "total": round(self.total, 6),
+            "p50": round(_percentile(values, 50), 6),
+            "p95": round(_percentile(values, 95), 6),
+            "max": round(self.max, 6),
+        }
+        if self.bytes is not None:
+            stats["bytes"] = self.bytes
+        return stats
+
+
+def _percentile(values, percent):
+    # Nearest rank of sorted values
+    rank = max(1, math.ceil(percent / 100 * len(values)))
+    return values[rank - 1]
+
+
+def _rate(value, seconds):
+    return round(value / seconds, 2) if seconds else None
+
+
+def _format_stats(stats):
+    text = (f"count={stats['count']} total={stats['total']:.3f}s "
+            f"p50={stats['p50']:.3f}s p95={stats['p95']:.3f}s "
+            f"max={stats['max']:.3f}s")
+    if "bytes" in stats:
+        text += f" bytes={stats['bytes']}"
+    return text
+
+
+# Metrics of this process, shared by all modules like the root logger
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def record(stage, seconds, item=None, kind=None, size=None):
+    _metrics.record(stage, seconds, item=item, kind=kind, size=size)
+
+
+def add(name, value=1):
+    _metrics.add(name, value)
+
+
+def timer(stage, item=None, kind=None):
+    return _metrics.timer(stage, item=item, kind=kind)
+
+
+def call_timed(func, *args, **kwargs):
+    """Call func and return its result with seconds taken
+
+    Metrics of a worker process are not seen by the main one, so functions
+    run in process pools are called through this and the caller records
+    the seconds.
+    """
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+@contextlib.contextmanager
+def measure_run(tool, report_path=None, profile_path=None):
+    """Measure a whole run of a tool
+
+    A summary of stages is logged at the end, the report is saved to
+    report_path and cProfile stats of the main thread to profile_path
+    if they are given. The report is saved even if the run fails.
+    """
+    # Samples are only kept when they are saved or profiled
+    _metrics.reset(keep_samples=bool(report_path or profile_path))
+    profiler = None
+    if profile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        yield _metrics
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            import pstats
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats(
+                "cumulative").print_stats(PROFILE_TOP)
+            logging.info(f"Saved profile to {profile_path}, top "
+                         f"{PROFILE_TOP} functions by cumulative time:\n"
+                         f"{output.getvalue()}")
+
+        _metrics.log_summary()
+        if report_path:
+            _metrics.save(report_path, tool)
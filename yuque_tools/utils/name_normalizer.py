@@ -0,0 +1,117 @@
+import logging
+import os
+
+from yuque_tools.utils import utils
+
+
+class RenamePlan(object):
+    """Renames normalizing every path component of files in a tree
+
+    Each directory and file is planned once however many files are under
+    it. Components normalized to a name taken by a sibling, or by an entry
+    on disk which is not planned, keep their original name. Renames are
+    applied bottom-up, so the parent of each entry still has its original
+    name when the entry is renamed.
+    """
+
+    def __init__(self, root_dir, paths, normalize=utils.normalize_name):
+        """Plan renames of files under root_dir
+
+        Args:
+            root_dir (str): Root of the tree, it is never renamed
+            paths (list): Paths of files under root_dir
+            normalize (callable): Returns normalized name of a component
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        self.paths = list(paths)
+        self.normalize = normalize
+        self.collisions = []
+        self._failed = set()
+
+        # Components are keyed by the tuple of original names from root
+        self._keys = {path: self._key(path) for path in self.paths}
+        children = {}
+        for key in self._keys.values():
+            for depth in range(1, len(key) + 1):
+                children.setdefault(key[:depth - 1], set()).add(
+                    key[depth - 1])
+
+        self._names = {}
+        for parent, names in children.items():
+            self._plan_dir(parent, names)
+
+    def _key(self, path):
+        return tuple(os.path.relpath(
+            os.path.abspath(path), self.root_dir).split(os.sep))
+
+    def _plan_dir(self, parent, names):
+        targets = {}
+        for name in names:
+            targets.setdefault(self.normalize(name), []).append(name)
+
+        parent_path = os.path.join(self.root_dir, *parent)
+        for target, sources in targets.items():
+            for name in sources:
+                if name == target:
+                    continue
+
+                if len(sources) > 1:
+                    others = [other for other in sources if other != name]
+                    self._collide(parent_path, name, target,
+                                  f"also the name of {', '.join(others)}")
+                elif os.path.lexists(os.path.join(parent_path, target)):
+                    self._collide(parent_path, name, target,
+                                  "it already exists")
+                else:
+                    self._names[parent + (name,)] = target
+
+    def _collide(self, parent_path, name, target, reason):
+        logging.warning(f"Not renaming {os.path.join(parent_path, name)} "
+                        f"to {target}, {reason}")
+        self.collisions.append((os.path.join(parent_path, name),
+                                os.path.join(parent_path, target)))
+
+    @property
+    def renames(self):
+        """(old path, new path) of each rename, deepest first
+
+        The parent of old path is the original one, as parents are renamed
+        after their children.
+        """
+        keys = sorted(self._names, key=len, reverse=True)
+        return [(os.path.join(self.root_dir, *key),
+                 os.path.join(self.root_dir, *key[:-1], self._names[key]))
+                for key in keys if key not in self._failed]
+
+    def _new_path(self, key):
+        parts = []
+        for depth in range(1, len(key) + 1):
+            prefix = key[:depth]
+            if prefix in self._names and prefix not in self._failed:
+                parts.append(self._names[prefix])
+            else:
+                parts.append(key[depth - 1])
+        return os.path.join(self.root_dir, *parts)
+
+    def path_map(self):
+        """Return the new path of each planned file by its original path"""
+        return {path: self._new_path(key) for path, key in self._keys.items()}
+
+    def apply(self):
+        """Rename all planned components in one pass
+
+        A component failed to rename keeps its original name, renames of
+        its children and parents are still applied.
+
+        Returns:
+            dict: New path of each planned file by its original path
+        """
+        for old_path, new_path in self.renames:
+            try:
+                os.rename(old_path, new_path)
+                logging.debug(f"Renamed {old_path} to {new_path}")
+            except OSError as e:
+                logging.error(f"Failed to rename {old_path} to {new_path}: "
+                              f"{str(e)}")
+                self._failed.add(self._key(old_path))
+        return self.path_map()
@@ -1,13 +1,24 @@
-import glob
+import contextlib
+import fnmatch
+import hashlib
 import logging
 import os
+import shutil
+import signal
+import tempfile
 
 # Log settings
 DEFAULT_PATH = "logs"
 LOG_FORMAT = "%(asctime)s %(process)s %(levelname)s [-] (%(threadName)-9s) %(message)s"
 
-# Backup
-DEFAULT_BACKUP_PATH = ".bak"
+# Images, backups, outputs of previous runs and hidden files
+DEFAULT_PRUNE_PATTERNS = ("_images", "*.bak", "*.converted", ".*")
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Read once, changing umask is not thread-safe
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 
 def init_logging(debug=False, verbose=True,
@@ -48,6 +59,26 @@ def init_logging(debug=False, verbose=True,
         logger.addHandler(fileout)
 
 
+def init_worker(debug=False, verbose=True):
+    """Initialize a worker process of a pool
+
+    Only the main process handles Ctrl-C, so an interrupted run could stop
+    its pools and keep its journal.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_logging(debug=debug, verbose=verbose)
+
+
+def cancel_futures(futures):
+    """Cancel futures which are not started yet
+
+    Like Executor.shutdown(cancel_futures=True), which is only available
+    from Python 3.9. Running futures are left to finish.
+    """
+    for future in futures:
+        future.cancel()
+
+
 def get_proxies(kwargs={}):
     """Return proxies dict with http proxy and https proxy"""
     http_proxy = kwargs.get("http_proxy",
@@ -60,28 +91,176 @@ def get_proxies(kwargs={}):
         "https_proxy": https_proxy
     }
 
-def backup(source_dir):
-    """Backup source dir to backup dir"""
-    src_filename = os.path.basename(src_dir)
-    src_full_path = os.path.abspath(src_dir)
+def find_md_files(search_path, ext_name="md", **kwargs):
+    """Return all markdown files under search_path, see iter_md_files"""
+    return list(iter_md_files(search_path, ext_name=ext_name, **kwargs))
 
-    backup_filename = "%s%s" % (src_filename, DEFAULT_BACKUP_PATH)
-    backup_full_path = os.path.join(
-        os.path.dirname(src_full_path), backup_filename)
 
-    if os.path.exists(backup_full_path):
-        logging.warning(f"Removing backup dir {backup_full_path}")
-        shutil.rmtree(backup_full_path)
-        logging.info(f"Removed backup dir {backup_full_path}")
+def iter_md_files(search_path, ext_name="md", include=None, exclude=None,
+                  prune=DEFAULT_PRUNE_PATTERNS):
+    """Yield markdown files under search_path as soon as they are found
 
-    logging.info(f"Backuping {src_full_path} to {backup_full_path}...")
-    shutil.copytree(src_full_path, backup_full_path)
-    logging.info(f"Success to backup {src_full_path} to {backup_full_path}.")
+    The tree is walked with os.scandir, so processing could start before
+    the walk finishes. Directories matching prune patterns, e.g. images
+    and backups left by previous runs, are never entered.
 
-def find_md_files(search_path, ext_name="md"):
+    Args:
+        search_path (str): Root of the markdown tree
+        ext_name (str): Extension of markdown files
+        include (list, optional): Patterns of relative paths to include,
+            all files are included if not provided
+        exclude (list, optional): Patterns of relative paths of files and
+            directories to exclude
+        prune (tuple): Patterns of file and directory names to skip
+    """
     logging.info(f"Searching markdown files in {search_path}")
-    search_pattern = "*.%s" % ext_name
-    md_files = glob.glob(
-        os.path.join(search_path, "**", search_pattern),
-        recursive=True)
-    return md_files
\ No newline at end of file
+    suffix = ".%s" % ext_name
+
+    dirs = [search_path]
+    while dirs:
+        dir_path = dirs.pop()
+        try:
+            entries = os.scandir(dir_path)
+        except OSError as e:
+            logging.warning(f"Failed to scan {dir_path}: {str(e)}")
+            continue
+
+        sub_dirs = []
+        with entries:
+            for entry in entries:
+                if _match_any(entry.name, prune):
+                    continue
+
+                rel_path = os.path.relpath(entry.path, search_path)
+                rel_path = rel_path.replace(os.sep, "/")
+                if exclude and _match_any(rel_path, exclude):
+                    continue
+
+                if entry.is_dir():
+                    sub_dirs.append(entry.path)
+                elif entry.name.endswith(suffix) and entry.is_file():
+                    if include and not _match_any(rel_path, include):
+                        continue
+                    yield entry.path
+
+        # Walk sub directories in the order they are found
+        dirs.extend(reversed(sub_dirs))
+
+
+def is_md_path(rel_path, ext_name="md", include=None, exclude=None,
+               prune=DEFAULT_PRUNE_PATTERNS):
+    """Return True if iter_md_files would yield a file of rel_path
+
+    For files which are not walked on disk, e.g. members of an archive.
+    Arguments are the same as iter_md_files, rel_path is separated by /.
+    """
+    if not rel_path.endswith(".%s" % ext_name):
+        return False
+    if is_pruned_path(rel_path, exclude=exclude, prune=prune):
+        return False
+    return not include or _match_any(rel_path, include)
+
+
+def is_pruned_path(rel_path, exclude=None, prune=DEFAULT_PRUNE_PATTERNS):
+    """Return True if iter_md_files would skip rel_path or a dir above it
+
+    Arguments are the same as iter_md_files, rel_path is separated by /.
+    """
+    parts = rel_path.split("/")
+    if any(_match_any(part, prune) for part in parts):
+        return True
+    return bool(exclude) and any(
+        _match_any("/".join(parts[:depth]), exclude)
+        for depth in range(1, len(parts) + 1))
+
+
+def _match_any(name, patterns):
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def file_sha256(path):
+    """Return SHA-256 hex digest of a file"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_version():
+    """Return version of installed yuque-tools, unknown if not installed"""
+    from importlib import metadata
+
+    try:
+        return metadata.version("yuque-tools")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def normalize_name(name):
+    """Replace brackets with parentheses and remove spaces in a file name"""
+    name = name.replace('［', '(').replace('］', ')')  # Full-width
+    name = name.replace('[', '(').replace(']', ')')  # Half-width
+    return name.replace(' ', '')
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode="w", **kwargs):
+    """Open a temp file next to path, which replaces path once closed
+
+    The file at path is either the old one or the completely written new
+    one, even if the process or the machine crashes: the temp file is
+    synced to disk before it is renamed over path, and the directory is
+    synced after. The temp file is removed if anything fails while writing.
+    """
+    with atomic_path(path, suffix=".tmp") as tmp_path:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+
+
+@contextlib.contextmanager
+def atomic_path(path, suffix=None):
+    """Return a temp path next to path, which replaces path once done
+
+    For writers which take a path instead of a file, e.g. pandoc. The temp
+    path keeps the extension of path unless suffix is given.
+
+    Yields:
+        str: Temp path to write the new file to
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    if suffix is None:
+        suffix = ".tmp" + os.path.splitext(path)[1]
+    fd, tmp_path = tempfile.mkstemp(
+        dir=dirname, prefix=".%s." % os.path.basename(path), suffix=suffix)
+    os.close(fd)
+    try:
+        yield tmp_path
+        fsync_file(tmp_path)
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        else:
+            os.chmod(tmp_path, 0o666 & ~UMASK)
+        os.replace(tmp_path, path)
+        fsync_file(dirname)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def fsync_file(path):
+    """Flush a file or a directory to disk, as far as the OS supports it"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        logging.debug(f"Failed to open {path} to sync: {str(e)}")
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        # Directories could not be synced on some platforms
+        logging.debug(f"Failed to sync {path}: {str(e)}")
+    finally:
+        os.close(fd)
@@ -0,0 +1,452 @@
+import collections
+import errno
+import json
+import logging
+import os
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from yuque_tools.utils import utils
+
+DEFAULT_DEBOUNCE = 2.0
+# A file written again and again is still processed after this many
+# debounce periods
+MAX_DEBOUNCE_PERIODS = 10
+MAX_ERRORS = 20
+READ_SIZE = 64 * 1024
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+# Files are taken once closed or moved in, not on every write
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyBackend(object):
+    """Changes of a tree reported by Linux inotify
+
+    Every directory of the tree is watched, directories created or moved
+    into the tree are watched and scanned as they appear. If the kernel
+    queue overflows, the whole tree is scanned again.
+    """
+
+    name = "inotify"
+
+    def __init__(self, root, is_md, is_watched_dir):
+        # Only loaded in watch mode
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._get_errno = ctypes.get_errno
+        self._add_watch = libc.inotify_add_watch
+        self._rm_watch = libc.inotify_rm_watch
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            error = self._get_errno()
+            raise OSError(error, os.strerror(error))
+
+        self.root = root
+        self._fd = fd
+        self._is_md = is_md
+        self._is_watched_dir = is_watched_dir
+        self._paths = {}
+        try:
+            for dir_path, _ in _walk(root, is_watched_dir):
+                self._watch(dir_path)
+        except BaseException:
+            self.close()
+            raise
+        logging.info(f"Watching {len(self._paths)} dirs of {root} with "
+                     f"inotify")
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _watch(self, dir_path):
+        wd = self._add_watch(self._fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            error = self._get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                # Removed before it was watched
+                return
+            raise OSError(error, f"Failed to watch {dir_path}: "
+                                 f"{os.strerror(error)}")
+        self._paths[wd] = dir_path
+
+    def _unwatch_tree(self, dir_path):
+        prefix = dir_path + os.sep
+        for wd, path in list(self._paths.items()):
+            if path == dir_path or path.startswith(prefix):
+                self._rm_watch(self._fd, wd)
+                del self._paths[wd]
+
+    def _scan(self, dir_path):
+        # Files in a new dir might be written before it is watched
+        changed = []
+        for path, entries in _walk(dir_path, self._is_watched_dir):
+            self._watch(path)
+            changed.extend(entry.path for entry in entries
+                           if entry.is_file() and self._is_md(entry.path))
+        return changed
+
+    def read(self, timeout):
+        """Return markdown files changed, waiting at most timeout seconds"""
+        ready, _, _ = select.select([self._fd], [], [], max(timeout, 0))
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        changed = []
+        position = 0
+        while position + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, position)
+            position += EVENT_HEADER.size
+            name = os.fsdecode(data[position:position + length].rstrip(b"\0"))
+            position += length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warning(f"Too many changes of {self.root}, scanning "
+                                f"the whole tree")
+                self._unwatch_tree(self.root)
+                changed.extend(self._scan(self.root))
+                continue
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+
+            dir_path = self._paths.get(wd)
+            if dir_path is None or not name:
+                continue
+            path = os.path.join(dir_path, name)
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self._unwatch_tree(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO) and \
+                        self._is_watched_dir(path):
+                    changed.extend(self._scan(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and self._is_md(path):
+                changed.append(path)
+        return changed
+
+
+class PollingBackend(object):
+    """Changes of a tree found by comparing size and mtime of files
+
+    For systems without inotify and network file systems, whose changes
+    from other hosts are not reported by inotify. Each poll walks the
+    whole tree, but only stats the files.
+    """
+
+    name = "polling"
+
+    def __init__(self, root, is_md, is_watched_dir, interval=DEFAULT_DEBOUNCE):
+        self.root = root
+        self.interval = interval
+        self._is_md = is_md
+        self._is_watched_dir = is_watched_dir
+        self._stats = self._stat_tree()
+        self._next_poll = time.monotonic() + interval
+        logging.info(f"Watching {root} by polling every {interval} seconds")
+
+    def close(self):
+        pass
+
+    def _stat_tree(self):
+        stats = {}
+        for _, entries in _walk(self.root, self._is_watched_dir):
+            for entry in entries:
+                if not entry.is_file() or not self._is_md(entry.path):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                stats[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return stats
+
+    def read(self, timeout):
+        """Return markdown files changed, waiting at most timeout seconds"""
+        delay = self._next_poll - time.monotonic()
+        if delay > timeout:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(delay, 0))
+
+        stats = self._stat_tree()
+        changed = [path for path, stat in stats.items()
+                   if self._stats.get(path) != stat]
+        self._stats = stats
+        self._next_poll = time.monotonic() + self.interval
+        return changed
+
+
+def _walk(root, is_watched_dir):
+    # (dir path, entries) of each dir under root which is watched
+    dirs = [root]
+    while dirs:
+        dir_path = dirs.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except OSError as e:
+            logging.debug(f"Failed to scan {dir_path}: {str(e)}")
+            continue
+
+        yield dir_path, entries
+        dirs.extend(entry.path for entry in entries
+                    if entry.is_dir(follow_symlinks=False) and
+                    is_watched_dir(entry.path))
+
+
+class TreeWatcher(object):
+    """Markdown files of a tree created or modified, debounced
+
+    A file is reported once it has not changed for debounce seconds, so a
+    burst of writes, e.g. an export being unpacked or an editor saving
+    several times, is processed once. Filters are the same as
+    utils.iter_md_files.
+    """
+
+    def __init__(self, root, debounce=DEFAULT_DEBOUNCE, include=None,
+                 exclude=None, prune=utils.DEFAULT_PRUNE_PATTERNS,
+                 ext_name="md", polling=False):
+        """Start watching a markdown tree
+
+        Args:
+            root (str): Root of the markdown tree
+            debounce (float): Seconds a file must stay unchanged
+            include (list, optional): Patterns of relative paths to include
+            exclude (list, optional): Patterns of relative paths to exclude
+            prune (tuple): Patterns of file and directory names to skip
+            ext_name (str): Extension of markdown files
+            polling (bool): Poll the tree even if inotify is available
+        """
+        self.root = os.path.abspath(root)
+        self.debounce = debounce
+        self.include = include
+        self.exclude = exclude
+        self.prune = prune
+        self.ext_name = ext_name
+        self._lock = threading.Lock()
+        # Path: (first change, last change)
+        self._changes = {}
+
+        self.backend = None
+        if not polling:
+            try:
+                self.backend = InotifyBackend(
+                    self.root, self.is_md, self.is_watched_dir)
+            except (AttributeError, OSError) as e:
+                logging.warning(f"inotify is not available, polling "
+                                f"instead: {str(e)}")
+        if self.backend is None:
+            self.backend = PollingBackend(
+                self.root, self.is_md, self.is_watched_dir, debounce)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.backend.close()
+
+    def _rel_path(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def is_md(self, path):
+        return utils.is_md_path(
+            self._rel_path(path), ext_name=self.ext_name,
+            include=self.include, exclude=self.exclude, prune=self.prune)
+
+    def is_watched_dir(self, path):
+        return not utils.is_pruned_path(
+            self._rel_path(path), exclude=self.exclude, prune=self.prune)
+
+    @property
+    def pending(self):
+        """Number of changed files waiting for the debounce period"""
+        with self._lock:
+            return len(self._changes)
+
+    def _deadline(self, changed):
+        first, last = changed
+        return min(last + self.debounce,
+                   first + self.debounce * MAX_DEBOUNCE_PERIODS)
+
+    def wait(self, timeout):
+        """Return changed files which settled, waiting at most timeout
+
+        Returns:
+            list: Paths of the files, empty if none settled in time
+        """
+        end = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                ready = sorted(path for path, changed in self._changes.items()
+                               if self._deadline(changed) <= now)
+                for path in ready:
+                    del self._changes[path]
+                next_deadline = min(
+                    (self._deadline(changed)
+                     for changed in self._changes.values()), default=end)
+            if ready or now >= end:
+                return ready
+
+            for path in self.backend.read(min(next_deadline, end) - now):
+                now = time.monotonic()
+                with self._lock:
+                    first, _ = self._changes.get(path, (now, now))
+                    self._changes[path] = (first, now)
+
+
+class WatchStatus(object):
+    """Thread-safe state of a watch daemon reported by the control socket"""
+
+    def __init__(self, watcher, counters=None):
+        """Track the documents of a watcher
+
+        Args:
+            watcher (TreeWatcher): Watcher of the tree
+            counters (StageCounters, optional): Counters of the image
+                pipeline, reported with the documents
+        """
+        self.watcher = watcher
+        self.counters = counters
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._processing = set()
+        self._done = 0
+        self._failed = 0
+        self._errors = collections.deque(maxlen=MAX_ERRORS)
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def stop(self):
+        """Ask the daemon to stop after the current documents"""
+        self._stop.set()
+
+    def start_batch(self, md_files):
+        with self._lock:
+            self._processing.update(md_files)
+
+    def doc_done(self, md_file):
+        with self._lock:
+            self._processing.discard(md_file)
+            self._done += 1
+
+    def doc_failed(self, md_file, error):
+        with self._lock:
+            self._processing.discard(md_file)
+            self._failed += 1
+            self._errors.append({"time": time.time(), "file": md_file,
+                                 "error": error})
+
+    def snapshot(self):
+        """Return the state as a dict of JSON types"""
+        with self._lock:
+            status = {
+                "root": self.watcher.root,
+                "backend": self.watcher.backend.name,
+                "uptime": round(time.time() - self.started, 3),
+                "stopping": self.stopped,
+                "pending": self.watcher.pending,
+                "processing": len(self._processing),
+                "done": self._done,
+                "failed": self._failed,
+                "errors": list(self._errors),
+            }
+        if self.counters:
+            status["images"] = self.counters.snapshot()
+        return status
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        command = self.rfile.readline().decode("utf-8", "replace").strip()
+        status = self.server.status
+        if command in ("", "status"):
+            reply = status.snapshot()
+        elif command == "stop":
+            logging.info("Stop requested by the control socket")
+            status.stop()
+            reply = {"stopping": True}
+        else:
+            reply = {"error": f"Unknown command {command}"}
+        self.wfile.write(
+            (json.dumps(reply, ensure_ascii=False) + "\n").encode("utf-8"))
+
+
+class _ControlServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ControlServer(object):
+    """Unix socket answering commands to a watch daemon
+
+    A client sends one line, status or stop, and reads one line of JSON:
+    the WatchStatus snapshot, or the acknowledgment of the stop.
+    """
+
+    def __init__(self, path, status):
+        self.path = os.path.abspath(path)
+        self.status = status
+        self._remove_stale()
+        self._server = _ControlServer(self.path, _ControlHandler)
+        self._server.status = status
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="control", daemon=True)
+
+    def _remove_stale(self):
+        if not os.path.exists(self.path):
+            return
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.path)
+        except OSError:
+            # Left by a daemon which did not stop cleanly
+            os.remove(self.path)
+        else:
+            raise RuntimeError(f"Another watcher is listening on {self.path}")
+        finally:
+            client.close()
+
+    def __enter__(self):
+        self._thread.start()
+        logging.info(f"Control socket listening on {self.path}")
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -14,14 +14,33 @@
 
 
 import argparse
+import concurrent.futures
+import contextlib
 import logging
 import os
+import posixpath
+import shutil
 import sys
+import tempfile
 
+from yuque_tools.utils import archive
+from yuque_tools.utils import backup
+from yuque_tools.utils import http_client
+from yuque_tools.utils import image_converter
+from yuque_tools.utils import image_scanner
+from yuque_tools.utils import journal as run_journal
+from yuque_tools.utils import metrics
 from yuque_tools.utils import utils
 from yuque_tools.utils.image_downloader import YuqueImageDownloder
+from yuque_tools.utils.image_pipeline import DEFAULT_QUEUE_SIZE
+from yuque_tools.utils.image_pipeline import ImagePipeline
+from yuque_tools.utils.image_store import ImageStore
+from yuque_tools.utils.manifest import ProcessedManifest
 
 DEFAULT_IMAGE_PATH = "_images"
+DEFAULT_IMAGE_STORE_PATH = ".images"
+DEFAULT_WORKERS = 1
+TOOL_NAME = "yuque-images-downloader"
 
 
 def parse_sys_args(argv):
@@ -37,7 +56,16 @@ def parse_sys_args(argv):
     parser.add_argument(
         "-p", "--markdown-dir",
         type=str,
-        help="Directory containing Yuque exported markdown files"
+        help="Directory containing Yuque exported markdown files, or a "
+             "zip or tar archive of them"
+    )
+    parser.add_argument(
+        "-o", "--output-archive",
+        type=str,
+        default=None,
+        help="Archive the results are written to if markdown dir is an "
+             "archive, of the format told by its extension (default: "
+             ".downloaded inserted before the extension of the input)"
     )
     parser.add_argument(
         "-i", "--image-download-dir",
@@ -53,10 +81,150 @@ def parse_sys_args(argv):
         "-b", "--backup",
         action="store_true",
         default=False,
-        help="Backup original markdown files before processing "
+        help="Backup original markdown files before processing, "
+             "unchanged files are hardlinked into the snapshot "
              "(default: False, backup to .bak in the same level as "
              "markdown dir)"
     )
+    parser.add_argument(
+        "--keep-backups",
+        type=int,
+        default=backup.DEFAULT_KEEP_SNAPSHOTS,
+        help=f"Number of backup snapshots to keep "
+             f"(default: {backup.DEFAULT_KEEP_SNAPSHOTS})"
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=f"Number of concurrent download workers, images of many "
+             f"markdown files are downloaded at once through a shared "
+             f"pooled HTTP session (default: {DEFAULT_WORKERS})"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=http_client.DEFAULT_TIMEOUT[1],
+        help=f"Timeout in seconds of connecting and reading each chunk of "
+             f"an image (default: {http_client.DEFAULT_TIMEOUT[1]})"
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=http_client.DEFAULT_RETRIES,
+        help=f"Max number of retries of an image download on connection "
+             f"errors, timeouts and 429/5xx responses "
+             f"(default: {http_client.DEFAULT_RETRIES})"
+    )
+    parser.add_argument(
+        "--convert-workers",
+        type=int,
+        default=None,
+        help="Number of processes converting downloaded images when "
+             "workers > 1 (default: number of CPU cores)"
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help=f"Max number of downloaded images waiting for conversion, "
+             f"downloads pause when the queue is full "
+             f"(default: {DEFAULT_QUEUE_SIZE})"
+    )
+    parser.add_argument(
+        "--image-format",
+        choices=image_converter.ENCODING_FORMATS,
+        default=image_converter.DEFAULT_ENCODING_FORMAT,
+        help=f"Format downloaded images are encoded to, keep to keep the "
+             f"original format, JPEG and WebP are much smaller than PNG "
+             f"for photos (default: "
+             f"{image_converter.DEFAULT_ENCODING_FORMAT})"
+    )
+    parser.add_argument(
+        "--image-quality",
+        type=int,
+        default=image_converter.DEFAULT_QUALITY,
+        help=f"Quality of JPEG and WebP images, 1 to 100 "
+             f"(default: {image_converter.DEFAULT_QUALITY})"
+    )
+    parser.add_argument(
+        "--max-image-pixels",
+        type=int,
+        default=None,
+        help="Downscale images whose width or height is larger than this, "
+             "JPEG images are decoded at reduced size (default: no limit)"
+    )
+    parser.add_argument(
+        "--max-image-bytes",
+        type=int,
+        default=None,
+        help="Byte budget of each image, larger images are re-encoded with "
+             "lower quality and downscaled to fit (default: no limit)"
+    )
+    parser.add_argument(
+        "--keep-alpha",
+        action="store_true",
+        default=False,
+        help="Keep transparency of re-encoded PNG and WebP images, it is "
+             "flattened over white by default"
+    )
+    parser.add_argument(
+        "-s", "--image-store",
+        nargs="?",
+        const="",
+        default=None,
+        help=f"Content-addressed image store, each image url is downloaded "
+             f"once and linked into every images dir. Without a value the "
+             f"store is saved to {DEFAULT_IMAGE_STORE_PATH} in the same "
+             f"level as markdown dir, reuse the same dir to dedupe across "
+             f"runs (default: disabled)"
+    )
+    parser.add_argument(
+        "-f", "--force",
+        action="store_true",
+        default=False,
+        help="Process all markdown files, ignoring the manifest of files "
+             "processed by previous runs (default: False)"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Resume an interrupted run, documents and images it finished "
+             "are not processed again (default: False)"
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=None,
+        help="Only process markdown files whose path relative to markdown "
+             "dir matches the pattern, could be given multiple times"
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=None,
+        help="Skip markdown files and directories whose path relative to "
+             "markdown dir matches the pattern, could be given multiple "
+             "times"
+    )
+
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Save timings of each stage and file to the report, as CSV if "
+             "the path ends with .csv or JSON otherwise"
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=metrics.DEFAULT_PROFILE_PATH,
+        default=None,
+        help=f"Profile the run with cProfile and save the stats to the "
+             f"file (default: {metrics.DEFAULT_PROFILE_PATH} if no file "
+             f"is given)"
+    )
 
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
@@ -69,6 +237,12 @@ def main():
     args = parse_sys_args(sys.argv)
     utils.init_logging(debug=args["debug"], verbose=args["verbose"])
 
+    with metrics.measure_run(TOOL_NAME, report_path=args["report"],
+                             profile_path=args["profile"]):
+        run(args)
+
+
+def run(args):
     markdown_dir = args["markdown_dir"]
     markdown_path = str(os.path.abspath(markdown_dir))
 
@@ -78,19 +252,236 @@ def main():
         logging.error(f"{markdown_dir} is not exists, please check.")
         sys.exit(1)
 
+    if archive.is_archive(markdown_dir):
+        run_archive(args)
+        return
+
     if args["backup"]:
-        utils.backup(markdown_dir)
+        backup.snapshot(markdown_dir, keep=args["keep_backups"])
+
+    md_files = utils.iter_md_files(
+        markdown_path, include=args["include"], exclude=args["exclude"],
+        prune=utils.DEFAULT_PRUNE_PATTERNS + (
+            os.path.basename(image_download_dir),))
+
+    options = {
+        "image_download_dir": image_download_dir,
+        "image_encoding": get_encoding_policy(args).options()
+    }
+    manifest = ProcessedManifest(
+        markdown_path, TOOL_NAME, options=options, force=args["force"])
+    journal = run_journal.Journal(
+        markdown_path, TOOL_NAME, options=options, resume=args["resume"])
 
-    md_files = utils.find_md_files(markdown_path)
-    if not md_files:
+    # Markdown files are processed as they are found
+    try:
+        download_all(
+            journal.filter_pending(manifest.filter_changed(md_files),
+                                   manifest),
+            markdown_path, args, manifest, journal)
+    except BaseException:
+        journal.close()
+        logging.info("Run is interrupted, continue it with --resume")
+        raise
+    else:
+        journal.finish()
+    finally:
+        manifest.save()
+
+    if not manifest.found:
         logging.warning("No markdown file found")
         sys.exit(1)
+    logging.info(f"Skipped {manifest.skipped} unchanged markdown files")
+
+
+def download_all(md_files, markdown_path, args, manifest=None, journal=None):
+    """Download images of markdown files, concurrently if workers > 1"""
+    image_download_dir = args["image_download_dir"]
+
+    policy = get_encoding_policy(args)
+    image_store = get_image_store(args, markdown_path)
+
+    workers = max(1, args["workers"])
+    session = http_client.create_fetcher(
+        pool_size=workers, timeout=args["timeout"], retries=args["retries"])
+
+    if workers == 1:
+        for md_file in md_files:
+            download_images(md_file, image_download_dir, session,
+                            image_store=image_store, policy=policy,
+                            manifest=manifest, journal=journal)
+        return
+
+    # Images of all markdown files are downloaded and converted in one
+    # pipeline, markdown files are handled in another pool waiting for them
+    with ImagePipeline(
+            session, workers,
+            convert_workers=args["convert_workers"],
+            queue_size=args["queue_size"],
+            image_store=image_store,
+            policy=policy,
+            debug=args["debug"],
+            verbose=args["verbose"]) as image_pipeline, \
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers,
+                thread_name_prefix="markdown") as md_executor:
+        futures = {
+            md_executor.submit(
+                download_images, md_file, image_download_dir, session,
+                image_pipeline=image_pipeline, manifest=manifest,
+                journal=journal): md_file
+            for md_file in md_files}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(
+                        f"Failed to download images for {futures[future]}: "
+                        f"{str(e)}")
+        except BaseException:
+            # Documents not started are left to a resumed run, the pool
+            # waits for the running ones when it is closed
+            utils.cancel_futures(futures)
+            raise
+
+
+def run_archive(args):
+    """Download images of markdown files of an archive into a new archive
+
+    Markdown members are written with links to their downloaded images,
+    which are added next to them. Other members, e.g. images downloaded by
+    previous runs, are copied as they are. Images are downloaded into a
+    temp dir and removed once added to the archive. Documents are written
+    one by one, images of each document are downloaded concurrently.
+    """
+    input_path = args["markdown_dir"]
+    output_path = (args["output_archive"] or
+                   archive.output_path(input_path, "downloaded"))
+    image_download_dir = args["image_download_dir"]
+    prune = utils.DEFAULT_PRUNE_PATTERNS + (
+        os.path.basename(image_download_dir),)
+
+    policy = get_encoding_policy(args)
+    image_store = get_image_store(
+        args, input_path[:-len(archive.archive_suffix(input_path))])
+    workers = max(1, args["workers"])
+    session = http_client.create_fetcher(
+        pool_size=workers, timeout=args["timeout"], retries=args["retries"])
+
+    image_pipeline = contextlib.nullcontext()
+    if workers > 1:
+        image_pipeline = ImagePipeline(
+            session, workers,
+            convert_workers=args["convert_workers"],
+            queue_size=args["queue_size"],
+            image_store=image_store,
+            policy=policy,
+            debug=args["debug"],
+            verbose=args["verbose"])
+
+    found = 0
+    with archive.ArchiveReader(input_path) as reader, \
+            archive.create_archive(output_path) as writer, \
+            tempfile.TemporaryDirectory(prefix="yuque-tools-") as work_dir, \
+            image_pipeline as image_pipeline:
+        # Names of images saved by previous runs in each dir
+        saved_names = {}
+        for name in reader.names():
+            dirname, basename = posixpath.split(name)
+            saved_names.setdefault(dirname, []).append(basename)
+
+        for member in reader:
+            if not utils.is_md_path(member.name, include=args["include"],
+                                    exclude=args["exclude"], prune=prune):
+                writer.copy(reader, member)
+                continue
+
+            found += 1
+            data = reader.read(member)
+            if not image_scanner.has_images(data):
+                writer.copy(reader, member)
+                continue
+
+            logging.info(f"Starting to download images for {member.name}")
+            image_dir = posixpath.join(
+                posixpath.dirname(member.name), image_download_dir)
+            md_path = os.path.join(work_dir, *member.name.split("/"))
+            image_path = os.path.join(os.path.dirname(md_path),
+                                      image_download_dir)
+            image_downloader = YuqueImageDownloder(
+                md_path, image_download_dir, session=session,
+                image_store=image_store, image_pipeline=image_pipeline,
+                policy=policy, saved_names=saved_names.get(image_dir, []))
+            try:
+                with metrics.timer("markdown", item=member.name):
+                    text = image_downloader.download_text(
+                        data.decode("utf-8"))
+            except Exception as e:
+                logging.error(f"Failed to download images for "
+                              f"{member.name}: {str(e)}")
+                shutil.rmtree(image_path, ignore_errors=True)
+                writer.copy(reader, member)
+                continue
+
+            # Images are added once downloaded, the temp dir never holds
+            # images of more than one document
+            if os.path.isdir(image_path):
+                with os.scandir(image_path) as entries:
+                    for entry in entries:
+                        writer.write_file(
+                            posixpath.join(image_dir, entry.name),
+                            entry.path)
+                        os.remove(entry.path)
+            writer.write(member.name, text.encode("utf-8"))
+            logging.info(f"Finish downloading images for {member.name}")
+
+    if not found:
+        logging.warning("No markdown file found")
+        sys.exit(1)
+
+
+def download_images(md_file, image_download_dir, session,
+                    image_store=None, image_pipeline=None, policy=None,
+                    manifest=None, journal=None):
+    logging.info(f"Starting to download images for {md_file}")
+    image_downloader = YuqueImageDownloder(
+        md_file, image_download_dir, session=session,
+        image_store=image_store, image_pipeline=image_pipeline,
+        policy=policy, journal=journal)
+    with metrics.timer("markdown", item=md_file):
+        failed = image_downloader.download()
+    if failed:
+        # Not recorded as processed, so the next run retries the images
+        logging.warning(f"Failed to download {failed} images of {md_file}, "
+                        f"they are retried by the next run")
+    else:
+        if journal:
+            journal.doc_done(md_file)
+        if manifest:
+            manifest.update(md_file)
+    logging.info(f"Finish downloading images for {md_file}")
+    if image_pipeline:
+        logging.info(f"Image pipeline: {image_pipeline.counters}")
+
+
+def get_image_store(args, base_path):
+    """Return image store from arguments, None if it is disabled
+
+    The default store is saved next to base_path, e.g. the markdown dir.
+    """
+    if args["image_store"] is None:
+        return None
+    return ImageStore(args["image_store"] or
+                      base_path + DEFAULT_IMAGE_STORE_PATH)
+
 
-    for md_file in md_files:
-        logging.info(f"Starting to download images for {md_file}")
-        image_downloader = YuqueImageDownloder(md_file, image_download_dir)
-        image_downloader.download()
-        logging.info(f"Finish downloading images for {md_file}")
+def get_encoding_policy(args):
+    """Return encoding policy of downloaded images from arguments"""
+    return image_converter.EncodingPolicy(
+        format=args["image_format"], quality=args["image_quality"],
+        max_pixels=args["max_image_pixels"],
+        max_bytes=args["max_image_bytes"], keep_alpha=args["keep_alpha"])
 
 
 if __name__ == "__main__":
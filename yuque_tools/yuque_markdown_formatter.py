@@ -9,15 +9,21 @@
 
 
 import argparse
+import io
 import logging
 import os
 import shutil
 import sys
 
+from yuque_tools.utils import archive
+from yuque_tools.utils import backup
+from yuque_tools.utils import metrics
 from yuque_tools.utils import utils
+from yuque_tools.utils.manifest import ProcessedManifest
 from yuque_tools.utils.markdown_formatter import MarkdownFormatter
 
 DEFAULT_BACKUP_PATH = ".bak"
+TOOL_NAME = "yuque-markdown-formatter"
 
 
 def parse_sys_args(argv):
@@ -33,16 +39,72 @@ def parse_sys_args(argv):
     parser.add_argument(
         "-p", "--markdown-dir",
         type=str,
-        help="Directory containing Yuque exported markdown files"
+        help="Directory containing Yuque exported markdown files, or a "
+             "zip or tar archive of them"
+    )
+    parser.add_argument(
+        "-o", "--output-archive",
+        type=str,
+        default=None,
+        help="Archive the results are written to if markdown dir is an "
+             "archive, of the format told by its extension (default: "
+             ".formatted inserted before the extension of the input)"
     )
     parser.add_argument(
         "-b", "--backup",
         action="store_true",
         default=False,
-        help="Backup original markdown files before processing "
+        help="Backup original markdown files before processing, "
+             "unchanged files are hardlinked into the snapshot "
              "(default: False, backup to .bak in the same level as "
              "markdown dir)"
     )
+    parser.add_argument(
+        "--keep-backups",
+        type=int,
+        default=backup.DEFAULT_KEEP_SNAPSHOTS,
+        help=f"Number of backup snapshots to keep "
+             f"(default: {backup.DEFAULT_KEEP_SNAPSHOTS})"
+    )
+    parser.add_argument(
+        "-f", "--force",
+        action="store_true",
+        default=False,
+        help="Process all markdown files, ignoring the manifest of files "
+             "processed by previous runs (default: False)"
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=None,
+        help="Only process markdown files whose path relative to markdown "
+             "dir matches the pattern, could be given multiple times"
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=None,
+        help="Skip markdown files and directories whose path relative to "
+             "markdown dir matches the pattern, could be given multiple "
+             "times"
+    )
+
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Save timings of each stage and file to the report, as CSV if "
+             "the path ends with .csv or JSON otherwise"
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=metrics.DEFAULT_PROFILE_PATH,
+        default=None,
+        help=f"Profile the run with cProfile and save the stats to the "
+             f"file (default: {metrics.DEFAULT_PROFILE_PATH} if no file "
+             f"is given)"
+    )
 
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
@@ -55,6 +117,12 @@ def main():
     args = parse_sys_args(sys.argv)
     utils.init_logging(debug=args["debug"], verbose=args["verbose"])
 
+    with metrics.measure_run(TOOL_NAME, report_path=args["report"],
+                             profile_path=args["profile"]):
+        run(args)
+
+
+def run(args):
     markdown_dir = args["markdown_dir"]
     markdown_path = str(os.path.abspath(markdown_dir))
 
@@ -62,19 +130,67 @@ def main():
         logging.error(f"{markdown_dir} is not exists, please check.")
         sys.exit(1)
 
-    if args["backup"]:
-        utils.backup(markdown_dir)
+    if archive.is_archive(markdown_dir):
+        run_archive(args)
+        return
 
-    md_files = utils.find_md_files(markdown_path)
-    if not md_files:
+    if args["backup"]:
+        backup.snapshot(markdown_dir, keep=args["keep_backups"])
+
+    md_files = utils.iter_md_files(
+        markdown_path, include=args["include"], exclude=args["exclude"])
+
+    manifest = ProcessedManifest(
+        markdown_path, TOOL_NAME, force=args["force"])
+    try:
+        # Markdown files are formatted as they are found
+        for md_file in manifest.filter_changed(md_files):
+            logging.info(f"Starting to format markdown for {md_file}")
+            image_downloader = MarkdownFormatter(md_file)
+            with metrics.timer("format", item=md_file):
+                image_downloader.format()
+            manifest.update(md_file)
+            logging.info(f"Finish formatting markdown for {md_file}")
+    finally:
+        manifest.save()
+
+    if not manifest.found:
+        logging.warning("No markdown file found")
+        sys.exit(1)
+    logging.info(f"Skipped {manifest.skipped} unchanged markdown files")
+
+
+def run_archive(args):
+    """Format markdown files of an archive into a new archive
+
+    Members are read as streams and written as they are formatted, other
+    members are copied as they are.
+    """
+    input_path = args["markdown_dir"]
+    output_path = (args["output_archive"] or
+                   archive.output_path(input_path, "formatted"))
+
+    found = 0
+    with archive.ArchiveReader(input_path) as reader, \
+            archive.create_archive(output_path) as writer:
+        for member in reader:
+            if not utils.is_md_path(member.name, include=args["include"],
+                                    exclude=args["exclude"]):
+                writer.copy(reader, member)
+                continue
+
+            found += 1
+            logging.info(f"Starting to format markdown for {member.name}")
+            output = io.StringIO()
+            with reader.open(member) as f, \
+                    metrics.timer("format", item=member.name):
+                MarkdownFormatter(member.name).format_stream(
+                    io.TextIOWrapper(f, encoding="utf-8"), output)
+            writer.write(member.name, output.getvalue().encode("utf-8"))
+
+    if not found:
         logging.warning("No markdown file found")
         sys.exit(1)
-
-    for md_file in md_files:
-        logging.info(f"Starting to format markdown for {md_file}")
-        image_downloader = MarkdownFormatter(md_file)
-        image_downloader.format()
-        logging.info(f"Finish formatting markdown for {md_file}")
 
 
 if __name__ == "__main__":